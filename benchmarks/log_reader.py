@@ -0,0 +1,85 @@
+# coding=utf-8
+"""
+Compares reading and searching a large log file through file objects
+(LogReader) and through memory mappings (MmapLogReader).
+
+    python benchmarks/log_reader.py [size in MB]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from psdash.log import LogIndex, LogReader, MappedFile, MmapLogReader, ReverseFileSearcher
+
+
+def create_log(filename, size):
+    with open(filename, 'w') as f:
+        i = 0
+        while f.tell() < size:
+            f.write('2016-01-01 12:%02d:%02d INFO worker-%d handled request id=%d status=200\n' % (
+                i / 60 % 60, i % 60, i % 16, i
+            ))
+            i += 1
+    return i
+
+
+def measure(name, func, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        func()
+    elapsed = time.time() - start
+    print '%-40s %8.3f ms' % (name, elapsed / repeat * 1000)
+
+
+def main():
+    size = int(sys.argv[1] if len(sys.argv) > 1 else 100) * 1024 * 1024
+    _, filename = tempfile.mkstemp(suffix='.log')
+    try:
+        num_lines = create_log(filename, size)
+        print 'Log of %d MB, %d lines' % (size / 1024 / 1024, num_lines)
+
+        readers = [
+            ('file', LogReader(filename)),
+            ('mmap', MmapLogReader(filename))
+        ]
+        offsets = [random.randint(0, size) for _ in xrange(1000)]
+
+        for name, reader in readers:
+            def tail():
+                reader.set_tail_position()
+                reader.read()
+            measure('tail (%s)' % name, tail, 1000)
+
+            def windows():
+                for offset in offsets:
+                    reader.seek(offset)
+                    reader.read()
+            measure('1000 window reads (%s)' % name, windows, 10)
+
+        needles = ['id=%d ' % random.randint(0, num_lines) for _ in xrange(10)]
+
+        def reverse_searcher():
+            for needle in needles:
+                ReverseFileSearcher(filename, needle).find()
+        measure('10 searches (ReverseFileSearcher)', reverse_searcher, 1)
+
+        mapped = MappedFile(filename)
+
+        for name, index in [('file', LogIndex(filename)), ('mmap', LogIndex(filename, mapped=mapped))]:
+            measure('build index (%s)' % name, index.update, 1)
+
+            def indexed():
+                for needle in needles:
+                    index.rfind(needle)
+            measure('10 searches (index, %s)' % name, indexed, 1)
+
+        for _, reader in readers:
+            reader.close()
+        mapped.close()
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
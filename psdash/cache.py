@@ -0,0 +1,122 @@
+# coding=utf-8
+import json
+import time
+
+
+def make_key(name, args):
+    try:
+        hash(args)
+        return name, args
+    except TypeError:
+        # e.g. the filters dict passed to get_connections
+        return name, json.dumps(args, sort_keys=True, default=repr)
+
+
+class TTLCache(object):
+    """
+    Values that expire a given number of seconds after being set.
+    """
+    DEFAULT_MAX_ENTRIES = 1000
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # key => (expires, value)
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns a tuple of (found, value).
+        """
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            return True, entry[1]
+        return False, None
+
+    def set(self, key, value, ttl):
+        if len(self._entries) >= self.max_entries:
+            self.purge()
+        self._entries[key] = (time.time() + ttl, value)
+
+    def purge(self):
+        now = time.time()
+        for key, (expires, _) in self._entries.items():
+            if expires <= now:
+                del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+
+class MemoizedService(object):
+    """
+    Wraps a node service so that identical calls are only made once for as
+    long as the wrapper lives (i.e. a request). The results of the methods
+    given a ttl are also kept in a cache shared by all wrappers of the node.
+    Results are shared, so they must not be modified by the caller.
+    """
+    DEFAULT_TTLS = {
+        'get_disks': 10,
+        'get_connections': 2
+    }
+
+    def __init__(self, service, node_id, shared_cache, ttls=None):
+        self.service = service
+        self.node_id = node_id
+        self.shared_cache = shared_cache
+        self.ttls = ttls if ttls is not None else self.DEFAULT_TTLS
+        self._results = {}
+
+    def _get_cached(self, key):
+        if key in self._results:
+            return True, self._results[key]
+        if key[0] in self.ttls:
+            found, value = self.shared_cache.get((self.node_id,) + key)
+            if found:
+                self._results[key] = value
+            return found, value
+        return False, None
+
+    def _set_cached(self, key, value):
+        self._results[key] = value
+        ttl = self.ttls.get(key[0])
+        if ttl:
+            self.shared_cache.set((self.node_id,) + key, value, ttl)
+
+    def _call(self, name, *args):
+        key = make_key(name, args)
+        found, value = self._get_cached(key)
+        if not found:
+            value = getattr(self.service, name)(*args)
+            self._set_cached(key, value)
+        return value
+
+    def batch(self, calls):
+        """
+        Like LocalService.batch() but only the calls that are not
+        already cached are passed on to the service.
+        """
+        keys = [make_key(name, tuple(args)) for name, args in calls]
+        results = {}
+        missing = []
+        for key, (name, args) in zip(keys, calls):
+            found, value = self._get_cached(key)
+            if found:
+                results[key] = value
+            elif key not in results:
+                results[key] = None
+                missing.append((key, (name, args)))
+
+        if missing:
+            values = self.service.batch([call for _, call in missing])
+            for (key, _), value in zip(missing, values):
+                self._set_cached(key, value)
+                results[key] = value
+
+        return [results[key] for key in keys]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, *args)
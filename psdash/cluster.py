@@ -0,0 +1,111 @@
+# coding=utf-8
+import logging
+import time
+import gevent
+from gevent.pool import Pool
+
+logger = logging.getLogger('psdash.cluster')
+
+
+SUMMARY_CALLS = [
+    ('get_sysinfo', ()),
+    ('get_memory', ()),
+    ('get_swap_space', ()),
+    ('get_cpu', ())
+]
+
+
+def get_node_summary(service):
+    sysinfo, memory, swap, cpu = service.batch(SUMMARY_CALLS)
+    return {
+        'hostname': sysinfo['hostname'],
+        'os': sysinfo['os'],
+        'uptime': sysinfo['uptime'],
+        'load_avg': sysinfo['load_avg'],
+        'num_cpus': sysinfo['num_cpus'],
+        'cpu': cpu,
+        'memory_percent': memory['percent'],
+        'memory_total': memory['total'],
+        'swap_percent': swap['percent']
+    }
+
+
+class ClusterOverview(object):
+    """
+    Queries the summary of every node in parallel, giving each node at most
+    `timeout` seconds to respond. Nodes that fail or are too slow are
+    reported with the last summary they did respond with, if any.
+    """
+    DEFAULT_POOL_SIZE = 20
+    DEFAULT_TIMEOUT = 2
+    DEFAULT_CACHE_TTL = 2
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT, cache_ttl=DEFAULT_CACHE_TTL):
+        self.pool = Pool(pool_size)
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        # node id => (timestamp, summary)
+        self._responses = {}
+
+    def _get_cached(self, node_id, max_age=None):
+        cached = self._responses.get(node_id)
+        if cached and (max_age is None or time.time() - cached[0] <= max_age):
+            return cached
+        return None
+
+    def _query_node(self, node_id, node):
+        """
+        Returns a tuple of (status, error message).
+        """
+        try:
+            with gevent.Timeout(self.timeout):
+                summary = get_node_summary(node.get_service())
+        except gevent.Timeout:
+            logger.warning('Timed out querying node %s after %s seconds', node_id, self.timeout)
+            return 'timeout', None
+        except Exception as e:
+            logger.warning('Failed to query node %s: %s', node_id, e)
+            return 'error', str(e)
+
+        self._responses[node_id] = (time.time(), summary)
+        return 'ok', None
+
+    def _create_entry(self, node_id, node, status, error=None):
+        entry = {
+            'id': node_id,
+            'name': node.name,
+            'status': status,
+            'error': error,
+            'updated': None,
+            'summary': None
+        }
+        cached = self._get_cached(node_id)
+        if cached:
+            entry['updated'], entry['summary'] = cached
+        return entry
+
+    def query(self, nodes):
+        """
+        Returns a list with an entry for each node in the given dict of
+        node id => node, sorted by node id. The status of an entry is one of
+        'ok', 'timeout' or 'error'.
+        """
+        greenlets = {}
+        for node_id, node in nodes.iteritems():
+            if not self._get_cached(node_id, self.cache_ttl):
+                # blocks while all of the pool is busy, every query is bounded by the timeout though
+                greenlets[node_id] = self.pool.spawn(self._query_node, node_id, node)
+
+        gevent.joinall(greenlets.values())
+
+        entries = []
+        for node_id, node in sorted(nodes.iteritems()):
+            g = greenlets.get(node_id)
+            status, error = g.value if g is not None else ('ok', None)
+            entries.append(self._create_entry(node_id, node, status, error))
+
+        # forget about nodes that are no longer registered
+        for node_id in set(self._responses) - set(nodes):
+            del self._responses[node_id]
+
+        return entries
@@ -0,0 +1,329 @@
+# coding=utf-8
+"""
+Keeps the available logs in line with the log patterns, by watching only the
+directories the patterns can match files in. With inotify the directories
+are watched for changes, otherwise they are polled and only the directories
+whose modification time has changed are listed again.
+"""
+import logging
+import os
+import re
+import time
+from psdash import inotify
+from psdash.log import LogError
+
+logger = logging.getLogger('psdash.discovery')
+
+
+def pattern_to_regex(pattern):
+    """
+    Translates a glob pattern to a regular expression. Like with glob2, **
+    matches any number of directories, the other wildcards never match a /.
+    """
+    i, n = 0, len(pattern)
+    res = ''
+    while i < n:
+        if pattern.startswith('**/', i):
+            res += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            res += '.*'
+            i += 2
+            continue
+
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            res += '[^/]*'
+        elif c == '?':
+            res += '[^/]'
+        elif c == '[' and pattern.find(']', i + 1) > -1:
+            j = pattern.find(']', i + 1)
+            chars = pattern[i:j].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            res += '[%s]' % chars
+            i = j + 1
+        else:
+            res += re.escape(c)
+    return re.compile(res + r'\Z')
+
+
+class LogPattern(object):
+    """
+    A glob pattern of log files, along with the directories it can match
+    files in: the directory before the first wildcard and, depending on the
+    pattern, its subdirectories down to max_depth (None for any depth).
+    """
+    WILDCARDS_RE = re.compile(r'[*?\[]')
+
+    def __init__(self, pattern):
+        self.pattern = os.path.abspath(pattern)
+        self.regex = pattern_to_regex(self.pattern)
+
+        parts = self.pattern.split('/')
+        num_static = len(parts) - 1
+        for i, part in enumerate(parts[:-1]):
+            if self.WILDCARDS_RE.search(part):
+                num_static = i
+                break
+        self.base_dir = '/'.join(parts[:num_static]) or '/'
+        self.max_depth = None if '**' in self.pattern else len(parts) - num_static - 1
+        # like glob, wildcards don't match hidden files
+        self.match_hidden = parts[-1].startswith('.')
+
+    def __repr__(self):
+        return '<LogPattern %s>' % self.pattern
+
+    def get_depth(self, dirname):
+        """
+        Returns the depth of dirname below base_dir, or None if outside of it.
+        """
+        if dirname == self.base_dir:
+            return 0
+        prefix = self.base_dir.rstrip('/') + '/'
+        if not dirname.startswith(prefix):
+            return None
+        return dirname[len(prefix):].count('/') + 1
+
+    def covers_dir(self, dirname):
+        depth = self.get_depth(dirname)
+        return depth is not None and (self.max_depth is None or depth <= self.max_depth)
+
+    def matches(self, path):
+        if not self.match_hidden and os.path.basename(path).startswith('.'):
+            return False
+        return bool(self.regex.match(path))
+
+
+class LogDiscovery(object):
+    """
+    Adds the files matching any of the patterns to logs, and removes them
+    once deleted. Call scan() once, then either start_watching() and
+    watch() in a loop, or poll() periodically. When watching, poll() is
+    still to be called periodically, for the directories that could not be
+    watched and the base directories that did not exist yet.
+
+    A deleted file is only removed if it's still gone REMOVE_DELAY seconds
+    later: a log rotated by moving it away is back at its path right after,
+    and keeps its readers (which read the rest of the rotated file).
+    """
+    DIR_EVENTS = (inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+                  inotify.IN_ATTRIB | inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_ONLYDIR)
+    RACY_INTERVAL = 2
+    REMOVE_DELAY = 2
+
+    def __init__(self, logs, patterns):
+        self.logs = logs
+        self.patterns = [LogPattern(p) for p in patterns]
+        self.inotify = None
+        # directory => modification time when last listed, None to list it
+        # again on the next poll
+        self.dirs = {}
+        # the files added to logs
+        self.files = set()
+        # deleted file => time to remove it at if it's still gone
+        self._removals = {}
+        # watch descriptor => directory
+        self._watches = {}
+        self._dir_watches = {}
+        self.num_scanned_dirs = 0
+
+    def _covers_dir(self, dirname):
+        return any(p.covers_dir(dirname) for p in self.patterns)
+
+    def _matches(self, path):
+        return any(p.matches(path) for p in self.patterns)
+
+    def _add_file(self, path):
+        self._removals.pop(path, None)
+        if path in self.files:
+            return
+        try:
+            self.logs.add_available(path)
+            self.files.add(path)
+        except LogError as e:
+            logger.warning(e)
+
+    def _remove_file(self, path):
+        self._removals.pop(path, None)
+        if path not in self.files:
+            return
+        self.files.discard(path)
+        filename = path.decode('utf-8')
+        if filename in self.logs.available:
+            logger.debug('Removing log file %s', filename)
+            self.logs.remove_available(filename)
+
+    def _schedule_removal(self, path):
+        if path in self.files and path not in self._removals:
+            self._removals[path] = time.time() + self.REMOVE_DELAY
+
+    def _remove_deleted(self):
+        """
+        Removes the files deleted long enough ago that are still gone.
+        """
+        now = time.time()
+        for path, remove_at in self._removals.items():
+            if remove_at > now:
+                continue
+            if os.path.isfile(path):
+                del self._removals[path]
+            else:
+                self._remove_file(path)
+
+    def _watch_dir(self, dirname):
+        if not self.inotify or dirname in self._dir_watches:
+            return
+        try:
+            wd = self.inotify.add_watch(dirname, self.DIR_EVENTS)
+        except OSError as e:
+            logger.warning('Could not watch %s, falling back to polling it (%s)', dirname, e)
+            return
+        self._watches[wd] = dirname
+        self._dir_watches[dirname] = wd
+
+    def _unwatch_dir(self, dirname):
+        wd = self._dir_watches.pop(dirname, None)
+        if wd is not None:
+            self._watches.pop(wd, None)
+            self.inotify.rm_watch(wd)
+
+    def _scan_dir(self, dirname):
+        """
+        Lists dirname to add the new matching files and remove the
+        deleted ones, recursing into the new directories to cover.
+        """
+        try:
+            mtime = os.stat(dirname).st_mtime
+            # watched first, for no change to go unnoticed while listing
+            self._watch_dir(dirname)
+            names = os.listdir(dirname)
+        except OSError:
+            self._remove_dir(dirname)
+            return
+
+        # a change made right after listing can leave the modification time
+        # as it was, so recently modified directories are listed again
+        self.dirs[dirname] = mtime if time.time() - mtime > self.RACY_INTERVAL else None
+        self.num_scanned_dirs += 1
+
+        present = set()
+        for name in names:
+            path = os.path.join(dirname, name)
+            if os.path.isdir(path):
+                if path not in self.dirs and self._covers_dir(path):
+                    self._scan_dir(path)
+            elif self._matches(path) and os.path.isfile(path):
+                present.add(path)
+                self._add_file(path)
+
+        for path in [f for f in self.files if os.path.dirname(f) == dirname and f not in present]:
+            self._schedule_removal(path)
+
+    def _remove_dir(self, dirname):
+        prefix = dirname.rstrip('/') + '/'
+        for d in [d for d in self.dirs if d == dirname or d.startswith(prefix)]:
+            del self.dirs[d]
+            if self.inotify:
+                self._unwatch_dir(d)
+        for path in [f for f in self.files if f.startswith(prefix)]:
+            self._remove_file(path)
+
+    def scan(self):
+        """
+        Lists every directory the patterns can match files in.
+        """
+        for p in self.patterns:
+            if p.base_dir not in self.dirs:
+                self._scan_dir(p.base_dir)
+        logger.info('Found %d log file(s) in %d directories', len(self.files), len(self.dirs))
+        return len(self.files)
+
+    def poll(self):
+        """
+        Lists the directories changed since they were last listed, returns
+        the number of directories listed. The watched directories are left
+        to watch().
+        """
+        num_scanned = self.num_scanned_dirs
+        for dirname, mtime in self.dirs.items():
+            if dirname not in self.dirs or dirname in self._dir_watches:
+                # removed along with its parent, or watched
+                continue
+            try:
+                changed = os.stat(dirname).st_mtime != mtime
+            except OSError:
+                changed = True
+            if changed:
+                self._scan_dir(dirname)
+
+        # base directories that didn't exist yet
+        for p in self.patterns:
+            if p.base_dir not in self.dirs and os.path.isdir(p.base_dir):
+                self._scan_dir(p.base_dir)
+
+        self._remove_deleted()
+        return self.num_scanned_dirs - num_scanned
+
+    def process_events(self, events):
+        for wd, mask, _, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                logger.info('Missed inotify events, listing all log directories')
+                for dirname in self.dirs.keys():
+                    if dirname in self.dirs:
+                        self._scan_dir(dirname)
+                continue
+
+            dirname = self._watches.get(wd)
+            if dirname is None:
+                continue
+
+            if mask & (inotify.IN_DELETE_SELF | inotify.IN_MOVE_SELF | inotify.IN_IGNORED):
+                self._remove_dir(dirname)
+                continue
+
+            path = os.path.join(dirname, name)
+            if mask & inotify.IN_ISDIR:
+                if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO) and self._covers_dir(path):
+                    self._scan_dir(path)
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    self._remove_dir(path)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                self._schedule_removal(path)
+            elif self._matches(path) and os.path.isfile(path):
+                # created, moved in or permissions changed
+                self._add_file(path)
+
+    def start_watching(self, inotify_instance):
+        """
+        Watches the directories with the given Inotify instance. They are
+        listed again, for the changes made before being watched.
+        """
+        self.inotify = inotify_instance
+        for dirname in self.dirs.keys():
+            if dirname in self.dirs:
+                self._scan_dir(dirname)
+        self.scan()
+
+    def watch(self, timeout=None):
+        """
+        Waits for and processes the changes to the watched directories.
+        Returns False if no change was seen within timeout seconds.
+        """
+        if self._removals:
+            # woken up in time to remove the deleted files
+            wait = max(min(self._removals.values()) - time.time(), 0)
+            timeout = wait if timeout is None else min(timeout, wait)
+
+        changed = self.inotify.wait(timeout)
+        if changed:
+            self.process_events(self.inotify.read_events())
+        self._remove_deleted()
+        return changed
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
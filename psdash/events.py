@@ -0,0 +1,136 @@
+# coding=utf-8
+import logging
+from gevent.queue import Queue, Full, Empty
+
+logger = logging.getLogger('psdash.events')
+
+
+def diff(old, new):
+    """
+    Returns the parts of new that differ from old.
+    Dicts are compared key by key, recursively, and keys that
+    are missing from new are included with a value of None.
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+
+    delta = {}
+    for k, v in new.iteritems():
+        if k not in old:
+            delta[k] = v
+        elif old[k] != v:
+            delta[k] = diff(old[k], v)
+
+    for k in old:
+        if k not in new:
+            delta[k] = None
+
+    return delta
+
+
+class Subscription(object):
+    """
+    The queue of (channel, data) events waiting to be sent to a subscriber.
+    A subscriber not keeping up with the events is closed rather than
+    letting its queue grow without bounds.
+    """
+
+    def __init__(self, channels, max_pending):
+        self.channels = frozenset(channels)
+        self.closed = False
+        self._queue = Queue(maxsize=max_pending)
+
+    def put(self, channel, data):
+        if self.closed or channel not in self.channels:
+            return
+        try:
+            self._queue.put_nowait((channel, data))
+        except Full:
+            logger.info('Closing subscription as it fell behind by %d events', self._queue.maxsize)
+            self.close()
+
+    def get(self, timeout=None):
+        """
+        Returns the next event or None if there was none within timeout.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.closed = True
+
+
+class Publisher(object):
+    """
+    Fans out snapshots to any number of subscribers, sending each subscriber
+    the full snapshot once and then only the fields that changed.
+    """
+    DEFAULT_MAX_PENDING = 20
+
+    def __init__(self, max_pending=DEFAULT_MAX_PENDING):
+        self.max_pending = max_pending
+        self._snapshots = {}
+        self._subscriptions = set()
+
+    def subscribe(self, channels):
+        subscription = Subscription(channels, self.max_pending)
+        for channel, snapshot in self._snapshots.iteritems():
+            subscription.put(channel, snapshot)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        self._subscriptions.discard(subscription)
+
+    def get_channels(self):
+        """
+        Returns the channels that have at least one subscriber.
+        """
+        channels = set()
+        for s in self._subscriptions:
+            channels.update(s.channels)
+        return channels
+
+    def publish(self, channel, snapshot):
+        delta = diff(self._snapshots.get(channel), snapshot)
+        self._snapshots[channel] = snapshot
+        if not delta:
+            return
+
+        for s in list(self._subscriptions):
+            s.put(channel, delta)
+            if s.closed:
+                self._subscriptions.discard(s)
+
+
+def get_overview(service):
+    sysinfo = service.get_sysinfo()
+    # a copy, the service may return the dict it keeps (e.g. from a push)
+    memory = dict(service.get_memory())
+    memory['used_excl'] = memory['total'] - memory['available']
+    return {
+        'uptime': sysinfo['uptime'],
+        'load_avg': sysinfo['load_avg'],
+        'cpu': service.get_cpu(),
+        'memory': memory,
+        'swap': service.get_swap_space()
+    }
+
+
+def get_network(service):
+    return service.get_network_interfaces()
+
+
+def get_processes(service):
+    return dict((str(p['pid']), p) for p in service.get_process_list())
+
+
+# channel => function returning the channel's snapshot from a node service
+CHANNELS = {
+    'overview': get_overview,
+    'network': get_network,
+    'processes': get_processes
+}
@@ -0,0 +1,335 @@
+# coding=utf-8
+import logging
+import mmap
+import os
+import struct
+import time
+from array import array
+
+logger = logging.getLogger('psdash.history')
+
+
+class RingBuffer(object):
+    """
+    A fixed number of (timestamp, value) points kept in preallocated arrays,
+    overwriting the oldest point once full.
+    Points are expected to be appended in chronological order.
+    """
+    ITEM_SIZE = array('d').itemsize * 2
+
+    def __init__(self, size):
+        self.size = int(size)
+        self._timestamps = array('d', [0.0]) * self.size
+        self._values = array('d', [0.0]) * self.size
+        self._next = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _get_timestamp(self, idx):
+        return self._timestamps[idx]
+
+    def _get_point(self, idx):
+        return self._timestamps[idx], self._values[idx]
+
+    def _set_point(self, idx, timestamp, value):
+        self._timestamps[idx] = timestamp
+        self._values[idx] = value
+
+    def get_newest(self):
+        if not self._count:
+            return None
+        return self._get_timestamp(self._index(self._count - 1))
+
+    def append(self, timestamp, value):
+        newest = self.get_newest()
+        if newest is not None and timestamp <= newest:
+            # e.g. the bucket that was being filled when psdash was restarted
+            if timestamp == newest:
+                self._set_point(self._index(self._count - 1), timestamp, value)
+            return
+        self._set_point(self._next, timestamp, value)
+        self._next = (self._next + 1) % self.size
+        self._count = min(self._count + 1, self.size)
+
+    def _index(self, i):
+        # maps the i:th oldest point to its position in the arrays
+        return (self._next - self._count + i) % self.size
+
+    def _bisect(self, timestamp):
+        # the number of points older than timestamp
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._get_timestamp(self._index(mid)) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get_oldest(self):
+        if not self._count:
+            return None
+        return self._get_timestamp(self._index(0))
+
+    def get_range(self, start=None, end=None):
+        """
+        Returns the points with start <= timestamp <= end as a list of
+        (timestamp, value) tuples, oldest first.
+        """
+        first = self._bisect(start) if start is not None else 0
+        last = self._bisect(end + 1e-9) if end is not None else self._count
+        return [self._get_point(self._index(i)) for i in xrange(first, last)]
+
+    def close(self):
+        pass
+
+
+class MmapRingBuffer(RingBuffer):
+    """
+    A RingBuffer kept in a memory-mapped file, round robin style, so that
+    it survives restarts. The file is a fixed size header followed by
+    the fixed size records, opening it never reads more than the header.
+    """
+    MAGIC = 'PSDH'
+    VERSION = 1
+    # magic, version, size, next, count
+    HEADER = struct.Struct('<4sIQQQ')
+    RECORD = struct.Struct('<dd')
+
+    def __init__(self, filename, size):
+        self.filename = filename
+        self.size = int(size)
+        file_size = self.HEADER.size + self.size * self.RECORD.size
+
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != file_size:
+                os.ftruncate(fd, file_size)
+            self._mm = mmap.mmap(fd, file_size)
+        finally:
+            os.close(fd)
+
+        magic, version, size, self._next, self._count = self.HEADER.unpack_from(self._mm, 0)
+        if magic != self.MAGIC or version != self.VERSION or size != self.size:
+            if magic != '\0' * 4:
+                logger.info('Discarding incompatible history in %s', filename)
+            self._next = 0
+            self._count = 0
+            self._write_header()
+
+    def _write_header(self):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.VERSION, self.size, self._next, self._count)
+
+    def _offset(self, idx):
+        return self.HEADER.size + idx * self.RECORD.size
+
+    def _get_timestamp(self, idx):
+        return struct.unpack_from('<d', self._mm, self._offset(idx))[0]
+
+    def _get_point(self, idx):
+        return self.RECORD.unpack_from(self._mm, self._offset(idx))
+
+    def _set_point(self, idx, timestamp, value):
+        self.RECORD.pack_into(self._mm, self._offset(idx), timestamp, value)
+
+    def append(self, timestamp, value):
+        super(MmapRingBuffer, self).append(timestamp, value)
+        self._write_header()
+
+    def close(self):
+        self._mm.flush()
+        self._mm.close()
+
+
+class Tier(object):
+    """
+    Keeps the average value of every `resolution` seconds.
+    """
+
+    def __init__(self, resolution, buffer):
+        self.resolution = resolution
+        self.buffer = buffer
+        self._bucket = None
+        self._sum = 0.0
+        self._count = 0
+
+    def add(self, timestamp, value):
+        bucket = int(timestamp // self.resolution)
+        if bucket != self._bucket:
+            self.flush()
+            self._bucket = bucket
+        self._sum += value
+        self._count += 1
+
+    def flush(self):
+        if self._count:
+            self.buffer.append(self._bucket * self.resolution, self._sum / self._count)
+        self._sum = 0.0
+        self._count = 0
+
+    def get_range(self, start=None, end=None):
+        return self.buffer.get_range(start, end)
+
+
+class Metric(object):
+    def __init__(self, name, tiers, directory=None):
+        self.name = name
+        self.tiers = []
+        for resolution, size in tiers:
+            if directory:
+                filename = os.path.join(directory, '%s.%ds.hist' % (name.replace(os.sep, '_'), resolution))
+                buf = MmapRingBuffer(filename, size)
+            else:
+                buf = RingBuffer(size)
+            self.tiers.append(Tier(resolution, buf))
+
+    def add(self, timestamp, value):
+        for t in self.tiers:
+            t.add(timestamp, value)
+
+    def get_tier(self, resolution=None, start=None):
+        """
+        Returns the tier with the given resolution. Without a resolution
+        the finest tier still holding points as old as start is returned.
+        """
+        if resolution is not None:
+            for t in self.tiers:
+                if t.resolution == resolution:
+                    return t
+            raise KeyError('No tier with resolution %s' % resolution)
+
+        if start is not None:
+            for t in self.tiers:
+                oldest = t.buffer.get_oldest()
+                if oldest is not None and oldest <= start:
+                    return t
+            return self.tiers[-1]
+
+        return self.tiers[0]
+
+
+class MetricHistory(object):
+    # (resolution in seconds, number of points)
+    DEFAULT_TIERS = ((1, 3600), (10, 8640), (60, 10080))
+    DEFAULT_MEMORY_LIMIT = 32 * 1024 * 1024
+
+    def __init__(self, tiers=DEFAULT_TIERS, memory_limit=DEFAULT_MEMORY_LIMIT, directory=None):
+        self.tiers = sorted(tuple(t) for t in tiers)
+        self.memory_limit = memory_limit
+        self.directory = directory
+        self.metrics = {}
+        self._memory_size = 0
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_memory_size(self):
+        return self._memory_size
+
+    def _create_metric(self, name):
+        metric_size = sum(size for _, size in self.tiers) * RingBuffer.ITEM_SIZE
+        if self._memory_size + metric_size > self.memory_limit:
+            return None
+
+        metric = Metric(name, self.tiers, self.directory)
+        self.metrics[name] = metric
+        self._memory_size += metric_size
+        return metric
+
+    def add(self, name, timestamp, value):
+        metric = self.metrics.get(name)
+        if not metric:
+            metric = self._create_metric(name)
+            if not metric:
+                logger.warning('Not keeping history of %s as the history memory limit (%d bytes) is reached',
+                               name, self.memory_limit)
+                # don't log the warning at every sample
+                self.metrics[name] = None
+                return
+        metric.add(timestamp, value)
+
+    def add_sample(self, timestamp, values):
+        for name, value in values.iteritems():
+            self.add(name, timestamp, value)
+
+    def close(self):
+        for metric in self.metrics.itervalues():
+            if metric:
+                for t in metric.tiers:
+                    t.buffer.close()
+
+    def get_names(self):
+        return sorted(name for name, metric in self.metrics.iteritems() if metric)
+
+    def get(self, name, resolution=None, start=None, end=None):
+        metric = self.metrics.get(name)
+        if not metric:
+            raise KeyError('No history of metric "%s"' % name)
+
+        tier = metric.get_tier(resolution, start)
+        return {
+            'name': name,
+            'resolution': tier.resolution,
+            'points': tier.get_range(start, end)
+        }
+
+
+class HostMetrics(object):
+    """
+    Samples the host metrics to keep history of, turning the
+    disk io counters into rates.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.last_disk_counters = None
+        self.last_disk_time = None
+
+    def _get_disk_rates(self, now):
+        counters = self.service.get_disks_counters()
+        rates = {}
+        if self.last_disk_counters and now > self.last_disk_time:
+            time_delta = now - self.last_disk_time
+            for dev, c in counters.iteritems():
+                last = self.last_disk_counters.get(dev)
+                if not last:
+                    continue
+                rates['disk.%s.read_per_sec' % dev] = (c['read_bytes'] - last['read_bytes']) / time_delta
+                rates['disk.%s.write_per_sec' % dev] = (c['write_bytes'] - last['write_bytes']) / time_delta
+
+        self.last_disk_counters = counters
+        self.last_disk_time = now
+        return rates
+
+    def sample(self):
+        """
+        Returns a tuple of (timestamp, dict of metric name => current value).
+        """
+        now = time.time()
+        cpu = self.service.get_cpu()
+        memory = self.service.get_memory()
+        swap = self.service.get_swap_space()
+        load_avg = os.getloadavg()
+
+        values = {
+            'cpu.user': cpu['user'],
+            'cpu.system': cpu['system'],
+            'cpu.idle': cpu['idle'],
+            'cpu.iowait': cpu['iowait'],
+            'memory.percent': memory['percent'],
+            'memory.used': memory['total'] - memory['available'],
+            'swap.percent': swap['percent'],
+            'swap.used': swap['used'],
+            'load.1': load_avg[0],
+            'load.5': load_avg[1],
+            'load.15': load_avg[2]
+        }
+
+        for netif in self.service.get_network_interfaces().itervalues():
+            values['net.%s.recv_per_sec' % netif['name']] = netif['recv_rate']
+            values['net.%s.send_per_sec' % netif['name']] = netif['send_rate']
+
+        values.update(self._get_disk_rates(now))
+        return now, values
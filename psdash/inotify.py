@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+A minimal binding of Linux's inotify through ctypes, made to wait for
+events along with other greenlets.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+from gevent.select import select
+
+logger = logging.getLogger('psdash.inotify')
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+# wd, mask, cookie, length of the name following the struct
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify(object):
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise_errno()
+
+    def _raise_errno(self, filename=None):
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), filename)
+
+    def add_watch(self, path, mask):
+        """
+        Returns the watch descriptor of path. Watching an already watched
+        path replaces the mask and returns the same descriptor.
+        """
+        wd = self._libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        # fails when the watch was already removed along with the path
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def wait(self, timeout=None):
+        """
+        Waits for events to read, returns False if timed out.
+        """
+        readable, _, _ = select([self.fd], [], [], timeout)
+        return bool(readable)
+
+    def read_events(self):
+        """
+        Returns the pending events as a list of (wd, mask, cookie, name) tuples.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    return events
+                raise
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = _EVENT.unpack_from(buf, pos)
+                pos += _EVENT.size
+                name = buf[pos:pos + length].rstrip('\0')
+                pos += length
+                events.append((wd, mask, cookie, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+def create_inotify():
+    """
+    Returns an Inotify instance, or None if inotify is not available.
+    """
+    try:
+        return Inotify()
+    except (OSError, AttributeError) as e:
+        logger.info('inotify is not available (%s)', e)
+        return None
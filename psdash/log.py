@@ -1,7 +1,18 @@
 # coding=utf-8
+import bisect
+import calendar
+import heapq
+import itertools
+from contextlib import contextmanager
 import glob2
+import gevent
+from gevent.lock import Semaphore
 import os
 import logging
+import mmap
+import re
+import time
+import zlib
 
 logger = logging.getLogger('psdash.log')
 
@@ -10,6 +21,13 @@ class LogError(Exception):
     pass
 
 
+def get_file_id(stat):
+    """
+    Identifies the file a stat result is of, a path holds a new file once rotated.
+    """
+    return stat.st_dev, stat.st_ino
+
+
 class ReverseFileSearcher(object):
     DEFAULT_CHUNK_SIZE = 8192
 
@@ -86,31 +104,957 @@ class ReverseFileSearcher(object):
         return tuple(pos for pos in self)
 
 
+def is_gzip(filename):
+    return filename.endswith('.gz')
+
+
+class GzipCheckpoints(object):
+    """
+    Checkpoints of the state of the decompressor of a gzip file, taken every
+    `interval` bytes of uncompressed content, to be able to read from any
+    offset by decompressing from the closest checkpoint rather than from the
+    start of the file. Checkpoints are taken as the file is read, the first
+    read at the end of the file decompresses all of it.
+    """
+    DEFAULT_INTERVAL = 4 * 1024 * 1024
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, filename, interval=DEFAULT_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.reset()
+
+    def reset(self, file_id=None, compressed_size=None):
+        self.file_id = file_id
+        self.compressed_size = compressed_size
+        # (uncompressed offset, compressed offset, decompressor), the
+        # decompressor having consumed the compressed bytes before the offset
+        self.checkpoints = [(0, 0, self._create_decompressor())]
+        self._offsets = [0]
+        # the uncompressed size, known once the file has been read to the end
+        self.size = None
+
+    def __repr__(self):
+        return '<GzipCheckpoints filename=%s, checkpoints=%d>' % (self.filename, len(self.checkpoints))
+
+    def _create_decompressor(self):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def _check_file(self, fp):
+        stat = os.fstat(fp.fileno())
+        if get_file_id(stat) != self.file_id or stat.st_size != self.compressed_size:
+            self.reset(get_file_id(stat), stat.st_size)
+
+    def _decompress(self, decompressor, buf):
+        """
+        Returns a tuple of the decompressed content of buf and the decompressor
+        to continue with, which is a new one after the end of a gzip member.
+        """
+        data = decompressor.decompress(buf)
+        while decompressor.unused_data:
+            rest = decompressor.unused_data
+            if not rest.strip('\0'):
+                # padding after the last member
+                break
+            decompressor = self._create_decompressor()
+            data += decompressor.decompress(rest)
+        return data, decompressor
+
+    def read(self, fp, offset, length):
+        """
+        Returns `length` bytes of uncompressed content from offset, reading
+        the gzip file fp.
+        """
+        self._check_file(fp)
+
+        i = bisect.bisect_right(self._offsets, offset) - 1
+        position, compressed_position, decompressor = self.checkpoints[i]
+        decompressor = decompressor.copy()
+        fp.seek(compressed_position)
+
+        end = offset + length
+        parts = []
+        while position < end:
+            buf = fp.read(self.CHUNK_SIZE)
+            if not buf:
+                self.size = position
+                break
+
+            data, decompressor = self._decompress(decompressor, buf)
+            if position + len(data) > offset:
+                parts.append(data[max(offset - position, 0):end - position])
+            position += len(data)
+            compressed_position += len(buf)
+
+            last = self.checkpoints[-1]
+            if compressed_position > last[1] and position >= last[0] + self.interval:
+                self.checkpoints.append((position, compressed_position, decompressor.copy()))
+                self._offsets.append(position)
+            gevent.sleep(0)
+
+        return ''.join(parts)
+
+    def get_size(self, fp):
+        self._check_file(fp)
+        if self.size is None:
+            # read past the end, from the last checkpoint
+            offset = self.checkpoints[-1][0]
+            while self.size is None:
+                self.read(fp, offset, self.interval)
+                offset += self.interval
+        return self.size
+
+
+class GzipFile(object):
+    """
+    A read-only file object of the uncompressed content of a gzip file,
+    seeking through its GzipCheckpoints.
+    """
+
+    def __init__(self, filename, checkpoints):
+        self.filename = filename
+        self.checkpoints = checkpoints
+        self._fp = open(filename, 'rb')
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def fileno(self):
+        return self._fp.fileno()
+
+    def get_size(self):
+        return self.checkpoints.get_size(self._fp)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.get_size()
+        self._position = max(offset, 0)
+
+    def tell(self):
+        return self._position
+
+    def read(self, size=-1):
+        if size < 0:
+            size = max(self.get_size() - self._position, 0)
+        buf = self.checkpoints.read(self._fp, self._position, size)
+        self._position += len(buf)
+        return buf
+
+    def close(self):
+        self._fp.close()
+
+
+def get_size(fp):
+    """
+    Returns the size of the (uncompressed) content of an open log file.
+    """
+    if isinstance(fp, GzipFile):
+        return fp.get_size()
+    return os.fstat(fp.fileno()).st_size
+
+
+class MappedFile(object):
+    """
+    A read-only memory mapping of a file, shared by the readers of the file.
+    The mapping is renewed whenever the size of the file has changed, so every
+    access first checks the size of the file. Once the file is rotated the new
+    file at the path is mapped, incrementing `generation`.
+
+    A file truncated between the check and the access (e.g. rotated with
+    copytruncate) gets the process killed by a SIGBUS when touching the
+    pages past its new end, which is no exception to be caught. The window
+    is kept as small as possible, but that's why mapping logs is opt-in
+    (PSDASH_LOGS_MMAP).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.generation = 0
+        self._mm = None
+        self._open()
+        self.remap()
+
+    def _open(self):
+        self._fp = open(self.filename, 'rb')
+        self.file_id = get_file_id(os.fstat(self._fp.fileno()))
+        self.size = 0
+
+    def _close_mapping(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+
+    def _is_rotated(self):
+        try:
+            return get_file_id(os.stat(self.filename)) != self.file_id
+        except OSError:
+            # rotated, the new file is yet to be created
+            return False
+
+    def __repr__(self):
+        return '<MappedFile filename=%s, size=%d>' % (self.filename, self.size)
+
+    def remap(self):
+        """
+        Maps the file again if its size has changed, or the new file
+        at the path if it has been rotated. Returns the size.
+        """
+        if self._is_rotated():
+            logger.info('%s was rotated, mapping the new file', self.filename)
+            self._close_mapping()
+            self._fp.close()
+            self._open()
+            self.generation += 1
+
+        size = os.fstat(self._fp.fileno()).st_size
+        if size != self.size or (size and not self._mm):
+            self._close_mapping()
+            # empty files can't be mapped
+            self._mm = mmap.mmap(self._fp.fileno(), size, access=mmap.ACCESS_READ) if size else None
+            self.size = size
+        return size
+
+    def view(self, offset, length):
+        """
+        Returns a buffer of the given part of the file, without copying it.
+        """
+        size = self.remap()
+        if not self._mm or offset >= size:
+            return buffer('')
+        return buffer(self._mm, offset, length)
+
+    def read(self, offset, length):
+        return str(self.view(offset, length))
+
+    def close(self):
+        self._close_mapping()
+        self._fp.close()
+
+
+_WORD_RE = re.compile(r'\w{3,}')
+
+
+def get_trigrams(text):
+    """
+    Returns the set of lowercased three character sequences found in the words of text.
+    """
+    trigrams = set()
+    for word in set(_WORD_RE.findall(text.lower())):
+        for i in xrange(len(word) - 2):
+            trigrams.add(word[i:i + 3])
+    return trigrams
+
+
+class LogQuery(object):
+    """
+    Matches the lines containing any (or all) of the given terms. Terms are
+    literal text unless regex is set, in which case ^ and $ match at the
+    start and end of every line.
+    """
+    ANY = 'any'
+    ALL = 'all'
+    MODES = (ANY, ALL)
+
+    def __init__(self, terms, mode=ANY, regex=False, ignore_case=False):
+        terms = [t for t in terms if t]
+        if not terms:
+            raise ValueError('No terms to search for')
+        if mode not in self.MODES:
+            raise ValueError('Invalid search mode "%s", expected one of %s' % (mode, ', '.join(self.MODES)))
+
+        self.terms = terms
+        self.mode = mode
+        self.regex = regex
+        self.ignore_case = ignore_case
+
+        flags = re.M | (re.I if ignore_case else 0)
+        self.patterns = []
+        for t in terms:
+            try:
+                self.patterns.append(re.compile(t if regex else re.escape(t), flags))
+            except re.error as e:
+                raise ValueError('Invalid regular expression "%s" (%s)' % (t, e))
+
+    def to_dict(self):
+        return {
+            'terms': self.terms,
+            'mode': self.mode,
+            'regex': self.regex,
+            'ignore_case': self.ignore_case
+        }
+
+    def find_lines(self, buf):
+        """
+        Returns the start positions of the matching lines of buf.
+        """
+        found = None
+        for pattern in self.patterns:
+            starts = set(buf.rfind('\n', 0, m.start()) + 1 for m in pattern.finditer(buf))
+            if found is None:
+                found = starts
+            elif self.mode == self.ALL:
+                found &= starts
+            else:
+                found |= starts
+        return found
+
+
+class LogIndex(object):
+    """
+    A sparse index of a log file, shared by every reader of the file.
+
+    The file is split into blocks ending at a line break. For each block the
+    offset, the number of its first line and a bitmap of the trigrams in its
+    words are kept. A search only has to read the blocks having the bits of
+    all trigrams of the text searched for (unless it's a regular expression). The index is kept up to date as
+    the file grows by indexing the new bytes only.
+    Given a MappedFile of the log, the blocks are searched in the mapping.
+    Gzip files are read through GzipCheckpoints, shared by the readers of the file.
+    """
+    BLOCK_SIZE = 256 * 1024
+    BITMAP_SIZE = 1 << 14
+    SCAN_CHUNK_SIZE = 64 * 1024
+    CONTEXT_SIZE = 1024
+    # how far back to look for the timestamp of a line without one
+    TIMESTAMP_LOOKBACK = 64 * 1024
+    DEFAULT_LIMIT = 50
+    DEFAULT_MAX_SCAN = 64 * 1024 * 1024
+
+    def __init__(self, filename, block_size=BLOCK_SIZE, mapped=None,
+                 gzip_interval=GzipCheckpoints.DEFAULT_INTERVAL):
+        self.filename = filename
+        self.block_size = block_size
+        self.mapped = mapped
+        self.gzip = GzipCheckpoints(filename, gzip_interval) if is_gzip(filename) else None
+        self._updating = False
+        self.reset()
+
+    def reset(self, file_id=None):
+        self.file_id = file_id
+        self.offsets = []
+        self.line_numbers = []
+        self.bitmaps = []
+        self.indexed_size = 0
+        self.num_lines = 0
+
+    def __repr__(self):
+        return '<LogIndex filename=%s, blocks=%d, indexed=%d>' % (
+            self.filename, len(self.offsets), self.indexed_size
+        )
+
+    def open_file(self):
+        """
+        Opens the log file, returns a file object of its uncompressed content.
+        """
+        if self.gzip:
+            return GzipFile(self.filename, self.gzip)
+        return open(self.filename, 'rb')
+
+    def _get_bitmap(self, text):
+        bitmap = 0
+        for t in get_trigrams(text):
+            bitmap |= 1 << (hash(t) % self.BITMAP_SIZE)
+        return bitmap
+
+    def update(self):
+        """
+        Indexes the complete lines added to the file since the last update.
+        Yields to other greenlets between blocks.
+        """
+        if self._updating:
+            # another greenlet is at it, searches scan whatever is left.
+            return
+
+        self._updating = True
+        try:
+            with self.open_file() as fp:
+                size = get_size(fp)
+                file_id = get_file_id(os.fstat(fp.fileno()))
+                if file_id != self.file_id:
+                    if self.file_id:
+                        logger.info('%s was rotated, rebuilding its index', self.filename)
+                    self.reset(file_id)
+                elif size < self.indexed_size:
+                    logger.info('%s was truncated, rebuilding its index', self.filename)
+                    self.reset(file_id)
+
+                fp.seek(self.indexed_size)
+                while self.indexed_size < size:
+                    buf = fp.read(self.block_size)
+                    end = buf.rfind('\n') + 1
+                    if not end:
+                        if len(buf) < self.block_size:
+                            # an incomplete last line, it is indexed once it's complete.
+                            break
+                        # a line longer than the block, ending the block anyway.
+                        end = len(buf)
+                    self._add_block(buf[:end])
+                    fp.seek(self.indexed_size)
+                    gevent.sleep(0)
+        finally:
+            self._updating = False
+
+    def _add_block(self, buf):
+        self.offsets.append(self.indexed_size)
+        self.line_numbers.append(self.num_lines)
+        self.bitmaps.append(self._get_bitmap(buf))
+        self.indexed_size += len(buf)
+        self.num_lines += buf.count('\n')
+
+    def get_line_number(self, position):
+        """
+        Returns the (zero based) number of the line at position.
+        """
+        i = bisect.bisect_right(self.offsets, position) - 1
+        if i < 0 or position >= self.indexed_size:
+            start, line_number = (self.indexed_size, self.num_lines) if i >= 0 else (0, 0)
+        else:
+            start, line_number = self.offsets[i], self.line_numbers[i]
+
+        with self._open() as (read, _):
+            return line_number + self._count_lines(read, start, position)
+
+    def _count_lines(self, read, start, end):
+        """
+        Returns the number of line breaks between start and end, reading
+        SCAN_CHUNK_SIZE bytes at a time.
+        """
+        count = 0
+        while start < end:
+            buf = read(start, min(self.SCAN_CHUNK_SIZE, end - start))
+            if not buf:
+                break
+            count += buf.count('\n')
+            start += len(buf)
+            gevent.sleep(0)
+        return count
+
+    def _get_block_ranges(self, before, is_candidate=None):
+        """
+        Returns the (start, end) ranges of the indexed blocks starting before
+        the given position, last block first. Only blocks whose bitmap
+        is_candidate() returns True for are included.
+        """
+        ranges = []
+        num_blocks = len(self.offsets)
+        for i in xrange(bisect.bisect_left(self.offsets, before) - 1, -1, -1):
+            if is_candidate is None or is_candidate(self.bitmaps[i]):
+                end = self.offsets[i + 1] if i + 1 < num_blocks else self.indexed_size
+                ranges.append((self.offsets[i], end))
+        return ranges
+
+    def _get_ranges(self, text, before):
+        """
+        Returns the (start, end) ranges of the file that may contain text
+        starting before the given position, last range first.
+        """
+        if '\n' in text:
+            # the text may span blocks, no help from the index.
+            return [(0, before + len(text) - 1)]
+
+        bitmap = self._get_bitmap(text)
+        ranges = []
+        if self.indexed_size < before + len(text) - 1:
+            ranges.append((self.indexed_size, before + len(text) - 1))
+        ranges.extend(self._get_block_ranges(before, lambda b: b & bitmap == bitmap))
+        return ranges
+
+    def _get_query_filter(self, query):
+        """
+        Returns a function telling whether a block bitmap may hold lines
+        matching the query, or None when every block may.
+        """
+        if query.regex:
+            return None
+        bitmaps = [self._get_bitmap(t) for t in query.terms]
+        if query.mode == LogQuery.ALL:
+            bitmap = reduce(lambda a, b: a | b, bitmaps)
+            return lambda b: b & bitmap == bitmap
+        return lambda b: any(b & bm == bm for bm in bitmaps)
+
+    def _rfind_range(self, read, text, start, end, before):
+        """
+        Scans start to end of the file backwards for the last occurrence
+        of text starting before the given position.
+        """
+        chunk_end = end
+        while chunk_end > start:
+            chunk_start = max(chunk_end - self.SCAN_CHUNK_SIZE, start)
+            # overlap the chunks by the length of text, for text split between chunks
+            buf = read(chunk_start, min(chunk_end + len(text) - 1, end) - chunk_start)
+            pos = buf.rfind(text, 0, before - chunk_start + len(text) - 1)
+            if pos > -1:
+                return chunk_start + pos
+            chunk_end = chunk_start
+        return -1
+
+    def _rfind(self, read, size, text, before):
+        before = size if before is None else min(before, size)
+        for start, end in self._get_ranges(text, before):
+            pos = self._rfind_range(read, text, start, min(end, size), before)
+            if pos > -1:
+                return pos
+        return -1
+
+    @contextmanager
+    def _open(self):
+        """
+        Yields a tuple of (read function, file size).
+        """
+        if self.mapped:
+            yield self.mapped.read, self.mapped.remap()
+            return
+
+        with self.open_file() as fp:
+            def read(offset, length):
+                fp.seek(offset)
+                return fp.read(length)
+            yield read, get_size(fp)
+
+    def rfind(self, text, before=None):
+        """
+        Returns the position of the last occurrence of text starting before
+        the given position (the end of the file by default), or -1.
+        """
+        if not text:
+            raise ValueError('Needle is empty')
+
+        self.update()
+
+        # with a mapping, slices of it are searched as mmap.rfind() compares byte by byte.
+        with self._open() as (read, size):
+            return self._rfind(read, size, text, before)
+
+    def _get_context(self, read, start, end, num_lines):
+        """
+        Returns the num_lines lines before start and after end, reading
+        at most CONTEXT_SIZE bytes per line in each direction.
+        """
+        if not num_lines:
+            return [], []
+
+        length = min(num_lines * self.CONTEXT_SIZE, start)
+        # the bytes before start end with a line break
+        lines_before = read(start - length, length).split('\n')[:-1][-num_lines:]
+
+        lines_after = read(end, num_lines * self.CONTEXT_SIZE).split('\n')
+        if not lines_after[-1]:
+            lines_after.pop()
+        return lines_before, lines_after[:num_lines]
+
+    def _read_tail_chunk(self, read, start, end):
+        """
+        Returns a tuple of the offset and content of the last chunk of at
+        most block_size bytes between start and end, starting at a line
+        (unless the line is longer than the chunk).
+        """
+        chunk_start = max(end - self.block_size, start)
+        buf = read(chunk_start, end - chunk_start)
+        if chunk_start > start:
+            cut = buf.find('\n') + 1
+            if 0 < cut < len(buf):
+                # the cut off first line is read with the chunk before
+                return chunk_start + cut, buf[cut:]
+        return chunk_start, buf
+
+    def find_lines(self, query, before=None, limit=DEFAULT_LIMIT, context=0, max_scan=DEFAULT_MAX_SCAN):
+        """
+        Returns the lines matching query starting before the given position
+        (the end of the file by default), last line first. A dict of:
+            matches: a list of at most `limit` dicts of the position, line
+                     number, line and `context` lines before and after it.
+            scanned: the number of bytes scanned.
+            next: the position to continue from to get the next page, None
+                  when the start of the file was reached.
+
+        Scanning stops once max_scan bytes have been scanned, which can
+        make a page end up with less than `limit` matches.
+        """
+        self.update()
+
+        matches = []
+        scanned = 0
+        with self._open() as (read, size):
+            before = size if before is None else min(before, size)
+            # as of now, another greenlet may be indexing the file
+            indexed_size, num_lines = self.indexed_size, self.num_lines
+            is_candidate = self._get_query_filter(query)
+            blocks = [(start, end, self.line_numbers[bisect.bisect_left(self.offsets, start)])
+                      for start, end in self._get_block_ranges(before, is_candidate)]
+
+            def add_matches(start, buf, get_line_number):
+                """
+                Adds the matches of buf, returns False once limit is reached.
+                """
+                for pos in sorted(query.find_lines(buf), reverse=True):
+                    if start + pos >= before:
+                        continue
+                    if len(matches) == limit:
+                        return False
+
+                    line_end = buf.find('\n', pos)
+                    line_end = len(buf) if line_end < 0 else line_end
+                    lines_before, lines_after = self._get_context(read, start + pos, start + line_end + 1, context)
+                    matches.append({
+                        'position': start + pos,
+                        'line_number': get_line_number() + buf.count('\n', 0, pos),
+                        'line': buf[pos:line_end],
+                        'before': lines_before,
+                        'after': lines_after
+                    })
+                return True
+
+            # the lines not indexed yet first, in chunks as that can be most
+            # of the file while it's being indexed. Their line numbers are
+            # only counted once there's a match.
+            end = max(before, indexed_size)
+            # the number of line breaks between the indexed part and end, once known
+            tail_lines = None
+            while end > indexed_size:
+                if scanned >= max_scan:
+                    return {'matches': matches, 'scanned': scanned, 'next': end}
+
+                start, buf = self._read_tail_chunk(read, indexed_size, end)
+                scanned += len(buf)
+                counted = [None if tail_lines is None else tail_lines - buf.count('\n')]
+
+                def get_line_number():
+                    if counted[0] is None:
+                        counted[0] = self._count_lines(read, indexed_size, start)
+                    return num_lines + counted[0]
+
+                if not add_matches(start, buf, get_line_number):
+                    return {'matches': matches, 'scanned': scanned, 'next': matches[-1]['position']}
+                tail_lines = counted[0]
+                end = start
+                gevent.sleep(0)
+
+            for start, end, line_number in blocks:
+                if scanned >= max_scan:
+                    return {'matches': matches, 'scanned': scanned, 'next': end}
+
+                buf = read(start, end - start)
+                scanned += len(buf)
+                if not add_matches(start, buf, lambda: line_number):
+                    return {'matches': matches, 'scanned': scanned, 'next': matches[-1]['position']}
+                gevent.sleep(0)
+
+        return {'matches': matches, 'scanned': scanned, 'next': None}
+
+    def _get_line_offset(self, read, size, line_number):
+        """
+        Returns the offset of the start of the (zero based) line, counting
+        the lines from the closest block starting before it.
+        """
+        if line_number <= 0:
+            return 0
+
+        # the block holding the line break ending the previous line
+        i = bisect.bisect_left(self.line_numbers, line_number) - 1
+        if i < 0:
+            offset, skip = 0, line_number
+        else:
+            offset, skip = self.offsets[i], line_number - self.line_numbers[i]
+
+        while offset < size:
+            buf = read(offset, min(self.SCAN_CHUNK_SIZE, size - offset))
+            if not buf:
+                break
+            num_breaks = buf.count('\n')
+            if num_breaks >= skip:
+                pos = -1
+                for _ in xrange(skip):
+                    pos = buf.index('\n', pos + 1)
+                return offset + pos + 1
+            skip -= num_breaks
+            offset += len(buf)
+        return size
+
+    def _read_lines(self, read, size, offset, count):
+        """
+        Returns the count lines starting at offset and the offset of
+        the end of the last one.
+        """
+        lines = []
+        end = offset
+        pending = ''
+        while len(lines) < count and end < size:
+            buf = read(end, min(self.SCAN_CHUNK_SIZE, size - end))
+            if not buf:
+                break
+            end += len(buf)
+            parts = (pending + buf).split('\n')
+            pending = parts.pop()
+            lines.extend(parts)
+
+        if pending and len(lines) < count:
+            # the incomplete last line
+            lines.append(pending)
+            return lines, end
+
+        lines = lines[:count]
+        return lines, offset + sum(len(l) + 1 for l in lines)
+
+    def read_lines(self, start, count):
+        """
+        Returns count lines from the (zero based) line number start, where
+        a negative start counts from the end of the file. A dict of:
+            start: the line number of the first line.
+            lines: the lines, without line breaks.
+            offset, end: the offsets of the start of the first line and the
+                         end of the last.
+            num_lines: the number of lines of the file.
+            size: the size of the file.
+        """
+        if count < 0:
+            raise ValueError('Invalid number of lines: %d' % count)
+
+        self.update()
+
+        with self._open() as (read, size):
+            # the lines not indexed yet, which can be most of the file while
+            # another greenlet is indexing it, are counted in chunks
+            indexed_size, num_lines = self.indexed_size, self.num_lines
+            num_lines += self._count_lines(read, indexed_size, size)
+            if size > indexed_size and read(size - 1, 1) != '\n':
+                # the incomplete last line
+                num_lines += 1
+
+            if start < 0:
+                start = max(num_lines + start, 0)
+            start = min(start, num_lines)
+
+            offset = self._get_line_offset(read, size, start)
+            lines, end = self._read_lines(read, size, offset, count)
+
+        return {
+            'start': start,
+            'lines': lines,
+            'offset': offset,
+            'end': end,
+            'num_lines': num_lines,
+            'size': size
+        }
+
+    def read_range(self, offset, length):
+        """
+        Returns a dict of the content of the given byte range (clamped to the
+        file), along with the line number of its start and the file size.
+        """
+        if offset < 0 or length < 0:
+            raise ValueError('Invalid range: %d+%d' % (offset, length))
+
+        self.update()
+
+        with self._open() as (read, size):
+            offset = min(offset, size)
+            content = read(offset, min(length, size - offset))
+        return {
+            'offset': offset,
+            'content': content,
+            'line_number': self.get_line_number(offset),
+            'size': size
+        }
+
+    def get_timestamp(self, position):
+        """
+        Returns the timestamp of the line starting at position, which for a
+        line without one (e.g. of a stack trace) is the one of the closest
+        line before it having one, or None if none is found within
+        TIMESTAMP_LOOKBACK bytes.
+        """
+        with self._open() as (read, size):
+            line = read(position, self.CONTEXT_SIZE).split('\n', 1)[0]
+            timestamp = parse_timestamp(line)
+            if timestamp is not None:
+                return timestamp
+
+            start = max(position - self.TIMESTAMP_LOOKBACK, 0)
+            lines = read(start, position - start).split('\n')[:-1]
+            if start > 0:
+                # the first line is cut off
+                lines = lines[1:]
+        for line in reversed(lines):
+            timestamp = parse_timestamp(line)
+            if timestamp is not None:
+                return timestamp
+        return None
+
+    def close(self):
+        if self.mapped:
+            self.mapped.close()
+
+
+class SharedFile(object):
+    """
+    The open file of a log, shared by the readers of the log which each keep
+    their own position. Once the log is rotated the new file at the path is
+    opened, incrementing `generation`. The file of the previous generation is
+    kept open for the readers still reading the rest of it.
+    """
+
+    def __init__(self, filename, index):
+        self.filename = filename
+        self.index = index
+        self.generation = 0
+        self.previous_fp = None
+        # reading a gzip file yields to other greenlets while the shared
+        # file position is in use
+        self._lock = Semaphore()
+        self._open()
+
+    def __repr__(self):
+        return '<SharedFile filename=%s, generation=%d>' % (self.filename, self.generation)
+
+    def _open(self):
+        self.fp = self.index.open_file()
+        self.file_id = get_file_id(os.fstat(self.fp.fileno()))
+
+    def _is_rotated(self):
+        try:
+            return get_file_id(os.stat(self.filename)) != self.file_id
+        except OSError:
+            # rotated, the new file is yet to be created
+            return False
+
+    def check(self):
+        """
+        Opens the new file if the log was rotated.
+        """
+        if self._is_rotated():
+            logger.info('%s was rotated, opening the new file', self.filename)
+            if self.previous_fp:
+                self.previous_fp.close()
+            self.previous_fp = self.fp
+            self.generation += 1
+            self._open()
+
+    def get_size(self):
+        with self._lock:
+            return get_size(self.fp)
+
+    def read(self, generation, offset, length):
+        """
+        Returns length bytes from offset of the file of the given generation.
+        """
+        if generation == self.generation:
+            fp = self.fp
+        elif generation == self.generation - 1 and self.previous_fp:
+            fp = self.previous_fp
+        else:
+            return ''
+        with self._lock:
+            fp.seek(offset)
+            return fp.read(length)
+
+    def close(self):
+        if self.previous_fp:
+            self.previous_fp.close()
+        self.fp.close()
+
+
 class LogReader(object):
+    """
+    Reads a log file on behalf of a session, through a SharedFile of the log.
+    The new file is read once the log is rotated, from the start once it's
+    truncated. With follow_rotated set, the rest of a rotated file is read
+    before moving on to the new file.
+    """
     BUFFER_SIZE = 8192
 
-    def __init__(self, filename, buffer_size=BUFFER_SIZE):
+    def __init__(self, filename, buffer_size=BUFFER_SIZE, index=None, follow_rotated=True, shared=None):
         self.filename = filename
-        self.fp = open(filename, 'r')
         self.buffer_size = buffer_size
-        self._searchers = {}
+        self.follow_rotated = follow_rotated
+        self.index = index or LogIndex(filename)
+        self.shared = shared or SharedFile(filename, self.index)
+        self._owns_shared = shared is None
+        self.position = 0
+        self._generation = self.shared.generation
+        # text => position of the last match found
+        self._search_positions = {}
 
     def __repr__(self):
         return '<LogReader filename=%s, file-pos=%d>' % (
-            self.filename, self.fp.tell()
+            self.filename, self.position
         )
 
+    def _check_file(self):
+        """
+        Moves on to the new file if the log was rotated, rewinds if it was truncated.
+        """
+        self.shared.check()
+        if self._generation != self.shared.generation:
+            self._generation = self.shared.generation
+            self.position = 0
+            self._search_positions = {}
+        elif self.shared.get_size() < self.position:
+            logger.info('%s was truncated, reading it from the start', self.filename)
+            self.position = 0
+
     def set_tail_position(self):
-        stat = os.fstat(self.fp.fileno())
-        if stat.st_size >= self.buffer_size:
-            self.fp.seek(-self.buffer_size, os.SEEK_END)
-        else:
-            self.fp.seek(0)
+        self._check_file()
+        self.position = max(self.shared.get_size() - self.buffer_size, 0)
+
+    def set_end_position(self):
+        self._check_file()
+        self.position = self.shared.get_size()
+
+    def seek(self, offset):
+        self.position = offset
+
+    def at_end(self):
+        """
+        Returns whether the log has been read to its end (as of the last read).
+        """
+        return self._generation == self.shared.generation and self.position >= self.shared.get_size()
 
     def read(self):
-        buf = self.fp.read(self.buffer_size)
+        if self.follow_rotated:
+            self.shared.check()
+            if self._generation != self.shared.generation:
+                buf = self.shared.read(self._generation, self.position, self.buffer_size)
+                if buf:
+                    self.position += len(buf)
+                    return buf
+        self._check_file()
+        buf = self.shared.read(self._generation, self.position, self.buffer_size)
+        self.position += len(buf)
         return buf
 
+    def follow(self, position=None, max_bytes=64 * 1024):
+        """
+        Returns a tuple of the position to follow the log from next and the
+        content appended from position, at most max_bytes of it. With no
+        position, the log is followed from its end.
+        """
+        if position is None:
+            self.set_end_position()
+        else:
+            self.seek(position)
+
+        chunks = []
+        num_read = 0
+        while num_read < max_bytes:
+            buf = self.read()
+            if not buf:
+                break
+            chunks.append(buf)
+            num_read += len(buf)
+
+        content = ''.join(chunks)
+        if num_read > max_bytes:
+            # the rest is read next time
+            self.seek(self.position - (num_read - max_bytes))
+            content = content[:max_bytes]
+        return self.position, content
+
     def search(self, text):
         """
         Find text in log file from current position
@@ -120,33 +1064,336 @@ class LogReader(object):
             position in result buffer,
             result buffer (the actual file contents)
         """
-        key = hash(text)
-        searcher = self._searchers.get(key)
-        if not searcher:
-            searcher = ReverseFileSearcher(self.filename, text)
-            self._searchers[key] = searcher
-
-        position = searcher.find()
+        # positions are of the file at the path
+        self._check_file()
+        position = self.index.rfind(text, self._search_positions.get(text))
         if position < 0:
-            # reset the searcher to start from the tail again.
-            searcher.reset()
+            # start from the tail again at the next search.
+            self._search_positions.pop(text, None)
             return -1, -1, ''
+        self._search_positions[text] = position
 
         # try to get some content from before and after the result's position
         read_before = self.buffer_size / 2
         offset = max(position - read_before, 0)
         bufferpos = position if offset == 0 else read_before
-        self.fp.seek(offset)
+        self.seek(offset)
         return position, bufferpos, self.read()
 
+    def find_lines(self, query, before=None, limit=LogIndex.DEFAULT_LIMIT, context=0,
+                   max_scan=LogIndex.DEFAULT_MAX_SCAN):
+        return self.index.find_lines(query, before, limit, context, max_scan)
+
+    def read_lines(self, start, count):
+        return self.index.read_lines(start, count)
+
+    def read_range(self, offset, length):
+        return self.index.read_range(offset, length)
+
+    def get_timestamp(self, position):
+        return self.index.get_timestamp(position)
+
     def close(self):
-        self.fp.close()
+        # a shared file is closed by Logs
+        if self._owns_shared:
+            self.shared.close()
+
+
+class MmapLogReader(LogReader):
+    """
+    A LogReader reading from a memory mapping of the log rather than
+    through a file object, sharing the mapping of its index. As the mapping
+    moves on to the new file once rotated, the rest of a rotated file is
+    never read (follow_rotated is not supported).
+    """
+
+    def __init__(self, filename, buffer_size=LogReader.BUFFER_SIZE, index=None, follow_rotated=False, shared=None):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.follow_rotated = False
+        self.index = index or LogIndex(filename, mapped=MappedFile(filename))
+        if not self.index.mapped:
+            raise ValueError('The index of %s is not memory-mapped' % filename)
+        self.mapped = self.index.mapped
+        self.position = 0
+        self._generation = self.mapped.generation
+        self._owns_index = index is None
+        self._search_positions = {}
+
+    def __repr__(self):
+        return '<MmapLogReader filename=%s, file-pos=%d>' % (
+            self.filename, self.position
+        )
+
+    def _check_file(self):
+        size = self.mapped.remap()
+        if self.mapped.generation != self._generation:
+            self._generation = self.mapped.generation
+            self.position = 0
+            self._search_positions = {}
+        elif size < self.position:
+            logger.info('%s was truncated, reading it from the start', self.filename)
+            self.position = 0
+
+    def set_tail_position(self):
+        self._check_file()
+        self.position = max(self.mapped.size - self.buffer_size, 0)
+
+    def set_end_position(self):
+        self._check_file()
+        self.position = self.mapped.size
+
+    def at_end(self):
+        return self.position >= self.mapped.size
+
+    def read(self):
+        self._check_file()
+        buf = self.mapped.read(self.position, self.buffer_size)
+        self.position += len(buf)
+        return buf
+
+    def close(self):
+        # a shared mapping is closed along with its index by Logs
+        if self._owns_index:
+            self.index.close()
+
+
+_MONTHS = dict((m, i + 1) for i, m in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+))
+# 2016-01-02 03:04:05,678+01:00 (ISO 8601 and alike)
+_ISO_TIMESTAMP_RE = re.compile(
+    r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d+))?(?: ?(Z|[+-]\d\d:?\d\d))?'
+)
+# 02/Jan/2016:03:04:05 +0100 (nginx and apache access logs)
+_CLF_TIMESTAMP_RE = re.compile(r'(\d\d)/([A-Z][a-z]{2})/(\d{4}):(\d\d):(\d\d):(\d\d)(?: ([+-]\d{4}))?')
+# Jan  2 03:04:05 (syslog)
+_SYSLOG_TIMESTAMP_RE = re.compile(r'([A-Z][a-z]{2}) {1,2}(\d{1,2}) (\d\d):(\d\d):(\d\d)')
+# timestamps are looked for at the start of lines only
+_TIMESTAMP_MAX_OFFSET = 64
+
+
+def _to_epoch(year, month, day, hour, minute, second, utc_offset=None):
+    t = (year, month, day, hour, minute, second, 0, 0, -1)
+    if utc_offset is None:
+        return time.mktime(t)
+    return float(calendar.timegm(t) - utc_offset)
+
+
+def _parse_utc_offset(offset):
+    if not offset:
+        return None
+    if offset == 'Z':
+        return 0
+    offset = offset.replace(':', '')
+    seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+    return -seconds if offset[0] == '-' else seconds
+
+
+def parse_timestamp(line):
+    """
+    Returns the timestamp at the start of a log line as seconds since the
+    epoch, or None. Timestamps without a utc offset are taken as local time,
+    syslog timestamps (without a year) as of the last 12 months.
+    """
+    m = _ISO_TIMESTAMP_RE.search(line, 0, _TIMESTAMP_MAX_OFFSET)
+    if m:
+        year, month, day, hour, minute, second = map(int, m.groups()[:6])
+        fraction = float('0.' + m.group(7)) if m.group(7) else 0.0
+        return _to_epoch(year, month, day, hour, minute, second, _parse_utc_offset(m.group(8))) + fraction
+
+    m = _CLF_TIMESTAMP_RE.search(line, 0, _TIMESTAMP_MAX_OFFSET)
+    if m and m.group(2) in _MONTHS:
+        day, month, year = int(m.group(1)), _MONTHS[m.group(2)], int(m.group(3))
+        hour, minute, second = map(int, m.groups()[3:6])
+        return _to_epoch(year, month, day, hour, minute, second, _parse_utc_offset(m.group(7)))
+
+    m = _SYSLOG_TIMESTAMP_RE.search(line, 0, _TIMESTAMP_MAX_OFFSET)
+    if m and m.group(1) in _MONTHS:
+        month, day = _MONTHS[m.group(1)], int(m.group(2))
+        hour, minute, second = map(int, m.groups()[2:5])
+        now = time.time()
+        year = time.localtime(now).tm_year
+        ts = _to_epoch(year, month, day, hour, minute, second)
+        if ts > now + 86400:
+            ts = _to_epoch(year - 1, month, day, hour, minute, second)
+        return ts
+
+    return None
+
+
+class MergedLog(object):
+    """
+    Several logs read as one, their lines merged by the timestamps they start
+    with. Lines without a timestamp (e.g. stack traces) stay after the line
+    before them. Only complete lines are read, the readers are left at the
+    start of an incomplete last line.
+
+    As the logs are read a buffer at a time, a log not read to its end yet
+    can have lines older than the ones read from the others. Those are held
+    back (the readers are left at their start) until the lagging logs have
+    been read past them.
+    """
+
+    def __init__(self, readers):
+        self.readers = readers
+
+    def _read_lines(self, reader, seek_tail):
+        """
+        Returns a tuple of the offset of the first line read, the lines and
+        whether the log has more to read.
+        """
+        if seek_tail:
+            reader.set_tail_position()
+        start = reader.position
+        buf = reader.read()
+        lagging = not reader.at_end()
+
+        if seek_tail and start > 0:
+            # skip the part of a line before the tail position
+            skip = buf.find('\n') + 1
+            buf = buf[skip:]
+            start += skip
+
+        end = buf.rfind('\n') + 1
+        # a line longer than the buffer is read in pieces though
+        if end < len(buf) and (end or len(buf) < reader.buffer_size):
+            # read the incomplete last line once it's complete
+            reader.seek(reader.position - (len(buf) - end))
+            buf = buf[:end]
+
+        lines = buf.split('\n')
+        if not lines[-1]:
+            lines.pop()
+        return start, lines, lagging
+
+    def _get_timestamps(self, reader, start, lines):
+        """
+        Returns the timestamp of each line, inherited from the lines before
+        it for a line without one. Leading lines with nothing to inherit from
+        take the first timestamp after them, or the current time.
+        """
+        timestamp = None
+        if lines and parse_timestamp(lines[0]) is None:
+            # from the lines read before
+            timestamp = reader.get_timestamp(start)
+
+        timestamps = []
+        for line in lines:
+            timestamp = parse_timestamp(line) or timestamp
+            timestamps.append(timestamp)
+
+        first = next((ts for ts in timestamps if ts is not None), None)
+        if first is None:
+            first = time.time()
+        return [first if ts is None else ts for ts in timestamps]
+
+    def read(self, seek_tail=False):
+        """
+        Returns the next lines of the logs (from their tails with seek_tail)
+        as a list of (timestamp, filename, line) tuples, oldest first.
+        """
+        batches = []
+        for r in self.readers:
+            start, lines, lagging = self._read_lines(r, seek_tail)
+            batches.append((start, lines, self._get_timestamps(r, start, lines), lagging))
+
+        # the lines of the other logs newer than the last line read from a
+        # lagging log wait for it to catch up
+        lagging = [(timestamps[-1], i) for i, (_, _, timestamps, lagging) in enumerate(batches)
+                   if lagging and timestamps]
+        watermark, slowest = min(lagging) if lagging else (None, None)
+
+        merged = []
+        for i, (r, (start, lines, timestamps, _)) in enumerate(zip(self.readers, batches)):
+            num_lines = len(lines)
+            if watermark is not None and i != slowest:
+                num_lines = next((j for j, ts in enumerate(timestamps) if ts > watermark), num_lines)
+                if num_lines < len(lines):
+                    r.seek(start + sum(len(l) + 1 for l in lines[:num_lines]))
+            merged.append(itertools.izip(timestamps[:num_lines], itertools.repeat(i), lines[:num_lines]))
+
+        return [(ts, self.readers[i].filename, line) for ts, i, line in heapq.merge(*merged)]
+
+    def find_lines(self, query, cursors=None, limit=LogIndex.DEFAULT_LIMIT, context=0,
+                   max_scan=LogIndex.DEFAULT_MAX_SCAN):
+        """
+        Returns the lines of the logs matching query, latest first, like
+        LogIndex.find_lines() does for a single log. Each match also has the
+        `filename` and `timestamp` of its line. The position to continue from
+        is given per log, `cursors` and `next` being lists of a position per
+        reader, where -1 is for a log that has no more matches. At most
+        max_scan bytes are scanned across all of the logs.
+        """
+        cursors = cursors or [None] * len(self.readers)
+        pages = []
+        scanned = 0
+        for i, (r, before) in enumerate(zip(self.readers, cursors)):
+            if before == -1:
+                pages.append({'matches': [], 'next': None})
+                continue
+            page = r.find_lines(query, before, limit, context, max(max_scan - scanned, 0))
+            scanned += page['scanned']
+            for m in page['matches']:
+                m['filename'] = r.filename
+                # as ordered when read, by the timestamp inherited from the lines before
+                m['timestamp'] = parse_timestamp(m['line']) or r.get_timestamp(m['position'])
+            pages.append(page)
+
+        def latest_first(i, matches):
+            for m in matches:
+                yield -(m['timestamp'] or 0.0), i, -m['position'], m
+
+        merged = heapq.merge(*[latest_first(i, page['matches']) for i, page in enumerate(pages)])
+        taken = [(i, m) for _, i, _, m in itertools.islice(merged, limit)]
+
+        next_cursors = []
+        for i, page in enumerate(pages):
+            num_taken = sum(1 for j, _ in taken if j == i)
+            if num_taken < len(page['matches']):
+                # continue with the first match not taken
+                next_cursors.append(page['matches'][num_taken]['position'] + 1)
+            else:
+                next_cursors.append(-1 if page['next'] is None else page['next'])
+
+        return {'matches': [m for _, m in taken], 'scanned': scanned, 'next': next_cursors}
 
 
 class Logs(object):
-    def __init__(self):
+    """
+    The available log files and the readers of them, a reader per log and
+    session. Readers share an index and an open file per log, so the number
+    of open files doesn't grow with the number of sessions. At most
+    max_readers readers are kept, evicting the least recently used one, and
+    readers not used for idle_timeout seconds are evicted by evict_idle().
+    """
+    DEFAULT_MAX_READERS = 1000
+    DEFAULT_IDLE_TIMEOUT = 3600
+
+    def __init__(self, use_mmap=False, max_scan=LogIndex.DEFAULT_MAX_SCAN, follow_rotated=True,
+                 gzip_interval=GzipCheckpoints.DEFAULT_INTERVAL, max_readers=DEFAULT_MAX_READERS,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        self.use_mmap = use_mmap
+        self.follow_rotated = follow_rotated
+        # the number of uncompressed bytes between checkpoints of gzip files
+        self.gzip_interval = gzip_interval
+        # the maximum number of bytes scanned by a call to find_lines()
+        self.max_scan = max_scan
+        self.max_readers = max_readers
+        self.idle_timeout = idle_timeout
         self.available = set()
+        # (filename, key) => reader
         self.readers = {}
+        # (filename, key) => (last time used, use count), the use count
+        # telling apart readers last used at the same time
+        self._last_used = {}
+        self._uses = itertools.count()
+        # filename => LogIndex shared by the readers of the file
+        self.indexes = {}
+        # filename => SharedFile
+        self.files = {}
+        self.num_evicted = 0
+        self.num_evicted_idle = 0
 
     def add_available(self, filename):
         # quick verification that it exists and can be read
@@ -163,6 +1410,12 @@ class Logs(object):
 
     def remove_available(self, filename):
         self.remove(filename)
+        shared = self.files.pop(filename, None)
+        if shared:
+            shared.close()
+        index = self.indexes.pop(filename, None)
+        if index:
+            index.close()
         self.available.remove(filename)
 
     def get_available(self):
@@ -183,6 +1436,12 @@ class Logs(object):
 
     def clear_available(self):
         self.clear()
+        for shared in self.files.itervalues():
+            shared.close()
+        self.files = {}
+        for index in self.indexes.itervalues():
+            index.close()
+        self.indexes = {}
         self.available = set()
 
     def add_patterns(self, patterns):
@@ -203,25 +1462,84 @@ class Logs(object):
         for r in self.readers.itervalues():
             r.close()
         self.readers = {}
+        self._last_used = {}
+
+    def _touch(self, reader_key):
+        self._last_used[reader_key] = (time.time(), next(self._uses))
+
+    def _remove_reader(self, reader_key):
+        self.readers.pop(reader_key).close()
+        del self._last_used[reader_key]
 
     def remove(self, filename):
-        for reader_key, r in self.readers.items():
+        for reader_key in self.readers.keys():
             if reader_key[0] == filename:
-                r.close()
-                del self.readers[reader_key]
+                self._remove_reader(reader_key)
+
+    def evict_idle(self):
+        """
+        Evicts the readers not used for idle_timeout seconds, returns the number evicted.
+        """
+        expired = time.time() - self.idle_timeout
+        idle = [k for k, (last_used, _) in self._last_used.iteritems() if last_used < expired]
+        for reader_key in idle:
+            self._remove_reader(reader_key)
+        self.num_evicted_idle += len(idle)
+        return len(idle)
 
     def create(self, filename, key=None):
         if filename not in self.available:
             raise KeyError('No log with filename "%s" is available' % filename)
 
+        while self.readers and len(self.readers) >= self.max_readers:
+            lru_key = min(self._last_used, key=self._last_used.get)
+            logger.debug('Evicting the reader of %s for session %s', *lru_key)
+            self._remove_reader(lru_key)
+            self.num_evicted += 1
+
         reader_key = (filename, key)
-        r = LogReader(filename)
+        index = self.get_index(filename)
+        # gzip files can't be read through a mapping
+        if index.mapped:
+            r = MmapLogReader(filename, index=index)
+        else:
+            r = LogReader(filename, index=index, follow_rotated=self.follow_rotated,
+                          shared=self.get_shared_file(filename))
         self.readers[reader_key] = r
+        self._touch(reader_key)
         return r
 
+    def get_index(self, filename):
+        index = self.indexes.get(filename)
+        if not index:
+            mapped = MappedFile(filename) if self.use_mmap and not is_gzip(filename) else None
+            index = LogIndex(filename, mapped=mapped, gzip_interval=self.gzip_interval)
+            self.indexes[filename] = index
+        return index
+
+    def get_shared_file(self, filename):
+        shared = self.files.get(filename)
+        if not shared:
+            shared = SharedFile(filename, self.get_index(filename))
+            self.files[filename] = shared
+        return shared
+
     def get(self, filename, key=None):
         reader_key = (filename, key)
-        if reader_key not in self.readers:
+        r = self.readers.get(reader_key)
+        if not r:
             return self.create(filename, key)
-        else:
-            return self.readers.get(reader_key)
+        self._touch(reader_key)
+        return r
+
+    def get_stats(self):
+        return {
+            'available': len(self.available),
+            'readers': len(self.readers),
+            'max_readers': self.max_readers,
+            'sessions': len(set(key for _, key in self.readers)),
+            'open_files': len(self.files) + sum(1 for f in self.files.itervalues() if f.previous_fp),
+            'mapped_files': sum(1 for i in self.indexes.itervalues() if i.mapped),
+            'evicted': self.num_evicted,
+            'evicted_idle': self.num_evicted_idle
+        }
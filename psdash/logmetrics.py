@@ -0,0 +1,182 @@
+# coding=utf-8
+"""
+Counts the lines of logs matching configured patterns as the logs grow, per
+minute, so that e.g. the rate of errors of a log can be followed over time.
+Each log is read once for all of its patterns, from where it was when
+counting started.
+"""
+import logging
+import time
+import gevent
+from psdash.discovery import LogPattern
+from psdash.history import RingBuffer
+from psdash.log import LogQuery
+
+logger = logging.getLogger('psdash.logmetrics')
+
+
+class LogCounter(object):
+    """
+    Counts the lines of a log matching each of a set of LogQuery, keeping
+    the counts of the last `size` minutes. Lines are counted in the minute
+    they were read in.
+    """
+    RESOLUTION = 60
+    # an incomplete line growing beyond this is not a line worth waiting for
+    MAX_LINE_SIZE = 1024 * 1024
+
+    def __init__(self, filename, queries, size):
+        self.filename = filename
+        self.queries = queries
+        self.buffers = dict((name, RingBuffer(size)) for name in queries)
+        self.totals = dict((name, 0) for name in queries)
+        self.position = None
+        self._pending = ''
+        # set while skipping the rest of a line too long to wait for
+        self._discarding = False
+        self._bucket = None
+        self._counts = dict((name, 0) for name in queries)
+
+    def __repr__(self):
+        return '<LogCounter filename=%s, metrics=%s>' % (self.filename, ', '.join(sorted(self.queries)))
+
+    def add(self, timestamp, content):
+        """
+        Counts the matching lines of content, read at timestamp. An incomplete
+        last line is counted once the rest of it is added, unless it grows
+        beyond MAX_LINE_SIZE, in which case it is not counted at all.
+        """
+        bucket = int(timestamp // self.RESOLUTION)
+        if bucket != self._bucket:
+            self.flush()
+            self._bucket = bucket
+
+        if self._discarding:
+            newline = content.find('\n')
+            if newline == -1:
+                return
+            content = content[newline + 1:]
+            self._discarding = False
+
+        buf = self._pending + content
+        end = buf.rfind('\n') + 1
+        self._pending = buf[end:]
+        if len(self._pending) > self.MAX_LINE_SIZE:
+            self._pending = ''
+            self._discarding = True
+        if not end:
+            return
+
+        lines = buf[:end]
+        for name, query in self.queries.iteritems():
+            count = len(query.find_lines(lines))
+            self._counts[name] += count
+            self.totals[name] += count
+
+    def flush(self):
+        if self._bucket is not None:
+            for name, count in self._counts.iteritems():
+                self.buffers[name].append(self._bucket * self.RESOLUTION, count)
+        self._counts = dict((name, 0) for name in self.queries)
+
+    def get_counts(self, name, minutes, now):
+        """
+        Returns the counts of the last number of minutes up to now,
+        oldest first, 0 for the minutes nothing was read in.
+        """
+        last = int(now // self.RESOLUTION)
+        first = last - minutes + 1
+        counts = dict(self.buffers[name].get_range(first * self.RESOLUTION, last * self.RESOLUTION))
+        if self._bucket is not None and first <= self._bucket <= last:
+            counts[self._bucket * self.RESOLUTION] = self._counts[name]
+        return [int(counts.get((first + i) * self.RESOLUTION, 0)) for i in xrange(minutes)]
+
+
+class LogMetrics(object):
+    """
+    The LogCounters of the available logs matching the configured log
+    patterns. `patterns` is a dict of log pattern => dict of metric name =>
+    regular expression, e.g. {'/var/log/*.log': {'errors': 'ERROR'}}.
+    """
+    DEFAULT_HISTORY = 24 * 60
+    DEFAULT_MAX_READ = 16 * 1024 * 1024
+    READ_SIZE = 1024 * 1024
+    READER_KEY = 'metrics'
+
+    def __init__(self, logs, patterns, history=DEFAULT_HISTORY, max_read=DEFAULT_MAX_READ):
+        self.logs = logs
+        self.history = history
+        self.max_read = max_read
+        self.patterns = []
+        for pattern, metrics in patterns.iteritems():
+            queries = dict((name, LogQuery([regex], regex=True)) for name, regex in metrics.iteritems())
+            self.patterns.append((LogPattern(pattern), queries))
+        # filename => LogCounter, None for a log no pattern matches
+        self.counters = {}
+
+    def _create_counter(self, filename):
+        queries = {}
+        path = filename.encode('utf-8')
+        for pattern, pattern_queries in self.patterns:
+            if pattern.matches(path):
+                queries.update(pattern_queries)
+        return LogCounter(filename, queries, self.history) if queries else None
+
+    def _update_counter(self, counter, now):
+        log = self.logs.get(counter.filename, key=self.READER_KEY)
+        if counter.position is None:
+            counter.position, _ = log.follow(None, 0)
+
+        num_read = 0
+        while True:
+            counter.position, content = log.follow(counter.position, min(self.READ_SIZE, self.max_read - num_read))
+            counter.add(now, content)
+            num_read += len(content)
+            if len(content) < self.READ_SIZE or num_read >= self.max_read:
+                # the rest, if any, is read at the next update
+                return
+            gevent.sleep(0)
+
+    def update(self, now=None):
+        """
+        Counts the lines added to the logs since the last update.
+        """
+        if not self.patterns:
+            return
+
+        now = now or time.time()
+        for filename in list(self.logs.available):
+            if filename not in self.counters:
+                self.counters[filename] = self._create_counter(filename)
+            counter = self.counters[filename]
+            if not counter:
+                continue
+            try:
+                self._update_counter(counter, now)
+            except (IOError, OSError) as e:
+                logger.warning('Could not count the lines of %s (%s)', filename, e)
+
+        for filename in self.counters.keys():
+            if filename not in self.logs.available:
+                del self.counters[filename]
+
+    def get(self, filenames=None, minutes=60, now=None):
+        """
+        Returns a list of the counts of each log, per minute of the last
+        number of minutes, along with the total counts since counting started.
+        """
+        now = now or time.time()
+        filenames = self.counters.keys() if filenames is None else filenames
+        metrics = []
+        for filename in sorted(filenames):
+            counter = self.counters.get(filename)
+            if not counter:
+                continue
+            metrics.append({
+                'filename': filename,
+                'resolution': counter.RESOLUTION,
+                'end': int(now // counter.RESOLUTION) * counter.RESOLUTION,
+                'counts': dict((name, counter.get_counts(name, minutes, now)) for name in counter.queries),
+                'totals': dict(counter.totals)
+            })
+        return metrics
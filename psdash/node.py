@@ -1,4 +1,5 @@
 # coding=UTF-8
+import gevent
 import logging
 import os
 import platform
@@ -6,14 +7,67 @@ import psutil
 import socket
 import time
 import zerorpc
-from psdash.log import Logs
+import zmq
+from psdash.log import Logs, LogQuery, MergedLog
+from psdash.history import MetricHistory, HostMetrics
+from psdash.logmetrics import LogMetrics
 from psdash.helpers import socket_families, socket_types
 from psdash.net import get_interface_addresses, NetIOCounters
+from psdash.cache import make_key
+from psdash.wire import PLAIN, COLUMNS, WIRE_FORMATS, encode_result, decode_result
+from psdash.process import (ProcessTable, ProcessSnapshot, PROCESS_DETAIL_FIELDS, read_fields, get_memory_percent,
+                            query_processes)
 
 
 logger = logging.getLogger("psdash.node")
 
 
+# The calls made by an agent in push mode at every push. The web node
+# serves these calls for the agent from the latest push.
+PUSH_CALLS = (
+    ('get_sysinfo', ()),
+    ('get_memory', ()),
+    ('get_swap_space', ()),
+    ('get_cpu', ()),
+    ('get_cpu_cores', ()),
+    ('get_disks', ()),
+    ('get_disks', (True,)),
+    ('get_disks_counters', ()),
+    ('get_users', ()),
+    ('get_network_interfaces', ()),
+    ('get_process_list', ()),
+    ('get_connections', ()),
+    ('get_logs', ()),
+    ('get_log_metrics', (None, 60))
+)
+
+
+def filter_connections(connections, filters=None):
+    filters = filters or {}
+    filtered = []
+    for conn in connections:
+        for k, v in filters.iteritems():
+            if v and conn.get(k) != v:
+                break
+        else:
+            filtered.append(conn)
+    return filtered
+
+
+class NodeUnavailable(Exception):
+    pass
+
+
+def is_unknown_method(e):
+    """
+    Returns whether e is the error of an agent called for a method it
+    doesn't have (an agent of an older version), on its own or in a batch.
+    """
+    if not isinstance(e, zerorpc.RemoteError):
+        return False
+    return e.name == 'NameError' or (e.name == 'ValueError' and e.msg.startswith('Invalid method in batch'))
+
+
 class Node(object):
     def __init__(self):
         self._service = None
@@ -21,6 +75,12 @@ class Node(object):
     def get_id(self):
         raise NotImplementedError
 
+    def is_healthy(self):
+        return True
+
+    def close(self):
+        pass
+
     def _create_service(self):
         raise NotImplementedError
 
@@ -30,34 +90,281 @@ class Node(object):
         return self._service
 
 
+class CircuitBreaker(object):
+    """
+    Opens after `failure_threshold` consecutive failures, failing calls
+    right away for `reset_timeout` seconds. After that a single call is let
+    through, closing the breaker if it succeeds and opening it again if not.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_pending = False
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        if not self.is_open():
+            return True
+        if not self._trial_pending and time.time() - self.opened_at >= self.reset_timeout:
+            self._trial_pending = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_pending = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_pending = False
+        if self.is_open() or self.failures >= self.failure_threshold:
+            self.opened_at = time.time()
+
+    def record_cancelled(self):
+        """
+        Records a call given up on by the caller, which says nothing about
+        the node. A trial call is let through again.
+        """
+        self._trial_pending = False
+
+
+class RemoteService(object):
+    """
+    Calls the LocalService of a remote node through a zerorpc client,
+    raising NodeUnavailable when the node does not respond in time or when
+    it has been failing to do so lately.
+    """
+    # exceptions raised on the remote node itself (e.g. NoSuchProcess)
+    # come as zerorpc.RemoteError and are not counted as node failures.
+    RPC_ERRORS = (zerorpc.TimeoutExpired, zerorpc.LostRemote)
+
+    # methods returning lists of dicts large enough to be worth encoding
+    BULK_METHODS = frozenset([
+        'get_process_list',
+        'query_process_list',
+        'get_connections',
+        'get_process_connections',
+        'get_process_memory_maps',
+        'get_process_open_files'
+    ])
+
+    def __init__(self, node, client, wire_format=PLAIN):
+        self.node = node
+        self.client = client
+        self.preferred_wire_format = wire_format
+        self.wire_format = None
+        # False once the node turns out to be an agent from before batch calls
+        self.batch_supported = True
+
+    def _negotiate_wire_format(self):
+        if self.preferred_wire_format == PLAIN:
+            return PLAIN
+        try:
+            formats = self._call('get_wire_formats')
+        except zerorpc.RemoteError:
+            # an agent from before there were wire formats
+            formats = [PLAIN]
+        wire_format = self.preferred_wire_format if self.preferred_wire_format in formats else PLAIN
+        logger.info('Using wire format %s for node %s', wire_format, self.node.get_id())
+        return wire_format
+
+    def get_wire_format(self):
+        if self.wire_format is None:
+            self.wire_format = self._negotiate_wire_format()
+        return self.wire_format
+
+    def batch(self, calls):
+        if self.batch_supported:
+            try:
+                return self._batch(calls)
+            except zerorpc.RemoteError as e:
+                if e.name != 'NameError':
+                    raise
+                logger.info('Node %s does not support batch calls, making the calls one by one',
+                            self.node.get_id())
+                self.batch_supported = False
+        return [self._call(name, *args) for name, args in calls]
+
+    def _batch(self, calls):
+        wire_format = self.get_wire_format()
+        if wire_format == PLAIN:
+            return self._call('batch', calls)
+        return [decode_result(r) for r in self._call('batch', calls, wire_format)]
+
+    def _call(self, method, *args):
+        breaker = self.node.circuit_breaker
+        if not breaker.allow():
+            raise NodeUnavailable('Node %s is unavailable, not retrying for %d seconds' % (
+                self.node.get_id(), breaker.reset_timeout)
+            )
+
+        # every outcome is recorded, or a trial call would keep the breaker
+        # from ever letting another call through
+        outcome = breaker.record_failure
+        try:
+            result = self.client(method, *args)
+            outcome = breaker.record_success
+        except zerorpc.RemoteError:
+            outcome = breaker.record_success
+            raise
+        except gevent.Timeout:
+            # the caller's own timeout (zerorpc raises TimeoutExpired for its own)
+            outcome = breaker.record_cancelled
+            raise
+        except self.RPC_ERRORS as e:
+            logger.warning('Calling %s on node %s failed: %s', method, self.node.get_id(), e)
+            raise NodeUnavailable('Node %s did not respond: %s' % (self.node.get_id(), e))
+        finally:
+            outcome()
+        return result
+
+    def _call_method(self, name, *args):
+        if name in self.BULK_METHODS and self.batch_supported and self.get_wire_format() != PLAIN:
+            return self.batch([(name, args)])[0]
+        return self._call(name, *args)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call_method(name, *args)
+
+    def close(self):
+        self.client.close()
+
+
+class PushedService(object):
+    """
+    Serves the calls covered by the latest push of an agent node from memory,
+    passing any other call on to the node through RPC.
+    """
+
+    def __init__(self, node, calls, timestamp):
+        self.node = node
+        self.timestamp = timestamp
+        self._results = dict((make_key(name, tuple(args)), decode_result(result)) for name, args, result in calls)
+        processes = self._results.get(make_key('get_process_list', ()))
+        self._process_snapshot = ProcessSnapshot(processes, timestamp) if processes is not None else None
+
+    def _get_result(self, name, args):
+        """
+        Returns a tuple of (found, result).
+        """
+        key = make_key(name, tuple(args))
+        if key in self._results:
+            return True, self._results[key]
+
+        if name == 'query_process_list' and self._process_snapshot is not None:
+            return True, query_processes(self._process_snapshot, *args)
+
+        connections_key = make_key('get_connections', ())
+        if name == 'get_connections' and connections_key in self._results:
+            return True, filter_connections(self._results[connections_key], *args)
+
+        return False, None
+
+    def _call(self, name, *args):
+        found, result = self._get_result(name, args)
+        if found:
+            return result
+        return getattr(self.node.get_rpc_service(), name)(*args)
+
+    def batch(self, calls):
+        results = [self._get_result(name, args) for name, args in calls]
+        missing = [call for call, (found, _) in zip(calls, results) if not found]
+        if not missing:
+            return [result for _, result in results]
+
+        fetched = iter(self.node.get_rpc_service().batch(missing))
+        return [result if found else next(fetched) for found, result in results]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, *args)
+
+
 class RemoteNode(Node):
-    def __init__(self, name, host, port):
+    DEFAULT_TIMEOUT = 10
+    DEFAULT_FAILURE_THRESHOLD = 3
+    DEFAULT_RETRY_INTERVAL = 30
+    DEFAULT_WIRE_FORMAT = COLUMNS
+
+    def __init__(self, name, host, port, timeout=DEFAULT_TIMEOUT,
+                 failure_threshold=DEFAULT_FAILURE_THRESHOLD, retry_interval=DEFAULT_RETRY_INTERVAL,
+                 wire_format=DEFAULT_WIRE_FORMAT):
         super(RemoteNode, self).__init__()
         self.name = name
         self.host = host
         self.port = int(port)
+        self.timeout = timeout
+        self.wire_format = wire_format
+        self.circuit_breaker = CircuitBreaker(failure_threshold, retry_interval)
         self.last_registered = None
+        self.pushed = None
+        self.push_interval = None
+
+    def update_pushed(self, calls, push_interval):
+        self.pushed = PushedService(self, calls, time.time())
+        self.push_interval = push_interval
+
+    def is_push_current(self):
+        # a push or two might get lost, three is too many
+        return self.pushed is not None and time.time() - self.pushed.timestamp <= self.push_interval * 3
+
+    def get_service(self):
+        if self.is_push_current():
+            return self.pushed
+        return self.get_rpc_service()
+
+    def get_rpc_service(self):
+        return super(RemoteNode, self).get_service()
 
     def _create_service(self):
         logger.info('Connecting to node %s', self.get_id())
-        c = zerorpc.Client()
-        c.connect('tcp://%s:%s' % (self.host, self.port))
+        c = zerorpc.Client(timeout=self.timeout, heartbeat=min(self.timeout, 5))
+        try:
+            c.connect('tcp://%s:%s' % (self.host, self.port))
+        except zmq.ZMQError as e:
+            c.close()
+            self.circuit_breaker.record_failure()
+            raise NodeUnavailable('Could not connect to node %s: %s' % (self.get_id(), e))
         logger.info('Connected.')
-        return c
+        return RemoteService(self, c, self.wire_format)
 
     def get_id(self):
         return '%s:%s' % (self.host, self.port)
 
+    def is_healthy(self):
+        return not self.circuit_breaker.is_open()
+
     def update_last_registered(self):
         self.last_registered = int(time.time())
 
+    def get_registration_age(self):
+        return int(time.time()) - self.last_registered
+
+    def close(self):
+        if self._service:
+            self._service.close()
+            self._service = None
+
 
 class LocalNode(Node):
-    def __init__(self):
+    def __init__(self, history=None, logs=None, log_metrics=None):
         super(LocalNode, self).__init__()
         self.name = "psDash"
         self.net_io_counters = NetIOCounters()
-        self.logs = Logs()
+        self.process_table = ProcessTable()
+        self.history = history or MetricHistory()
+        self.host_metrics = HostMetrics(self.get_service())
+        self.logs = logs or Logs()
+        self.log_metrics = log_metrics or LogMetrics(self.logs, {})
 
     def get_id(self):
         return 'localhost'
@@ -70,6 +377,27 @@ class LocalService(object):
     def __init__(self, node):
         self.node = node
 
+    def batch(self, calls, wire_format=PLAIN):
+        """
+        Makes several calls in one go, saving a round trip per call when called
+        through RPC. Each call is a (method name, args) pair and the results are
+        returned in the same order, encoded in the given wire format.
+        The first exception raised is passed on.
+        """
+        if wire_format not in WIRE_FORMATS:
+            raise ValueError('Unknown wire format: %s' % wire_format)
+
+        results = []
+        for name, args in calls:
+            method = getattr(self, name, None) if not name.startswith('_') and name != 'batch' else None
+            if not callable(method):
+                raise ValueError('Invalid method in batch: %s' % name)
+            results.append(encode_result(method(*args), wire_format))
+        return results
+
+    def get_wire_formats(self):
+        return list(WIRE_FORMATS)
+
     def get_sysinfo(self):
         uptime = int(time.time() - psutil.boot_time())
         sysinfo = {
@@ -153,82 +481,27 @@ class LocalService(object):
 
         return netifs
 
+    def get_metric_names(self):
+        return self.node.history.get_names()
+
+    def get_metric_history(self, name, resolution=None, start=None, end=None):
+        return self.node.history.get(name, resolution=resolution, start=start, end=end)
+
     def get_process_list(self):
-        process_list = []
-        for p in psutil.process_iter():
-            mem = p.memory_info()
-            
-            # psutil throws a KeyError when the uid of a process is not associated with an user.
-            try:
-                username = p.username()
-            except KeyError:
-                username = None
-
-            proc = {
-                'pid': p.pid,
-                'name': p.name(),
-                'cmdline': ' '.join(p.cmdline()),
-                'user': username,
-                'status': p.status(),
-                'created': p.create_time(),
-                'mem_rss': mem.rss,
-                'mem_vms': mem.vms,
-                'mem_percent': p.memory_percent(),
-                'cpu_percent': p.cpu_percent(0)
-            }
-            process_list.append(proc)
+        return list(self.node.process_table.get())
 
-        return process_list
+    def query_process_list(self, sort='cpu_percent', order='desc', offset=0, limit=None, filter='all', text=None):
+        return query_processes(self.node.process_table.get(), sort, order, offset, limit, filter, text)
 
     def get_process(self, pid):
-        p = psutil.Process(pid)
-        mem = p.memory_info_ex()
-        cpu_times = p.cpu_times()
-
-        # psutil throws a KeyError when the uid of a process is not associated with an user.
-        try:
-            username = p.username()
-        except KeyError:
-            username = None
+        proc = read_fields(psutil.Process(pid), PROCESS_DETAIL_FIELDS)
+        proc['mem_percent'] = get_memory_percent(proc['mem_rss'], psutil.virtual_memory().total)
 
-        return {
-            'pid': p.pid,
-            'ppid': p.ppid(),
-            'parent_name': p.parent().name() if p.parent() else '',
-            'name': p.name(),
-            'cmdline': ' '.join(p.cmdline()),
-            'user': username,
-            'uid_real': p.uids().real,
-            'uid_effective': p.uids().effective,
-            'uid_saved': p.uids().saved,
-            'gid_real': p.gids().real,
-            'gid_effective': p.gids().effective,
-            'gid_saved': p.gids().saved,
-            'status': p.status(),
-            'created': p.create_time(),
-            'terminal': p.terminal(),
-            'mem_rss': mem.rss,
-            'mem_vms': mem.vms,
-            'mem_shared': mem.shared,
-            'mem_text': mem.text,
-            'mem_lib': mem.lib,
-            'mem_data': mem.data,
-            'mem_dirty': mem.dirty,
-            'mem_percent': p.memory_percent(),
-            'cwd': p.cwd(),
-            'nice': p.nice(),
-            'io_nice_class': p.ionice()[0],
-            'io_nice_value': p.ionice()[1],
-            'cpu_percent': p.cpu_percent(0),
-            'num_threads': p.num_threads(),
-            'num_files': len(p.open_files()),
-            'num_children': len(p.children()),
-            'num_ctx_switches_invol': p.num_ctx_switches().involuntary,
-            'num_ctx_switches_vol': p.num_ctx_switches().voluntary,
-            'cpu_times_user': cpu_times.user,
-            'cpu_times_system': cpu_times.system,
-            'cpu_affinity': p.cpu_affinity()
-        }
+        # cpu utilization is measured between samples of the process table,
+        # a single look at the process can't tell us anything about it.
+        sampled = self.node.process_table.get().get_process(pid)
+        proc['cpu_percent'] = sampled['cpu_percent'] if sampled else 0.0
+        return proc
 
     def get_process_limits(self, pid):
         p = psutil.Process(pid)
@@ -309,7 +582,6 @@ class LocalService(object):
         return children
 
     def get_connections(self, filters=None):
-        filters = filters or {}
         connections = []
 
         for c in psutil.net_connections('all'):
@@ -325,13 +597,9 @@ class LocalService(object):
                 'state': c.status
             }
 
-            for k, v in filters.iteritems():
-                if v and conn.get(k) != v:
-                    break
-            else:
-                connections.append(conn)
+            connections.append(conn)
 
-        return connections
+        return filter_connections(connections, filters)
 
     def get_logs(self):
         available_logs = []
@@ -350,12 +618,27 @@ class LocalService(object):
 
         return available_logs
 
+    def get_log_stats(self):
+        return self.node.logs.get_stats()
+
     def read_log(self, filename, session_key=None, seek_tail=False):
         log = self.node.logs.get(filename, key=session_key)
         if seek_tail:
             log.set_tail_position()
         return log.read()
 
+    def follow_log(self, filename, session_key, position=None, max_bytes=64 * 1024):
+        """
+        Returns a dict of the content appended to the log from position,
+        up to max_bytes, and the position to follow the log from next. With
+        no position, the log is followed from its end. The file read is
+        kept track of by the reader of session_key, rotation and truncation
+        are handled like when reading the log.
+        """
+        log = self.node.logs.get(filename, key=session_key)
+        position, content = log.follow(position, max_bytes)
+        return {'position': position, 'content': content}
+
     def search_log(self, filename, text, session_key=None):
         log = self.node.logs.get(filename, key=session_key)
         pos, bufferpos, res = log.search(text)
@@ -367,3 +650,71 @@ class LocalService(object):
             'content': res
         }
         return data
+
+    def query_log(self, filename, query, before=None, limit=50, context=0):
+        """
+        Returns a page of the lines of the log matching query, a dict of
+        the LogQuery arguments. See LogIndex.find_lines().
+        """
+        log = self.node.logs.get(filename)
+        result = log.find_lines(LogQuery(**query), before, limit, context, self.node.logs.max_scan)
+        result['filesize'] = os.stat(log.filename).st_size
+        return result
+
+    def get_log_metrics(self, filenames=None, minutes=60):
+        """
+        Returns the number of lines matching the configured patterns of
+        each log, per minute of the last number of minutes.
+        """
+        metrics = self.node.log_metrics.get(filenames, minutes)
+        for m in metrics:
+            m['filename'] = m['filename'].encode('utf-8')
+        return metrics
+
+    def read_log_lines(self, filename, start, count):
+        """
+        Returns count lines of the log from line number start, negative
+        counting from the end. See LogIndex.read_lines().
+        """
+        return self.node.logs.get(filename).read_lines(start, count)
+
+    def read_log_range(self, filename, offset, length):
+        """
+        Returns length bytes of the log from offset. See LogIndex.read_range().
+        """
+        return self.node.logs.get(filename).read_range(offset, length)
+
+    def read_log_file(self, filename, offset, length):
+        """
+        Returns a dict of length bytes of the log file from offset, as they
+        are on disk (compressed for a gzip log), and the size of the file.
+        """
+        if filename not in self.node.logs.available:
+            raise KeyError('No log with filename "%s" is available' % filename)
+        with open(filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            return {'content': f.read(length), 'size': size}
+
+    def _get_merged_log(self, filenames, session_key):
+        # the position in a merged view is kept apart from the one of the log's own view
+        return MergedLog([self.node.logs.get(f, key=(session_key, 'merged')) for f in filenames])
+
+    def read_merged_logs(self, filenames, session_key=None, seek_tail=False):
+        """
+        Returns the next lines of the logs merged by timestamp as a list of
+        (timestamp, filename, line) tuples.
+        """
+        lines = self._get_merged_log(filenames, session_key).read(seek_tail)
+        return [(ts, filename.encode('utf-8'), line) for ts, filename, line in lines]
+
+    def query_merged_logs(self, filenames, query, cursors=None, limit=50, context=0):
+        """
+        Returns a page of the lines of the logs matching query, latest first.
+        See MergedLog.find_lines().
+        """
+        log = self._get_merged_log(filenames, None)
+        result = log.find_lines(LogQuery(**query), cursors, limit, context, self.node.logs.max_scan)
+        for m in result['matches']:
+            m['filename'] = m['filename'].encode('utf-8')
+        return result
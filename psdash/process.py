@@ -0,0 +1,377 @@
+# coding=utf-8
+import gevent
+import heapq
+import logging
+import pwd
+import os
+import time
+import psutil
+from collections import namedtuple
+from contextlib import contextmanager
+from operator import attrgetter, itemgetter
+
+logger = logging.getLogger('psdash.process')
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+
+CpuTimes = namedtuple('CpuTimes', ['user', 'system'])
+
+
+def get_username(uids):
+    # a KeyError is raised when the uid of a process is not associated with an user.
+    try:
+        return pwd.getpwuid(uids.real).pw_name
+    except KeyError:
+        return None
+
+
+def get_process_name(pid):
+    try:
+        return psutil.Process(pid).name()
+    except psutil.NoSuchProcess:
+        return ''
+
+
+# Each field is a (key, accessor, transform) tuple where accessor is the
+# psutil.Process method to read the value from. Every accessor is only called
+# once per process no matter how many fields are derived from it.
+PROCESS_LIST_FIELDS = (
+    ('name', 'name', None),
+    ('cmdline', 'cmdline', ' '.join),
+    ('user', 'uids', get_username),
+    ('status', 'status', None),
+    ('created', 'create_time', None),
+    ('mem_rss', 'memory_info', attrgetter('rss')),
+    ('mem_vms', 'memory_info', attrgetter('vms'))
+)
+
+PROCESS_DETAIL_FIELDS = (
+    ('ppid', 'ppid', None),
+    ('parent_name', 'ppid', get_process_name),
+    ('name', 'name', None),
+    ('cmdline', 'cmdline', ' '.join),
+    ('user', 'uids', get_username),
+    ('uid_real', 'uids', attrgetter('real')),
+    ('uid_effective', 'uids', attrgetter('effective')),
+    ('uid_saved', 'uids', attrgetter('saved')),
+    ('gid_real', 'gids', attrgetter('real')),
+    ('gid_effective', 'gids', attrgetter('effective')),
+    ('gid_saved', 'gids', attrgetter('saved')),
+    ('status', 'status', None),
+    ('created', 'create_time', None),
+    ('terminal', 'terminal', None),
+    ('mem_rss', 'memory_info_ex', attrgetter('rss')),
+    ('mem_vms', 'memory_info_ex', attrgetter('vms')),
+    ('mem_shared', 'memory_info_ex', attrgetter('shared')),
+    ('mem_text', 'memory_info_ex', attrgetter('text')),
+    ('mem_lib', 'memory_info_ex', attrgetter('lib')),
+    ('mem_data', 'memory_info_ex', attrgetter('data')),
+    ('mem_dirty', 'memory_info_ex', attrgetter('dirty')),
+    ('cwd', 'cwd', None),
+    ('nice', 'nice', None),
+    ('io_nice_class', 'ionice', itemgetter(0)),
+    ('io_nice_value', 'ionice', itemgetter(1)),
+    ('num_threads', 'num_threads', None),
+    ('num_files', 'open_files', len),
+    ('num_children', 'children', len),
+    ('num_ctx_switches_invol', 'num_ctx_switches', attrgetter('involuntary')),
+    ('num_ctx_switches_vol', 'num_ctx_switches', attrgetter('voluntary')),
+    ('cpu_times_user', 'cpu_times', attrgetter('user')),
+    ('cpu_times_system', 'cpu_times', attrgetter('system')),
+    ('cpu_affinity', 'cpu_affinity', None)
+)
+
+
+@contextmanager
+def _no_oneshot():
+    yield
+
+
+def oneshot(p):
+    """
+    Process.oneshot() (psutil >= 5.0) makes psutil parse each /proc file of
+    the process only once for all the accessors called within it.
+    """
+    if hasattr(p, 'oneshot'):
+        return p.oneshot()
+    return _no_oneshot()
+
+
+def read_fields(p, fields):
+    """
+    Reads the given fields of a psutil.Process calling each accessor once.
+    """
+    values = {}
+    with oneshot(p):
+        for _, accessor, _ in fields:
+            if accessor not in values:
+                values[accessor] = getattr(p, accessor)()
+
+    proc = {'pid': p.pid}
+    for key, accessor, transform in fields:
+        value = values[accessor]
+        proc[key] = transform(value) if transform else value
+
+    return proc
+
+
+def is_user_process(proc):
+    return proc['user'] != 'root'
+
+
+def create_process_filter(user_only=False, text=None):
+    """
+    Returns a predicate matching processes that are not owned by root (when user_only
+    is set) and that contain text in their pid, name, cmdline or user.
+    Returns None when nothing is to be filtered out.
+    """
+    if isinstance(text, unicode):
+        # process names and command lines are byte strings
+        text = text.encode('utf-8')
+    if text:
+        text = text.lower()
+
+    def matches(proc):
+        if user_only and not is_user_process(proc):
+            return False
+        if text:
+            return (text == str(proc['pid']) or
+                    text in proc['name'].lower() or
+                    text in proc['cmdline'].lower() or
+                    text in (proc['user'] or '').lower())
+        return True
+
+    if user_only or text:
+        return matches
+    return None
+
+
+def get_memory_percent(rss, total_memory):
+    try:
+        return (rss / float(total_memory)) * 100
+    except ZeroDivisionError:
+        return 0.0
+
+
+def read_stat(pid):
+    """
+    Returns a (start time, cpu times) tuple of a process as found in
+    /proc/<pid>/stat, the start time in clock ticks since boot. Together
+    with the pid the start time uniquely identifies a process even when a
+    pid has been reused.
+    """
+    with open('/proc/%d/stat' % pid) as f:
+        stat = f.read()
+    # the process name is enclosed in parentheses and may contain spaces.
+    fields = stat[stat.rfind(')') + 2:].split()
+    cpu_times = CpuTimes(float(fields[11]) / CLOCK_TICKS, float(fields[12]) / CLOCK_TICKS)
+    return int(fields[19]), cpu_times
+
+
+def get_start_time(pid):
+    return read_stat(pid)[0]
+
+
+class TrackedProcess(object):
+    """
+    A psutil.Process that is kept around between samples together with
+    the cpu time it had used at the previous sample.
+    """
+
+    def __init__(self, process, start_time):
+        self.process = process
+        self.start_time = start_time
+        self.last_cpu_time = None
+        self.last_sample_time = None
+
+    def cpu_percent(self, cpu_times, sample_time):
+        """
+        Returns the cpu utilization since the previous call, where
+        100.0 means that one cpu core was fully used by the process.
+        """
+        cpu_time = cpu_times.user + cpu_times.system
+        percent = 0.0
+        if self.last_sample_time is not None and sample_time > self.last_sample_time:
+            percent = (cpu_time - self.last_cpu_time) / (sample_time - self.last_sample_time) * 100
+            percent = round(max(percent, 0.0), 1)
+
+        self.last_cpu_time = cpu_time
+        self.last_sample_time = sample_time
+        return percent
+
+
+class ProcessSnapshot(object):
+    """
+    The process table as it looked at a single point in time.
+    Snapshots are never modified once created, so the same snapshot
+    can be handed out to any number of concurrent readers.
+    """
+
+    INDEXED_FIELDS = ('pid', 'cpu_percent', 'mem_rss', 'mem_percent', 'name', 'user')
+
+    def __init__(self, processes, timestamp):
+        self.processes = tuple(processes)
+        self.timestamp = timestamp
+        self._by_pid = None
+        self._indexes = {}
+        self._num_user_processes = None
+
+    def __len__(self):
+        return len(self.processes)
+
+    def __iter__(self):
+        return iter(self.processes)
+
+    def get_process(self, pid):
+        if self._by_pid is None:
+            self._by_pid = dict((p['pid'], p) for p in self.processes)
+        return self._by_pid.get(pid)
+
+    def get_num_user_processes(self):
+        if self._num_user_processes is None:
+            self._num_user_processes = sum(1 for p in self.processes if is_user_process(p))
+        return self._num_user_processes
+
+    def get_index(self, field):
+        """
+        Returns the processes sorted in ascending order by field.
+        The index is built on first use and then shared by every reader of the snapshot.
+        """
+        index = self._indexes.get(field)
+        if index is None:
+            index = tuple(sorted(self.processes, key=itemgetter(field)))
+            self._indexes[field] = index
+        return index
+
+    def query(self, sort='cpu_percent', reverse=True, offset=0, limit=None, predicate=None):
+        """
+        Returns a tuple of (processes, num_matches) where processes is the
+        requested page of the processes matching predicate, ordered by sort.
+        """
+        end = offset + limit if limit is not None else None
+
+        if sort in self.INDEXED_FIELDS:
+            matches = self.get_index(sort)
+            if predicate:
+                matches = tuple(p for p in matches if predicate(p))
+            num_matches = len(matches)
+
+            if reverse:
+                start = max(num_matches - end, 0) if end is not None else 0
+                page = matches[start:max(num_matches - offset, 0)][::-1]
+            else:
+                page = matches[offset:end]
+        else:
+            matches = [p for p in self.processes if not predicate or predicate(p)]
+            num_matches = len(matches)
+            key = lambda p: p.get(sort)
+
+            if end is None:
+                page = sorted(matches, key=key, reverse=reverse)[offset:]
+            else:
+                # only the top of the list is ever shown, no need to sort all of it.
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                page = select(end, matches, key=key)[offset:]
+
+        return list(page), num_matches
+
+    def __repr__(self):
+        return '<ProcessSnapshot processes=%d, timestamp=%d>' % (
+            len(self.processes), self.timestamp
+        )
+
+
+def query_processes(snapshot, sort='cpu_percent', order='desc', offset=0, limit=None, filter='all', text=None):
+    processes, num_matches = snapshot.query(
+        sort=sort,
+        reverse=order != 'asc',
+        offset=offset,
+        limit=limit,
+        predicate=create_process_filter(user_only=filter == 'user', text=text)
+    )
+
+    return {
+        'processes': processes,
+        'num_matches': num_matches,
+        'num_procs': len(snapshot),
+        'num_user_procs': snapshot.get_num_user_processes()
+    }
+
+
+class ProcessTable(object):
+    """
+    Samples the process table and keeps the latest snapshot around so that
+    readers never have to walk /proc themselves.
+    """
+    # the number of processes read between yields to other greenlets
+    YIELD_INTERVAL = 100
+
+    def __init__(self):
+        self.last_snapshot = None
+        # (pid, start time) => TrackedProcess
+        self._processes = {}
+
+    def _track(self, pids):
+        """
+        Returns a (TrackedProcess, cpu times, sample time) tuple for each of
+        the given pids, reusing the processes of earlier samples and evicting
+        the ones that are gone. The cpu times come from the same read of
+        /proc/<pid>/stat that tells the processes apart.
+        """
+        processes = {}
+        samples = []
+        for pid in pids:
+            try:
+                start_time, cpu_times = read_stat(pid)
+            except (IOError, OSError):
+                # the process went away before we got to it
+                continue
+            sample_time = time.time()
+            key = (pid, start_time)
+
+            tracked = self._processes.get(key)
+            if not tracked:
+                try:
+                    tracked = TrackedProcess(psutil.Process(pid), key[1])
+                except psutil.NoSuchProcess:
+                    continue
+            processes[key] = tracked
+            samples.append((tracked, cpu_times, sample_time))
+
+        self._processes = processes
+        return samples
+
+    def _get_process(self, tracked, cpu_times, sample_time, total_memory):
+        proc = read_fields(tracked.process, PROCESS_LIST_FIELDS)
+        proc['mem_percent'] = get_memory_percent(proc['mem_rss'], total_memory)
+        proc['cpu_percent'] = tracked.cpu_percent(cpu_times, sample_time)
+        return proc
+
+    def _get_process_list(self):
+        process_list = []
+        total_memory = psutil.virtual_memory().total
+        for i, (tracked, cpu_times, sample_time) in enumerate(self._track(psutil.pids()), 1):
+            try:
+                process_list.append(self._get_process(tracked, cpu_times, sample_time, total_memory))
+            except (psutil.NoSuchProcess, psutil.AccessDenied) as e:
+                logger.debug('Skipping process %d in sample: %s', tracked.process.pid, e)
+            if i % self.YIELD_INTERVAL == 0:
+                # let requests be served while sampling a large process table
+                gevent.sleep(0)
+
+        process_list.sort(key=lambda p: p['pid'])
+        return process_list
+
+    def get(self):
+        """
+        Returns the latest snapshot, sampling the process table
+        if no snapshot has been taken yet.
+        """
+        if self.last_snapshot is None:
+            return self.update()
+        return self.last_snapshot
+
+    def update(self):
+        snapshot = ProcessSnapshot(self._get_process_list(), time.time())
+        self.last_snapshot = snapshot
+        return snapshot
@@ -9,12 +9,23 @@ import logging
 import socket
 import urllib
 import urllib2
+import msgpack
+import uuid
 from logging import getLogger
 from flask import Flask
 import zerorpc
 from psdash import __version__
-from psdash.node import LocalNode, RemoteNode
-from psdash.web import fromtimestamp
+from psdash.node import LocalNode, RemoteNode, PUSH_CALLS
+from psdash.events import Publisher, CHANNELS
+from psdash.history import MetricHistory
+from psdash.log import Logs, LogIndex, GzipCheckpoints
+from psdash.discovery import LogDiscovery
+from psdash.inotify import create_inotify
+from psdash.tail import LogTails
+from psdash.logmetrics import LogMetrics
+from psdash.cluster import ClusterOverview
+from psdash.cache import TTLCache
+from psdash.web import fromtimestamp, sparkline_points
 
 
 logger = getLogger('psdash.run')
@@ -22,7 +33,12 @@ logger = getLogger('psdash.run')
 
 class PsDashRunner(object):
     DEFAULT_LOG_INTERVAL = 60
+    DEFAULT_LOG_METRICS_INTERVAL = 10
     DEFAULT_NET_IO_COUNTER_INTERVAL = 3
+    DEFAULT_PROCESS_TABLE_INTERVAL = 3
+    DEFAULT_PROCESSES_PER_PAGE = 100
+    DEFAULT_STREAM_INTERVAL = 3
+    DEFAULT_HISTORY_INTERVAL = 1
     DEFAULT_REGISTER_INTERVAL = 60
     DEFAULT_BIND_HOST = '0.0.0.0'
     DEFAULT_PORT = 5000
@@ -34,12 +50,24 @@ class PsDashRunner(object):
 
     def __init__(self, config_overrides=None, args=tuple()):
         self._nodes = {}
+        self._configured_nodes = set()
+        self._publishers = {}
+        self._log_tails = {}
+        # the key of the log readers following logs for this node's viewers
+        self._tail_session_key = 'tail-%s' % uuid.uuid4().hex
+        self.service_cache = TTLCache()
+        self.log_discovery = None
         config = self._load_args_config(args)
         if config_overrides:
             config.update(config_overrides)
         self.app = self._create_app(config)
 
         self._setup_nodes()
+        self.cluster_overview = ClusterOverview(
+            pool_size=self.app.config.get('PSDASH_CLUSTER_POOL_SIZE', ClusterOverview.DEFAULT_POOL_SIZE),
+            timeout=self.app.config.get('PSDASH_CLUSTER_TIMEOUT', ClusterOverview.DEFAULT_TIMEOUT),
+            cache_ttl=self.app.config.get('PSDASH_CLUSTER_CACHE_TTL', ClusterOverview.DEFAULT_CACHE_TTL)
+        )
         self._setup_logging()
         self._setup_context()
 
@@ -101,6 +129,16 @@ class PsDashRunner(object):
             metavar='name',
             help='The name to register as. (This will default to the node\'s hostname)'
         )
+        parser.add_argument(
+            '--push-interval',
+            action='store',
+            type=int,
+            dest='push_interval',
+            default=None,
+            metavar='seconds',
+            help='Push the node\'s data to the psdash node registered to every n seconds, '
+                 'which then serves its pages without calling the agent.'
+        )
 
         return parser.parse_args(args)
 
@@ -113,12 +151,32 @@ class PsDashRunner(object):
         return config
 
     def _setup_nodes(self):
-        self.add_node(LocalNode())
+        history = MetricHistory(
+            tiers=self.app.config.get('PSDASH_HISTORY_TIERS', MetricHistory.DEFAULT_TIERS),
+            memory_limit=self.app.config.get('PSDASH_HISTORY_MEMORY_LIMIT', MetricHistory.DEFAULT_MEMORY_LIMIT),
+            directory=self.app.config.get('PSDASH_HISTORY_DIR')
+        )
+        logs = Logs(
+            use_mmap=self.app.config.get('PSDASH_LOGS_MMAP', False),
+            max_scan=self.app.config.get('PSDASH_LOG_SEARCH_MAX_SCAN', LogIndex.DEFAULT_MAX_SCAN),
+            follow_rotated=self.app.config.get('PSDASH_LOGS_FOLLOW_ROTATED', True),
+            gzip_interval=self.app.config.get('PSDASH_LOGS_GZIP_CHECKPOINT_INTERVAL', GzipCheckpoints.DEFAULT_INTERVAL),
+            max_readers=self.app.config.get('PSDASH_LOGS_MAX_READERS', Logs.DEFAULT_MAX_READERS),
+            idle_timeout=self.app.config.get('PSDASH_LOGS_READER_IDLE_TIMEOUT', Logs.DEFAULT_IDLE_TIMEOUT)
+        )
+        log_metrics = LogMetrics(
+            logs,
+            self.app.config.get('PSDASH_LOG_METRICS', {}),
+            history=self.app.config.get('PSDASH_LOG_METRICS_HISTORY', LogMetrics.DEFAULT_HISTORY),
+            max_read=self.app.config.get('PSDASH_LOG_METRICS_MAX_READ', LogMetrics.DEFAULT_MAX_READ)
+        )
+        self.add_node(LocalNode(history=history, logs=logs, log_metrics=log_metrics))
 
         nodes = self.app.config.get('PSDASH_NODES', [])
         logger.info("Registering %d nodes", len(nodes))
         for n in nodes:
-            self.register_node(n['name'], n['host'], int(n['port']))
+            node = self.register_node(n['name'], n['host'], int(n['port']))
+            self._configured_nodes.add(node.get_id())
 
     def add_node(self, node):
         self._nodes[node.get_id()] = node
@@ -132,8 +190,25 @@ class PsDashRunner(object):
     def get_nodes(self):
         return self._nodes
 
+    def remove_node(self, node_id):
+        node = self._nodes.pop(node_id, None)
+        self._publishers.pop(node_id, None)
+        tails = self._log_tails.pop(node_id, None)
+        if tails:
+            tails.close()
+        if node:
+            node.close()
+        return node
+
     def register_node(self, name, host, port):
-        n = RemoteNode(name, host, port)
+        n = RemoteNode(
+            name, host, port,
+            timeout=self.app.config.get('PSDASH_NODE_TIMEOUT', RemoteNode.DEFAULT_TIMEOUT),
+            failure_threshold=self.app.config.get('PSDASH_NODE_FAILURE_THRESHOLD',
+                                                  RemoteNode.DEFAULT_FAILURE_THRESHOLD),
+            retry_interval=self.app.config.get('PSDASH_NODE_RETRY_INTERVAL', RemoteNode.DEFAULT_RETRY_INTERVAL),
+            wire_format=self.app.config.get('PSDASH_WIRE_FORMAT', RemoteNode.DEFAULT_WIRE_FORMAT)
+        )
         node = self.get_node(n.get_id())
         if node:
             n = node
@@ -144,6 +219,26 @@ class PsDashRunner(object):
         self.add_node(n)
         return n
 
+    def get_publisher(self, node_id):
+        publisher = self._publishers.get(node_id)
+        if not publisher:
+            publisher = Publisher()
+            self._publishers[node_id] = publisher
+        return publisher
+
+    def get_log_tails(self, node_id):
+        tails = self._log_tails.get(node_id)
+        if not tails:
+            tails = LogTails(
+                self.get_node(node_id),
+                self._tail_session_key,
+                max_buffered=self.app.config.get('PSDASH_LOGS_TAIL_MAX_BUFFERED', LogTails.DEFAULT_MAX_BUFFERED),
+                poll_interval=self.app.config.get('PSDASH_LOGS_TAIL_POLL_INTERVAL', LogTails.DEFAULT_POLL_INTERVAL),
+                use_inotify=node_id == self.LOCAL_NODE and self.app.config.get('PSDASH_LOGS_INOTIFY', True)
+            )
+            self._log_tails[node_id] = tails
+        return tails
+
     def _create_app(self, config=None):
         app = Flask(__name__)
         app.psdash = self
@@ -158,14 +253,18 @@ class PsDashRunner(object):
         if not app.secret_key:
             app.secret_key = 'whatisthissourcery'
         app.add_template_filter(fromtimestamp)
+        app.add_template_filter(sparkline_points)
 
-        from psdash.web import webapp
+        from psdash.web import webapp, api
         prefix = app.config.get('PSDASH_URL_PREFIX')
         if prefix:
             prefix = '/' + prefix.strip('/')
         webapp.url_prefix = prefix
         app.register_blueprint(webapp)
 
+        api.url_prefix = (prefix or '') + '/api/v1'
+        app.register_blueprint(api)
+
         return app
 
     def _load_allowed_remote_addresses(self, app):
@@ -191,29 +290,82 @@ class PsDashRunner(object):
         net_io_interval = self.app.config.get('PSDASH_NET_IO_COUNTER_INTERVAL', self.DEFAULT_NET_IO_COUNTER_INTERVAL)
         gevent.spawn_later(net_io_interval, self._net_io_counters_worker, net_io_interval)
 
+        process_table_interval = self.app.config.get('PSDASH_PROCESS_TABLE_INTERVAL',
+                                                     self.DEFAULT_PROCESS_TABLE_INTERVAL)
+        gevent.spawn_later(process_table_interval, self._process_table_worker, process_table_interval)
+
         if 'PSDASH_LOGS' in self.app.config:
+            if self.app.config.get('PSDASH_LOGS_INOTIFY', True):
+                inotify = create_inotify()
+                if inotify:
+                    self.log_discovery.start_watching(inotify)
+                    gevent.spawn(self._log_discovery_worker)
+
             logs_interval = self.app.config.get('PSDASH_LOGS_INTERVAL', self.DEFAULT_LOG_INTERVAL)
             gevent.spawn_later(logs_interval, self._logs_worker, logs_interval)
 
+        if self.app.config.get('PSDASH_LOG_METRICS'):
+            log_metrics_interval = self.app.config.get('PSDASH_LOG_METRICS_INTERVAL',
+                                                       self.DEFAULT_LOG_METRICS_INTERVAL)
+            gevent.spawn(self._log_metrics_worker, log_metrics_interval)
+
+        history_interval = self.app.config.get('PSDASH_HISTORY_INTERVAL', self.DEFAULT_HISTORY_INTERVAL)
+        gevent.spawn(self._history_worker, history_interval)
+
+        if not self.app.config.get('PSDASH_AGENT'):
+            stream_interval = self.app.config.get('PSDASH_STREAM_INTERVAL', self.DEFAULT_STREAM_INTERVAL)
+            gevent.spawn(self._publish_worker, stream_interval)
+
+            register_interval = self.app.config.get('PSDASH_REGISTER_INTERVAL', self.DEFAULT_REGISTER_INTERVAL)
+            gevent.spawn_later(register_interval, self._evict_nodes_worker, register_interval)
+
         if self.app.config.get('PSDASH_AGENT'):
             register_interval = self.app.config.get('PSDASH_REGISTER_INTERVAL', self.DEFAULT_REGISTER_INTERVAL)
             gevent.spawn_later(register_interval, self._register_agent_worker, register_interval)
 
+            push_interval = self.app.config.get('PSDASH_PUSH_INTERVAL')
+            if push_interval and 'PSDASH_REGISTER_TO' in self.app.config:
+                gevent.spawn(self._push_worker, push_interval)
+
     def _setup_locale(self):
         # This set locale to the user default (usually controlled by the LANG env var)
         locale.setlocale(locale.LC_ALL, '')
 
     def _setup_context(self):
         self.get_local_node().net_io_counters.update()
+        self.get_local_node().process_table.update()
         if 'PSDASH_LOGS' in self.app.config:
-            self.get_local_node().logs.add_patterns(self.app.config['PSDASH_LOGS'])
+            self.log_discovery = LogDiscovery(self.get_local_node().logs, self.app.config['PSDASH_LOGS'])
+            self.log_discovery.scan()
 
     def _logs_worker(self, sleep_interval):
         while True:
             logger.debug("Reloading logs...")
-            self.get_local_node().logs.add_patterns(self.app.config['PSDASH_LOGS'])
+            # when watching, only the directories that could not be watched are listed
+            num_scanned = self.log_discovery.poll()
+            logger.debug("Listed %d changed log directories", num_scanned)
+            num_evicted = self.get_local_node().logs.evict_idle()
+            if num_evicted:
+                logger.debug("Evicted %d idle log readers", num_evicted)
+            gevent.sleep(sleep_interval)
+
+    def _log_metrics_worker(self, sleep_interval):
+        while True:
+            logger.debug("Counting matching log lines...")
+            try:
+                self.get_local_node().log_metrics.update()
+            except Exception:
+                logger.exception('Failed to count matching log lines')
             gevent.sleep(sleep_interval)
 
+    def _log_discovery_worker(self):
+        while True:
+            try:
+                self.log_discovery.watch()
+            except Exception:
+                logger.exception('Failed to process log directory changes')
+                gevent.sleep(1)
+
     def _register_agent_worker(self, sleep_interval):
         while True:
             logger.debug("Registering agent...")
@@ -226,7 +378,72 @@ class PsDashRunner(object):
             self.get_local_node().net_io_counters.update()
             gevent.sleep(sleep_interval)
 
-    def _register_agent(self):
+    def _process_table_worker(self, sleep_interval):
+        while True:
+            logger.debug("Updating process table...")
+            try:
+                self.get_local_node().process_table.update()
+            except Exception:
+                logger.exception('Failed to update the process table')
+            gevent.sleep(sleep_interval)
+
+    def _history_worker(self, sleep_interval):
+        node = self.get_local_node()
+        while True:
+            logger.debug("Sampling metric history...")
+            try:
+                timestamp, values = node.host_metrics.sample()
+                node.history.add_sample(timestamp, values)
+            except Exception:
+                logger.exception('Failed to sample metric history')
+            gevent.sleep(sleep_interval)
+
+    def _evict_nodes_worker(self, sleep_interval):
+        while True:
+            logger.debug("Evicting nodes that stopped registering...")
+            self.evict_nodes()
+            gevent.sleep(sleep_interval)
+
+    def evict_nodes(self):
+        """
+        Removes the agents that have not registered within PSDASH_NODE_EVICT_AFTER
+        seconds. Nodes given in PSDASH_NODES are never removed.
+        """
+        register_interval = self.app.config.get('PSDASH_REGISTER_INTERVAL', self.DEFAULT_REGISTER_INTERVAL)
+        evict_after = self.app.config.get('PSDASH_NODE_EVICT_AFTER', register_interval * 3)
+
+        evicted = []
+        for node_id, node in self._nodes.items():
+            if not isinstance(node, RemoteNode) or node_id in self._configured_nodes:
+                continue
+            if node.get_registration_age() > evict_after:
+                logger.info('Removing node %s as it has not registered in %d seconds',
+                            node_id, node.get_registration_age())
+                self.remove_node(node_id)
+                evicted.append(node_id)
+        return evicted
+
+    def _publish_worker(self, sleep_interval):
+        while True:
+            for node_id, publisher in self._publishers.items():
+                channels = publisher.get_channels()
+                if channels:
+                    logger.debug("Publishing %s for node %s...", ', '.join(channels), node_id)
+                    self._publish(node_id, publisher, channels)
+            gevent.sleep(sleep_interval)
+
+    def _publish(self, node_id, publisher, channels):
+        node = self.get_node(node_id)
+        if not node:
+            return
+
+        for channel in channels:
+            try:
+                publisher.publish(channel, CHANNELS[channel](node.get_service()))
+            except Exception:
+                logger.exception('Failed to publish %s for node %s', channel, node_id)
+
+    def _get_register_url(self, path):
         register_name = self.app.config.get('PSDASH_REGISTER_AS')
         if not register_name:
             register_name = socket.gethostname()
@@ -235,24 +452,57 @@ class PsDashRunner(object):
             'name': register_name,
             'port': self.app.config.get('PSDASH_PORT', self.DEFAULT_PORT),
         }
-        register_url = '%s/register?%s' % (self.app.config['PSDASH_REGISTER_TO'], urllib.urlencode(url_args))
+        return '%s%s?%s' % (self.app.config['PSDASH_REGISTER_TO'], path, urllib.urlencode(url_args))
 
+    def _install_register_auth(self):
         if 'PSDASH_AUTH_USERNAME' in self.app.config and 'PSDASH_AUTH_PASSWORD' in self.app.config:
             auth_handler = urllib2.HTTPBasicAuthHandler()
             auth_handler.add_password(
                 realm='psDash login required',
-                uri=register_url,
+                uri=self.app.config['PSDASH_REGISTER_TO'],
                 user=self.app.config['PSDASH_AUTH_USERNAME'],
                 passwd=self.app.config['PSDASH_AUTH_PASSWORD']
             )
             opener = urllib2.build_opener(auth_handler)
             urllib2.install_opener(opener)
 
+    def _register_agent(self):
+        register_url = self._get_register_url('/register')
+        self._install_register_auth()
+
         try:
             urllib2.urlopen(register_url)
         except urllib2.HTTPError as e:
             logger.error('Failed to register agent to "%s": %s', register_url, e)
 
+    def _push_worker(self, sleep_interval):
+        while True:
+            logger.debug("Pushing to %s...", self.app.config['PSDASH_REGISTER_TO'])
+            try:
+                self._push(sleep_interval)
+            except Exception:
+                logger.exception('Failed to push to %s', self.app.config['PSDASH_REGISTER_TO'])
+            gevent.sleep(sleep_interval)
+
+    def _push(self, push_interval):
+        """
+        Sends the results of the PUSH_CALLS to the node that the agent is registered to,
+        so that it doesn't have to make those calls itself.
+        """
+        wire_format = self.app.config.get('PSDASH_WIRE_FORMAT', RemoteNode.DEFAULT_WIRE_FORMAT)
+        results = self.get_local_node().get_service().batch(PUSH_CALLS, wire_format)
+        data = msgpack.packb({
+            'interval': push_interval,
+            'calls': [(name, args, result) for (name, args), result in zip(PUSH_CALLS, results)]
+        })
+
+        push_url = self._get_register_url('/push')
+        self._install_register_auth()
+        try:
+            urllib2.urlopen(urllib2.Request(push_url, data, {'Content-Type': 'application/x-msgpack'}))
+        except (urllib2.URLError, socket.error) as e:
+            logger.error('Failed to push to "%s": %s', push_url, e)
+
     def _run_rpc(self):
         logger.info("Starting RPC server (agent mode)")
 
@@ -13,6 +13,17 @@ function init_log() {
         $el.scrollTop($el[0].scrollHeight);
     }
 
+    function append_log(content) {
+        var $el = $("#log-content");
+        // only scroll down if the scroll is already at the bottom.
+        if(($el.scrollTop() + $el.innerHeight()) >= $el[0].scrollHeight) {
+            $el.append(document.createTextNode(content));
+            scroll_down($el);
+        } else {
+            $el.append(document.createTextNode(content));
+        }
+    }
+
     function read_log() {
         var $el = $("#log-content");
         var mode = $el.data("mode");
@@ -20,15 +31,30 @@ function init_log() {
             return;
         }
 
-        $.get($log.data("read-log-url"), function (resp) {
-            // only scroll down if the scroll is already at the bottom.
-            if(($el.scrollTop() + $el.innerHeight()) >= $el[0].scrollHeight) {
-                $el.append(resp);
-                scroll_down($el);
-            } else {
-                $el.append(resp);
+        $.get($log.data("read-log-url"), append_log);
+    }
+
+    function stream_log() {
+        var url = $log.data("tail-url");
+        if (!url || !window.EventSource) {
+            return false;
+        }
+
+        var source = new EventSource(url);
+        source.addEventListener("append", function (e) {
+            if($("#log-content").data("mode") != "tail") {
+                return;
             }
+            var data = JSON.parse(e.data);
+            if (data.skipped) {
+                append_log("\n[... " + filesizeformat(data.skipped) + " skipped ...]\n");
+            }
+            append_log(data.content);
+        });
+        source.addEventListener("end", function () {
+            source.close();
         });
+        return true;
     }
 
     function exit_search_mode() {
@@ -42,9 +68,41 @@ function init_log() {
             $el.text(resp);
             scroll_down($el);
             $("#search-input").val("").blur();
+            $("#line-input").val("");
         });
     }
 
+    var lines_per_page = 100;
+
+    function read_lines(start) {
+        var $el = $("#log-content");
+        $el.data("mode", "lines");
+        $("#log").find(".controls .mode-text").text("Line mode (Press n/p for next/previous page, escape to exit)");
+
+        $.get($log.data("read-lines-url"), {"start": start, "count": lines_per_page}, function (resp) {
+            $el.data("start", resp.start);
+            $el.text(resp.lines.join("\n"));
+            $el.scrollTop(0);
+
+            var $status = $("#log").find(".controls .status-text");
+            if (resp.lines.length) {
+                $status.text("Lines " + (resp.start + 1) + "-" + (resp.start + resp.lines.length) + " of " + resp.num_lines + ".");
+            } else {
+                $status.text("Line " + (resp.start + 1) + " is past the end (" + resp.num_lines + " lines).");
+            }
+            $status.show();
+        });
+    }
+
+    $("#line-form").submit(function(e) {
+        e.preventDefault();
+
+        var line = parseInt($("#line-input").val(), 10);
+        if (!line) return;
+        $("#line-input").blur();
+        read_lines(line - 1);
+    });
+
     $("#scroll-down-btn").click(function() {
         scroll_down($el);
     });
@@ -103,19 +161,93 @@ function init_log() {
             $("#search-input").focus();
         }
         // Exit search mode if escape is pressed.
-        else if(mode == "search" && e.which == 27) {
+        else if((mode == "search" || mode == "lines") && e.which == 27) {
             exit_search_mode();
         }
+        else if(mode == "lines" && !$(e.target).is("input") && (e.which == 78 || e.which == 80)) {
+            var start = $el.data("start") + (e.which == 78 ? lines_per_page : -lines_per_page);
+            read_lines(Math.max(start, 0));
+        }
     });
 
-    setInterval(read_log, 1000);
+    if (!stream_log()) {
+        setInterval(read_log, 1000);
+    }
     var $el = $("#log-content");
     scroll_down($el);
 }
 
 var skip_updates = false;
 
-function init_updater() {
+function filesizeformat(bytes) {
+    // same output as the filesizeformat filter of jinja
+    if (bytes == 1) return "1 Byte";
+    if (bytes < 1000) return bytes + " Bytes";
+
+    var prefixes = ["kB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB"];
+    for (var i = 0; i < prefixes.length; i++) {
+        var unit = Math.pow(1000, i + 2);
+        if (bytes < unit) {
+            return (1000 * bytes / unit).toFixed(1) + " " + prefixes[i];
+        }
+    }
+    return (1000 * bytes / unit).toFixed(1) + " " + prefixes[prefixes.length - 1];
+}
+
+function apply_delta(state, delta) {
+    for (var key in delta) {
+        var value = delta[key];
+        if (value === null) {
+            delete state[key];
+        } else if ($.isPlainObject(value) && $.isPlainObject(state[key])) {
+            apply_delta(state[key], value);
+        } else {
+            state[key] = value;
+        }
+    }
+}
+
+function init_stream() {
+    var $dashboard = $("#dashboard");
+    var url = $dashboard.data("stream-url");
+    if (!url || !window.EventSource) {
+        return false;
+    }
+
+    var state = {};
+    var formats = {
+        "filesize": filesizeformat,
+        "load": function (value) { return value.toFixed(2); }
+    };
+
+    function render() {
+        $("#dashboard").find("[data-field]").each(function () {
+            var $field = $(this);
+            var value = state;
+            var path = $field.data("field").split("/");
+            for (var i = 0; i < path.length && value !== undefined; i++) {
+                value = value[path[i]];
+            }
+            if (value === undefined) return;
+
+            var format = formats[$field.data("format")];
+            $field.text(format ? format(value) : value);
+        });
+    }
+
+    var source = new EventSource(url);
+    $.each(["overview", "network"], function (i, channel) {
+        source.addEventListener(channel, function (e) {
+            if (!state[channel]) state[channel] = {};
+            apply_delta(state[channel], JSON.parse(e.data));
+            render();
+        });
+    });
+
+    return true;
+}
+
+function init_updater(interval) {
     function update() {
         if (skip_updates) return;
 
@@ -129,7 +261,7 @@ function init_updater() {
         });
     }
 
-    setInterval(update, 3000);
+    setInterval(update, interval);
 }
 
 function init_connections_filter() {
@@ -150,11 +282,33 @@ function init_connections_filter() {
     });
 }
 
+function init_process_search() {
+    var $content = $("#psdash");
+    $content.on("focus", "#process-search-form input", function () {
+        skip_updates = true;
+    });
+    $content.on("blur", "#process-search-form input", function () {
+        skip_updates = false;
+    });
+}
+
+function init_logs_form() {
+    var $content = $("#psdash");
+    $content.on("change", "#logs-form input[type='checkbox']", function () {
+        // keep the selection from being reset by the updates
+        skip_updates = $content.find("#logs-form input:checked").length > 0;
+    });
+}
+
 $(document).ready(function() {
     init_connections_filter();
+    init_process_search();
+    init_logs_form();
 
     if($("#log").length == 0) {
-        init_updater();
+        // Streamed values are patched in place, the rest of the page
+        // only has to be reloaded once in a while.
+        init_updater(init_stream() ? 30000 : 3000);
     } else {
         init_log();
     }
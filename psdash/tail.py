@@ -0,0 +1,272 @@
+# coding=utf-8
+"""
+Streams the content appended to logs to their viewers. However many viewers
+a log has, it is followed by a single LogTail which reads what was appended
+once and hands it to each viewer's subscription.
+"""
+import logging
+from collections import deque
+import gevent
+from gevent.event import Event
+from psdash import inotify
+from psdash.inotify import create_inotify
+
+logger = logging.getLogger('psdash.tail')
+
+
+class TailSubscription(object):
+    """
+    The content of a log waiting to be sent to a viewer, at most
+    max_buffered bytes of it. A viewer not keeping up skips the oldest
+    content rather than holding up the other viewers of the log.
+    """
+
+    def __init__(self, tail, max_buffered):
+        self.tail = tail
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.skipped = 0
+        self.closed = False
+        self._chunks = deque()
+        self._ready = Event()
+
+    def get_free(self):
+        return self.max_buffered - self.buffered
+
+    def put(self, content):
+        if self.closed or not content:
+            return
+
+        if len(content) > self.max_buffered:
+            self.skipped += len(content) - self.max_buffered
+            content = content[-self.max_buffered:]
+        while self._chunks and self.buffered + len(content) > self.max_buffered:
+            chunk = self._chunks.popleft()
+            self.buffered -= len(chunk)
+            self.skipped += len(chunk)
+
+        self._chunks.append(content)
+        self.buffered += len(content)
+        self._ready.set()
+
+    def get(self, timeout=None):
+        """
+        Returns a tuple of (skipped, content): all of the buffered content
+        and the number of bytes skipped before it. Returns None if there
+        was no content within timeout or once closed.
+        """
+        if not self._chunks:
+            self._ready.wait(timeout)
+        if not self._chunks:
+            return None
+
+        skipped, content = self.skipped, ''.join(self._chunks)
+        self.skipped = 0
+        self.buffered = 0
+        self._chunks.clear()
+        self._ready.clear()
+        # room was made, the log can be read further
+        self.tail.wakeup()
+        return skipped, content
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+
+
+class LogTail(object):
+    """
+    Follows a log on behalf of its subscriptions. The log is read when
+    woken up by a change to the file, or every poll_interval seconds, and
+    never further than the subscription with the most free space can take:
+    the log itself is the buffer of viewers falling behind.
+    """
+
+    def __init__(self, tails, filename, position):
+        self.tails = tails
+        self.filename = filename
+        self.position = position
+        self.subscriptions = set()
+        self.closed = False
+        self._wakeup = Event()
+
+    def __repr__(self):
+        return '<LogTail filename=%s, position=%d>' % (self.filename, self.position)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def subscribe(self, max_buffered):
+        subscription = TailSubscription(self, max_buffered)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        self.subscriptions.discard(subscription)
+
+    def follow(self):
+        """
+        Reads the content appended since the last read and hands it to the
+        subscriptions. Returns False once caught up or held up by the
+        subscriptions.
+        """
+        max_bytes = max([s.get_free() for s in self.subscriptions] or [0])
+        if not max_bytes:
+            return False
+
+        max_bytes = min(max_bytes, self.tails.read_size)
+        result = self.tails.follow_log(self.filename, self.position, max_bytes)
+        self.position = result['position']
+        content = result['content']
+        for s in list(self.subscriptions):
+            s.put(content)
+        return len(content) >= max_bytes
+
+    def run(self):
+        while not self.closed:
+            self._wakeup.clear()
+            try:
+                if self.follow():
+                    # let the subscriptions be sent before reading on
+                    gevent.sleep(0)
+                    continue
+            except KeyError:
+                logger.info('%s is no longer available, closing its subscriptions', self.filename)
+                self.tails.remove(self)
+                return
+            except Exception:
+                logger.exception('Failed to follow %s', self.filename)
+
+            self.tails.watch(self)
+            self._wakeup.wait(self.tails.get_poll_interval(self))
+
+    def close(self):
+        self.closed = True
+        for s in self.subscriptions:
+            s.close()
+        self.subscriptions = set()
+        self.wakeup()
+
+
+class LogTails(object):
+    """
+    The LogTails of a node, at most one per log. When given a local node,
+    the logs are watched with inotify (where available) so that content is
+    read as soon as it's appended rather than every poll_interval.
+    """
+    DEFAULT_MAX_BUFFERED = 256 * 1024
+    DEFAULT_POLL_INTERVAL = 1
+    READ_SIZE = 64 * 1024
+    # how often a log watched through inotify is checked regardless
+    WATCHED_POLL_INTERVAL = 30
+    WATCH_EVENTS = inotify.IN_MODIFY | inotify.IN_ATTRIB | inotify.IN_MOVE_SELF | inotify.IN_DELETE_SELF
+
+    def __init__(self, node, session_key, max_buffered=DEFAULT_MAX_BUFFERED,
+                 poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=False, read_size=READ_SIZE):
+        self.node = node
+        self.session_key = session_key
+        self.max_buffered = max_buffered
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.read_size = read_size
+        # filename => LogTail
+        self.tails = {}
+        self._inotify = None
+        # watch descriptor => set of LogTails, LogTail => watch descriptor
+        self._watchers = {}
+        self._watches = {}
+
+    def follow_log(self, filename, position, max_bytes):
+        return self.node.get_service().follow_log(filename, self.session_key, position, max_bytes)
+
+    def subscribe(self, filename):
+        """
+        Returns a new TailSubscription to the content appended to the log
+        from now on. Raises KeyError if the log is not available.
+        """
+        tail = self.tails.get(filename)
+        if not tail:
+            result = self.follow_log(filename, None, 0)
+            tail = LogTail(self, filename, result['position'])
+            self.tails[filename] = tail
+            gevent.spawn(tail.run)
+            logger.debug('Following %s', filename)
+        return tail.subscribe(self.max_buffered)
+
+    def unsubscribe(self, subscription):
+        tail = subscription.tail
+        tail.unsubscribe(subscription)
+        if not tail.subscriptions:
+            self.remove(tail)
+
+    def remove(self, tail):
+        if self.tails.get(tail.filename) is tail:
+            del self.tails[tail.filename]
+            logger.debug('No longer following %s', tail.filename)
+        self._unwatch(tail)
+        tail.close()
+
+    def get_num_subscriptions(self):
+        return sum(len(t.subscriptions) for t in self.tails.itervalues())
+
+    def _get_inotify(self):
+        if not self._inotify and self.use_inotify:
+            self._inotify = create_inotify()
+            if self._inotify:
+                gevent.spawn(self._watch_worker, self._inotify)
+            else:
+                self.use_inotify = False
+        return self._inotify
+
+    def watch(self, tail):
+        """
+        Watches the file at the path of the tail's log, again every time
+        as the path is a new file once the log is rotated.
+        """
+        if tail.closed or not self._get_inotify():
+            return
+        try:
+            wd = self._inotify.add_watch(tail.filename.encode('utf-8'), self.WATCH_EVENTS)
+        except OSError as e:
+            logger.debug('Could not watch %s (%s)', tail.filename, e)
+            self._unwatch(tail)
+            return
+
+        if self._watches.get(tail) != wd:
+            self._unwatch(tail)
+            self._watches[tail] = wd
+            self._watchers.setdefault(wd, set()).add(tail)
+
+    def _unwatch(self, tail):
+        wd = self._watches.pop(tail, None)
+        if wd is None:
+            return
+        watchers = self._watchers.get(wd)
+        watchers.discard(tail)
+        if not watchers:
+            del self._watchers[wd]
+            self._inotify.rm_watch(wd)
+
+    def get_poll_interval(self, tail):
+        return self.WATCHED_POLL_INTERVAL if tail in self._watches else self.poll_interval
+
+    def close(self):
+        for tail in self.tails.values():
+            self.remove(tail)
+        if self._inotify:
+            self._inotify.close()
+            self._inotify = None
+
+    def _watch_worker(self, inotify_instance):
+        while self._inotify is inotify_instance:
+            inotify_instance.wait()
+            if self._inotify is not inotify_instance:
+                return
+            for wd, mask, _, _ in inotify_instance.read_events():
+                if mask & inotify.IN_Q_OVERFLOW:
+                    tails = list(self._watches)
+                else:
+                    tails = list(self._watchers.get(wd, ()))
+                for tail in tails:
+                    tail.wakeup()
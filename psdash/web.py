@@ -1,16 +1,31 @@
 # coding=utf-8
+import ast
+import json
 import logging
+import os
 import psutil
 import socket
 from datetime import datetime, timedelta
 import uuid
 import locale
+import time
+import msgpack
+import zerorpc
 from flask import render_template, request, session, jsonify, Response, Blueprint, current_app, g
 from werkzeug.local import LocalProxy
+from werkzeug.datastructures import ContentRange
 from psdash.helpers import socket_families, socket_types
+from psdash.events import CHANNELS
+from psdash.node import NodeUnavailable, is_unknown_method
+from psdash.process import ProcessSnapshot, query_processes
+from psdash.cache import MemoizedService
+from psdash.log import LogQuery, LogReader
 
 logger = logging.getLogger('psdash.web')
 webapp = Blueprint('psdash', __name__, static_folder='static')
+api = Blueprint('psdash_api', __name__)
+
+STREAM_KEEPALIVE_INTERVAL = 15
 
 
 def get_current_node():
@@ -18,7 +33,15 @@ def get_current_node():
 
 
 def get_current_service():
-    return get_current_node().get_service()
+    # identical calls within a request are only made once
+    if not hasattr(g, 'service'):
+        g.service = MemoizedService(
+            get_current_node().get_service(),
+            g.node,
+            current_app.psdash.service_cache,
+            current_app.config.get('PSDASH_SERVICE_CACHE_TTLS')
+        )
+    return g.service
 
 
 current_node = LocalProxy(get_current_node)
@@ -30,6 +53,91 @@ def fromtimestamp(value, dateformat='%Y-%m-%d %H:%M:%S'):
     return dt.strftime(dateformat)
 
 
+def sparkline_points(values, width=120, height=20):
+    """
+    Returns the points of an svg polyline of values, scaled to fit width
+    and height with the highest value at the top.
+    """
+    if not values:
+        return ''
+    step = float(width) / max(len(values) - 1, 1)
+    top = max(max(values), 1)
+    return ' '.join('%.1f,%.1f' % (i * step, height - float(v) / top * height) for i, v in enumerate(values))
+
+
+def get_connection_filters():
+    # {'key', 'default_value'}
+    # An empty string means that no filtering will take place on that key
+    form_keys = {
+        'pid': '', 
+        'family': socket_families[socket.AF_INET],
+        'type': socket_types[socket.SOCK_STREAM],
+        'state': 'LISTEN'
+    }
+
+    form_values = dict((k, request.args.get(k, default_val)) for k, default_val in form_keys.iteritems())
+
+    for k in ('local_addr', 'remote_addr'):
+        val = request.args.get(k, '')
+        if ':' in val:
+            host, port = val.rsplit(':', 1)
+            form_values[k + '_host'] = host
+            form_values[k + '_port'] = int(port)
+        elif val:
+            form_values[k + '_host'] = val
+
+    return form_values
+
+
+def batch_call(*calls):
+    """
+    Makes the given service calls in a single round trip to the node, returning
+    the results in the same order. Each call is a (method name, args) tuple.
+    The sysinfo shown in the page header is fetched along with them.
+    """
+    return current_service.batch([('get_sysinfo', ())] + list(calls))[1:]
+
+
+def query_process_list(*args):
+    """
+    Returns a page of the process list, queried on the node, or here for an
+    agent from before it could.
+    """
+    try:
+        result, = batch_call(('query_process_list', args))
+    except zerorpc.RemoteError as e:
+        if not is_unknown_method(e):
+            raise
+        snapshot = ProcessSnapshot(current_service.get_process_list(), time.time())
+        result = query_processes(snapshot, *args)
+    return result
+
+
+def get_log_metrics(filenames, minutes):
+    """
+    Returns the log metrics of the node, none for an agent from before
+    there were log metrics.
+    """
+    try:
+        return current_service.get_log_metrics(filenames, minutes)
+    except zerorpc.RemoteError as e:
+        if not is_unknown_method(e):
+            raise
+        return []
+
+
+def get_process_environment(pid, penviron=None):
+    if penviron is None:
+        penviron = current_service.get_process_environment(pid)
+
+    whitelist = current_app.config.get('PSDASH_ENVIRON_WHITELIST')
+    if whitelist:
+        penviron = dict((k, v if k in whitelist else '*hidden by whitelist*') 
+                         for k, v in penviron.iteritems())
+
+    return penviron
+
+
 @webapp.context_processor
 def inject_nodes():
     return {"current_node": current_node, "nodes": current_app.psdash.get_nodes()}
@@ -37,7 +145,10 @@ def inject_nodes():
 
 @webapp.context_processor
 def inject_header_data():
-    sysinfo = current_service.get_sysinfo()
+    try:
+        sysinfo = current_service.get_sysinfo()
+    except NodeUnavailable:
+        return {'os': '', 'hostname': current_node.name, 'uptime': 'unknown'}
     uptime = timedelta(seconds=sysinfo['uptime'])
     uptime = str(uptime).split('.')[0]
     return {
@@ -52,11 +163,13 @@ def add_node(endpoint, values):
 
 
 @webapp.before_request
+@api.before_request
 def add_node():
     g.node = request.args.get('node', current_app.psdash.LOCAL_NODE)
 
 
 @webapp.before_request
+@api.before_request
 def check_access():
     if not current_node:
         return 'Unknown psdash node specified', 404
@@ -103,21 +216,34 @@ def access_denied(e):
     return render_template('error.html', error=errmsg), 404
 
 
+@webapp.errorhandler(NodeUnavailable)
+def node_unavailable(e):
+    return render_template('error.html', error=str(e)), 503
+
+
 @webapp.route('/')
 def index():
+    netifs, memory, swap, disks, cpu, users = batch_call(
+        ('get_network_interfaces', ()),
+        ('get_memory', ()),
+        ('get_swap_space', ()),
+        ('get_disks', ()),
+        ('get_cpu', ()),
+        ('get_users', ())
+    )
     sysinfo = current_service.get_sysinfo()
 
-    netifs = current_service.get_network_interfaces().values()
+    netifs = netifs.values()
     netifs.sort(key=lambda x: x.get('bytes_sent'), reverse=True)
 
     data = {
         'load_avg': sysinfo['load_avg'],
         'num_cpus': sysinfo['num_cpus'],
-        'memory': current_service.get_memory(),
-        'swap': current_service.get_swap_space(),
-        'disks': current_service.get_disks(),
-        'cpu': current_service.get_cpu(),
-        'users': current_service.get_users(),
+        'memory': memory,
+        'swap': swap,
+        'disks': disks,
+        'cpu': cpu,
+        'users': users,
         'net_interfaces': netifs,
         'page': 'overview',
         'is_xhr': request.is_xhr
@@ -131,27 +257,27 @@ def index():
 @webapp.route('/processes/<string:sort>/<string:order>')
 @webapp.route('/processes/<string:sort>/<string:order>/<string:filter>')
 def processes(sort='pid', order='asc', filter='user'):
-    procs = current_service.get_process_list()
-    num_procs = len(procs)
-
-    user_procs = [p for p in procs if p['user'] != 'root']
-    num_user_procs = len(user_procs)
-    if filter == 'user':
-        procs = user_procs
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = request.args.get('limit', current_app.config.get('PSDASH_PROCESSES_PER_PAGE',
+                                                             current_app.psdash.DEFAULT_PROCESSES_PER_PAGE), type=int)
+    if limit <= 0:
+        limit = None
+    text = request.args.get('q', '').strip()
 
-    procs.sort(
-        key=lambda x: x.get(sort),
-        reverse=True if order != 'asc' else False
-    )
+    result = query_process_list(sort, order, offset, limit, filter, text)
 
     return render_template(
         'processes.html',
-        processes=procs,
+        processes=result['processes'],
         sort=sort,
         order=order,
         filter=filter,
-        num_procs=num_procs,
-        num_user_procs=num_user_procs,
+        offset=offset,
+        limit=limit,
+        q=text,
+        num_matches=result['num_matches'],
+        num_procs=result['num_procs'],
+        num_user_procs=result['num_user_procs'],
         page='processes',
         is_xhr=request.is_xhr
     )
@@ -175,34 +301,33 @@ def process(pid, section):
         errmsg = 'Invalid subsection when trying to view process %d' % pid
         return render_template('error.html', error=errmsg), 404
 
+    # section => (service method, template variable)
+    section_calls = {
+        'environment': ('get_process_environment', 'process_environ'),
+        'threads': ('get_process_threads', 'threads'),
+        'files': ('get_process_open_files', 'files'),
+        'connections': ('get_process_connections', 'connections'),
+        'memory': ('get_process_memory_maps', 'memory_maps'),
+        'children': ('get_process_children', 'children'),
+        'limits': ('get_process_limits', 'limits')
+    }
+
+    calls = [('get_process', (pid,))]
+    if section in section_calls:
+        calls.append((section_calls[section][0], (pid,)))
+    results = batch_call(*calls)
+
     context = {
-        'process': current_service.get_process(pid),
+        'process': results[0],
         'section': section,
         'page': 'processes',
         'is_xhr': request.is_xhr
     }
 
     if section == 'environment':
-        penviron = current_service.get_process_environment(pid)
-
-        whitelist = current_app.config.get('PSDASH_ENVIRON_WHITELIST')
-        if whitelist:
-            penviron = dict((k, v if k in whitelist else '*hidden by whitelist*') 
-                             for k, v in penviron.iteritems())
-
-        context['process_environ'] = penviron
-    elif section == 'threads':
-        context['threads'] = current_service.get_process_threads(pid)
-    elif section == 'files':
-        context['files'] = current_service.get_process_open_files(pid)
-    elif section == 'connections':
-        context['connections'] = current_service.get_process_connections(pid)
-    elif section == 'memory':
-        context['memory_maps'] = current_service.get_process_memory_maps(pid)
-    elif section == 'children':
-        context['children'] = current_service.get_process_children(pid)
-    elif section == 'limits':
-        context['limits'] = current_service.get_process_limits(pid)
+        context['process_environ'] = get_process_environment(pid, results[1])
+    elif section in section_calls:
+        context[section_calls[section][1]] = results[1]
 
     return render_template(
         'process/%s.html' % section,
@@ -212,31 +337,14 @@ def process(pid, section):
 
 @webapp.route('/network')
 def view_networks():
-    netifs = current_service.get_network_interfaces().values()
+    form_values = get_connection_filters()
+    netifs, conns = batch_call(
+        ('get_network_interfaces', ()),
+        ('get_connections', (form_values,))
+    )
+    netifs = netifs.values()
     netifs.sort(key=lambda x: x.get('bytes_sent'), reverse=True)
-
-    # {'key', 'default_value'}
-    # An empty string means that no filtering will take place on that key
-    form_keys = {
-        'pid': '', 
-        'family': socket_families[socket.AF_INET],
-        'type': socket_types[socket.SOCK_STREAM],
-        'state': 'LISTEN'
-    }
-
-    form_values = dict((k, request.args.get(k, default_val)) for k, default_val in form_keys.iteritems())
-
-    for k in ('local_addr', 'remote_addr'):
-        val = request.args.get(k, '')
-        if ':' in val:
-            host, port = val.rsplit(':', 1)
-            form_values[k + '_host'] = host
-            form_values[k + '_port'] = int(port)
-        elif val:
-            form_values[k + '_host'] = val
-
-    conns = current_service.get_connections(form_values)
-    conns.sort(key=lambda x: x['state'])
+    conns = sorted(conns, key=lambda x: x['state'])
 
     states = [
         'ESTABLISHED', 'SYN_SENT', 'SYN_RECV',
@@ -261,8 +369,11 @@ def view_networks():
 
 @webapp.route('/disks')
 def view_disks():
-    disks = current_service.get_disks(all_partitions=True)
-    io_counters = current_service.get_disks_counters().items()
+    disks, io_counters = batch_call(
+        ('get_disks', (True,)),
+        ('get_disks_counters', ())
+    )
+    io_counters = io_counters.items()
     io_counters.sort(key=lambda x: x[1]['read_count'], reverse=True)
     return render_template(
         'disks.html',
@@ -275,13 +386,20 @@ def view_disks():
 
 @webapp.route('/logs')
 def view_logs():
-    available_logs = current_service.get_logs()
-    available_logs.sort(cmp=lambda x1, x2: locale.strcoll(x1['path'], x2['path']))
+    try:
+        available_logs, log_metrics = batch_call(('get_logs', ()), ('get_log_metrics', (None, LOG_METRICS_MINUTES)))
+    except zerorpc.RemoteError as e:
+        if not is_unknown_method(e):
+            raise
+        # an agent from before there were log metrics
+        available_logs, log_metrics = current_service.get_logs(), []
+    available_logs = sorted(available_logs, cmp=lambda x1, x2: locale.strcoll(x1['path'], x2['path']))
 
     return render_template(
         'logs.html',
         page='logs',
         logs=available_logs,
+        log_metrics=dict((m['filename'], m) for m in log_metrics),
         is_xhr=request.is_xhr
     )
 
@@ -293,7 +411,7 @@ def view_log():
     session_key = session.get('client_id')
 
     try:
-        content = current_service.read_log(filename, session_key=session_key, seek_tail=seek_tail)
+        content = current_service.read_log(filename, session_key, seek_tail)
     except KeyError:
         error_msg = 'File not found. Only files passed through args are allowed.'
         if request.is_xhr:
@@ -313,12 +431,179 @@ def search_log():
     session_key = session.get('client_id')
 
     try:
-        data = current_service.search_log(filename, query_text, session_key=session_key)
+        data = current_service.search_log(filename, query_text, session_key)
         return jsonify(data)
     except KeyError:
         return 'Could not find log file with given filename', 404
 
 
+@webapp.route('/log/download')
+def download_log():
+    filename = request.args['filename']
+    # not through current_service, the chunks are not to be kept for the request
+    service = current_node.get_service()
+    try:
+        size = service.read_log_file(filename, 0, 0)['size']
+    except KeyError:
+        return render_template('error.html', error='Could not find log file with given filename'), 404
+
+    status = 200
+    start, end = 0, size
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'Content-Disposition': 'attachment; filename="%s"' % os.path.basename(filename).encode('utf-8')
+    }
+    # multiple ranges are not supported, the whole log is sent instead
+    if request.range and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if not byte_range:
+            headers['Content-Range'] = 'bytes */%d' % size
+            return Response('', 416, headers=headers)
+        start, end = byte_range
+        status = 206
+        headers['Content-Range'] = ContentRange('bytes', start, end, size).to_header()
+    headers['Content-Length'] = str(end - start)
+
+    def generate():
+        offset = start
+        while offset < end:
+            content = service.read_log_file(filename, offset, min(LOG_DOWNLOAD_CHUNK_SIZE, end - offset))['content']
+            if not content:
+                # truncated since
+                break
+            offset += len(content)
+            yield content
+
+    return Response(generate(), status, headers=headers, mimetype='application/octet-stream')
+
+
+MAX_LOG_MATCHES = 500
+MAX_LOG_CONTEXT = 20
+MAX_LOG_LINES = 1000
+LOG_METRICS_MINUTES = 60
+MAX_LOG_METRICS_MINUTES = 24 * 60
+MAX_LOG_RANGE = 1024 * 1024
+LOG_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def get_log_query_args():
+    """
+    Returns a tuple of the LogQuery (as a dict), limit and number of context
+    lines given by the request args. Raises ValueError on invalid args.
+    """
+    query = LogQuery(
+        request.args.getlist('q'),
+        mode=request.args.get('mode', LogQuery.ANY),
+        regex=request.args.get('regex', '0') == '1',
+        ignore_case=request.args.get('ignore_case', '0') == '1'
+    )
+    limit = min(request.args.get('limit', 50, type=int), MAX_LOG_MATCHES)
+    context = min(request.args.get('context', 0, type=int), MAX_LOG_CONTEXT)
+    if limit < 1 or context < 0:
+        raise ValueError('Invalid limit or context')
+    return query.to_dict(), limit, context
+
+
+def decode_log_matches(matches):
+    for m in matches:
+        m['line'] = m['line'].decode('utf-8', 'replace')
+        m['before'] = [l.decode('utf-8', 'replace') for l in m['before']]
+        m['after'] = [l.decode('utf-8', 'replace') for l in m['after']]
+
+
+def query_log():
+    """
+    Returns the page of matching lines of the log searched for by the
+    request args, with the lines decoded. Raises ValueError on invalid args.
+    """
+    filename = request.args['filename']
+    query, limit, context = get_log_query_args()
+    before = request.args.get('before', type=int)
+
+    result = current_service.query_log(filename, query, before, limit, context)
+    decode_log_matches(result['matches'])
+    return result
+
+
+def query_merged_logs():
+    """
+    Like query_log() for several logs. The position to continue from is
+    passed in `before` as a comma separated list of a position per log,
+    where - is for a log that has no more matches.
+    """
+    filenames = request.args.getlist('filename')
+    if not filenames:
+        raise ValueError('No logs given')
+    query, limit, context = get_log_query_args()
+
+    cursors = None
+    if request.args.get('before'):
+        cursors = [-1 if p == '-' else int(p) for p in request.args['before'].split(',')]
+        if len(cursors) != len(filenames):
+            raise ValueError('Expected a position per log to continue from')
+
+    result = current_service.query_merged_logs(filenames, query, cursors, limit, context)
+    decode_log_matches(result['matches'])
+    if all(c == -1 for c in result['next']):
+        result['next'] = None
+    else:
+        result['next'] = ','.join('-' if c == -1 else str(c) for c in result['next'])
+    return result
+
+
+@webapp.route('/log/matches')
+def search_log_lines():
+    try:
+        return jsonify(query_log())
+    except ValueError as e:
+        return str(e), 400
+    except KeyError:
+        return 'Could not find log file with given filename', 404
+
+
+@webapp.route('/log/merged')
+def view_merged_log():
+    filenames = request.args.getlist('filename')
+    seek_tail = request.args.get('seek_tail', '1') != '0'
+    session_key = session.get('client_id')
+
+    try:
+        lines = current_service.read_merged_logs(filenames, session_key, seek_tail)
+    except KeyError:
+        error_msg = 'File not found. Only files passed through args are allowed.'
+        if request.is_xhr:
+            return error_msg
+        return render_template('error.html', error=error_msg), 404
+
+    content = ''.join('[%s] %s\n' % (os.path.basename(filename), line) for _, filename, line in lines)
+    if request.is_xhr:
+        return content
+
+    return render_template('log.html', content=content, filenames=filenames)
+
+
+@webapp.route('/log/merged/matches')
+def search_merged_log_lines():
+    try:
+        return jsonify(query_merged_logs())
+    except ValueError as e:
+        return str(e), 400
+    except KeyError:
+        return 'Could not find log file with given filename', 404
+
+
+@webapp.route('/cluster')
+def view_cluster():
+    nodes = current_app.psdash.cluster_overview.query(current_app.psdash.get_nodes())
+    return render_template(
+        'cluster.html',
+        cluster_nodes=nodes,
+        num_ok=sum(1 for n in nodes if n['status'] == 'ok'),
+        page='cluster',
+        is_xhr=request.is_xhr
+    )
+
+
 @webapp.route('/register')
 def register_node():
     name = request.args['name']
@@ -327,3 +612,299 @@ def register_node():
 
     current_app.psdash.register_node(name, host, port)
     return jsonify({'status': 'OK'})
+
+
+@webapp.route('/push', methods=['POST'])
+def push_node():
+    name = request.args['name']
+    port = request.args['port']
+    host = request.remote_addr
+
+    try:
+        data = msgpack.unpackb(request.get_data())
+        calls = [(method, args, result) for method, args, result in data['calls']]
+        interval = float(data['interval'])
+    except (ValueError, TypeError, KeyError):
+        return 'Invalid push data', 400
+
+    node = current_app.psdash.register_node(name, host, port)
+    node.update_pushed(calls, interval)
+    return jsonify({'status': 'OK'})
+
+
+def api_response(data):
+    """
+    Returns data as compact json, tagged with an ETag so that polling clients
+    sending If-None-Match get an empty 304 response when nothing has changed.
+    """
+    resp = Response(json.dumps(data, separators=(',', ':')), mimetype='application/json')
+    resp.add_etag()
+    return resp.make_conditional(request)
+
+
+@api.errorhandler(psutil.AccessDenied)
+def api_access_denied(e):
+    errmsg = 'Access denied to %s (pid %d).' % (e.name, e.pid)
+    return api_response({'error': errmsg}), 401
+
+
+@api.errorhandler(psutil.NoSuchProcess)
+def api_no_such_process(e):
+    errmsg = 'No process with pid %d was found.' % e.pid
+    return api_response({'error': errmsg}), 404
+
+
+@api.errorhandler(NodeUnavailable)
+def api_node_unavailable(e):
+    return api_response({'error': str(e)}), 503
+
+
+@api.errorhandler(zerorpc.RemoteError)
+def api_remote_error(e):
+    # the KeyError and ValueError of a remote node are answered as they are here
+    if e.name == 'KeyError':
+        # str() of a KeyError is the repr of its message
+        try:
+            msg = ast.literal_eval(e.msg)
+        except (ValueError, SyntaxError):
+            msg = e.msg
+        return api_response({'error': msg}), 404
+    if e.name == 'ValueError':
+        return api_response({'error': e.msg}), 400
+    raise
+
+
+@api.route('/sysinfo')
+def api_sysinfo():
+    return api_response(current_service.get_sysinfo())
+
+
+@api.route('/memory')
+def api_memory():
+    return api_response(current_service.get_memory())
+
+
+@api.route('/swap')
+def api_swap():
+    return api_response(current_service.get_swap_space())
+
+
+@api.route('/cpu')
+def api_cpu():
+    return api_response(current_service.get_cpu())
+
+
+@api.route('/cpu/cores')
+def api_cpu_cores():
+    return api_response(current_service.get_cpu_cores())
+
+
+@api.route('/disks')
+def api_disks():
+    all_partitions = request.args.get('all', '0') != '0'
+    return api_response(current_service.get_disks(all_partitions))
+
+
+@api.route('/disks/counters')
+def api_disks_counters():
+    return api_response(current_service.get_disks_counters())
+
+
+@api.route('/users')
+def api_users():
+    return api_response(current_service.get_users())
+
+
+@api.route('/network')
+def api_network():
+    return api_response(current_service.get_network_interfaces())
+
+
+@api.route('/connections')
+def api_connections():
+    return api_response(current_service.get_connections(get_connection_filters()))
+
+
+@api.route('/processes')
+def api_processes():
+    # the arguments are passed by position as keyword arguments can't be passed through RPC
+    result = query_process_list(
+        request.args.get('sort', 'cpu_percent'),
+        request.args.get('order', 'desc'),
+        max(request.args.get('offset', 0, type=int), 0),
+        request.args.get('limit', None, type=int),
+        request.args.get('filter', 'all'),
+        request.args.get('q', '').strip()
+    )
+    return api_response(result)
+
+
+@api.route('/processes/<int:pid>')
+def api_process(pid):
+    return api_response(current_service.get_process(pid))
+
+
+@api.route('/processes/<int:pid>/<string:section>')
+def api_process_section(pid, section):
+    sections = {
+        'threads': current_service.get_process_threads,
+        'files': current_service.get_process_open_files,
+        'connections': current_service.get_process_connections,
+        'memory': current_service.get_process_memory_maps,
+        'children': current_service.get_process_children,
+        'limits': current_service.get_process_limits,
+        'environment': get_process_environment
+    }
+
+    if section not in sections:
+        errmsg = 'Invalid subsection when trying to view process %d' % pid
+        return api_response({'error': errmsg}), 404
+
+    return api_response(sections[section](pid))
+
+
+@api.route('/logs')
+def api_logs():
+    return api_response(current_service.get_logs())
+
+
+@api.route('/logs/stats')
+def api_logs_stats():
+    return api_response(current_service.get_log_stats())
+
+
+@api.route('/logs/search')
+def api_logs_search():
+    try:
+        return api_response(query_log())
+    except ValueError as e:
+        return api_response({'error': str(e)}), 400
+    except KeyError:
+        return api_response({'error': 'Could not find log file with given filename'}), 404
+
+
+@api.route('/logs/merged/search')
+def api_logs_merged_search():
+    try:
+        return api_response(query_merged_logs())
+    except ValueError as e:
+        return api_response({'error': str(e)}), 400
+    except KeyError:
+        return api_response({'error': 'Could not find log file with given filename'}), 404
+
+
+@api.route('/logs/metrics')
+def api_logs_metrics():
+    filenames = request.args.getlist('filename') or None
+    minutes = request.args.get('minutes', LOG_METRICS_MINUTES, type=int)
+    if not 0 < minutes <= MAX_LOG_METRICS_MINUTES:
+        return api_response({'error': 'minutes must be between 1 and %d' % MAX_LOG_METRICS_MINUTES}), 400
+    return api_response(get_log_metrics(filenames, minutes))
+
+
+@api.route('/logs/lines')
+def api_logs_lines():
+    filename = request.args['filename']
+    start = request.args.get('start', 0, type=int)
+    count = min(request.args.get('count', 100, type=int), MAX_LOG_LINES)
+    try:
+        result = current_service.read_log_lines(filename, start, count)
+    except ValueError as e:
+        return api_response({'error': str(e)}), 400
+    except KeyError:
+        return api_response({'error': 'Could not find log file with given filename'}), 404
+    result['lines'] = [l.decode('utf-8', 'replace') for l in result['lines']]
+    return api_response(result)
+
+
+@api.route('/logs/range')
+def api_logs_range():
+    filename = request.args['filename']
+    offset = request.args.get('offset', 0, type=int)
+    length = min(request.args.get('length', LogReader.BUFFER_SIZE, type=int), MAX_LOG_RANGE)
+    try:
+        result = current_service.read_log_range(filename, offset, length)
+    except ValueError as e:
+        return api_response({'error': str(e)}), 400
+    except KeyError:
+        return api_response({'error': 'Could not find log file with given filename'}), 404
+    result['content'] = result['content'].decode('utf-8', 'replace')
+    return api_response(result)
+
+
+@api.route('/logs/tail')
+def api_logs_tail():
+    filename = request.args['filename']
+    tails = current_app.psdash.get_log_tails(g.node)
+    try:
+        subscription = tails.subscribe(filename)
+    except KeyError:
+        return api_response({'error': 'Could not find log file with given filename'}), 404
+
+    def stream():
+        try:
+            while not subscription.closed:
+                appended = subscription.get(timeout=STREAM_KEEPALIVE_INTERVAL)
+                if not appended:
+                    yield ':\n\n'
+                    continue
+                skipped, content = appended
+                data = {'skipped': skipped, 'content': content.decode('utf-8', 'replace')}
+                yield 'event: append\ndata: %s\n\n' % json.dumps(data, separators=(',', ':'))
+            # the log is no longer available
+            yield 'event: end\ndata: {}\n\n'
+        finally:
+            tails.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@api.route('/cluster')
+def api_cluster():
+    return api_response(current_app.psdash.cluster_overview.query(current_app.psdash.get_nodes()))
+
+
+@api.route('/stream')
+def api_stream():
+    channels = request.args.get('channels', 'overview,network').split(',')
+    unknown = [c for c in channels if c not in CHANNELS]
+    if unknown:
+        return api_response({'error': 'Unknown channel(s): %s' % ', '.join(unknown)}), 400
+
+    publisher = current_app.psdash.get_publisher(g.node)
+    subscription = publisher.subscribe(channels)
+
+    def stream():
+        try:
+            while not subscription.closed:
+                event = subscription.get(timeout=STREAM_KEEPALIVE_INTERVAL)
+                if not event:
+                    # a comment line, keeps proxies from timing out the connection
+                    yield ':\n\n'
+                    continue
+                channel, data = event
+                yield 'event: %s\ndata: %s\n\n' % (channel, json.dumps(data, separators=(',', ':')))
+        finally:
+            publisher.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@api.route('/history')
+def api_history_names():
+    return api_response(current_service.get_metric_names())
+
+
+@api.route('/history/<string:name>')
+def api_history(name):
+    try:
+        history = current_service.get_metric_history(
+            name,
+            request.args.get('resolution', None, type=int),
+            request.args.get('start', None, type=float),
+            request.args.get('end', None, type=float)
+        )
+    except KeyError as e:
+        # str() of a KeyError is the repr of its message
+        return api_response({'error': e.args[0]}), 404
+    return api_response(history)
@@ -0,0 +1,117 @@
+# coding=utf-8
+"""
+A columnar encoding for lists of dicts, such as the process list, to cut down
+on the bytes sent between agent and web nodes. Instead of repeating the keys
+of every row, each key is sent once together with all of its values: numbers
+as packed arrays and strings as indexes into a table of the distinct strings.
+"""
+import struct
+import zlib
+import msgpack
+
+PLAIN = 'plain'
+COLUMNS = 'columns'
+COLUMNS_ZLIB = 'columns-zlib'
+WIRE_FORMATS = (PLAIN, COLUMNS, COLUMNS_ZLIB)
+
+COLUMNS_KEY = '__columns__'
+ZLIB_KEY = '__zlib__'
+
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+
+def _pack(typecode, values):
+    return struct.pack('<%d%s' % (len(values), typecode), *values)
+
+
+def _unpack(typecode, data):
+    return struct.unpack('<%d%s' % (len(data) // struct.calcsize(typecode), typecode), data)
+
+
+def _get_column_type(values):
+    # bools are ints too, but they have to come back as bools
+    if all(type(v) in (int, long) and _INT_MIN <= v <= _INT_MAX for v in values):
+        return 'q'
+    if all(type(v) is float for v in values):
+        return 'd'
+    if all(v is None or type(v) is str for v in values):
+        return 's'
+    return 'o'
+
+
+def _encode_column(values):
+    column_type = _get_column_type(values)
+    if column_type in ('q', 'd'):
+        return column_type, _pack(column_type, values)
+    if column_type == 's':
+        strings = {}
+        indexes = [strings.setdefault(v, len(strings)) for v in values]
+        table = sorted(strings, key=strings.get)
+        return column_type, [table, _pack('I', indexes)]
+    return column_type, list(values)
+
+
+def _decode_column(column_type, data):
+    if column_type in ('q', 'd'):
+        return list(_unpack(column_type, data))
+    if column_type == 's':
+        table, indexes = data
+        return [table[i] for i in _unpack('I', indexes)]
+    return data
+
+
+def encode_rows(rows):
+    fields = sorted(set(k for row in rows for k in row))
+    columns = []
+    for name in fields:
+        column_type, data = _encode_column([row.get(name) for row in rows])
+        columns.append([name, column_type, data])
+    return {COLUMNS_KEY: len(rows), 'columns': columns}
+
+
+def decode_rows(encoded):
+    if not encoded[COLUMNS_KEY]:
+        return []
+    names = [name for name, _, _ in encoded['columns']]
+    values = [_decode_column(column_type, data) for _, column_type, data in encoded['columns']]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+def _is_rows(value):
+    return isinstance(value, list) and value and all(isinstance(v, dict) for v in value)
+
+
+def encode_result(value, wire_format):
+    """
+    Encodes the lists of dicts in value, either value itself or the values of
+    value when it is a dict, in the given wire format.
+    """
+    if wire_format == PLAIN:
+        return value
+
+    if _is_rows(value):
+        encoded = encode_rows(value)
+    elif isinstance(value, dict) and any(_is_rows(v) for v in value.itervalues()):
+        encoded = dict((k, encode_rows(v) if _is_rows(v) else v) for k, v in value.iteritems())
+    else:
+        return value
+
+    if wire_format == COLUMNS_ZLIB:
+        return {ZLIB_KEY: zlib.compress(msgpack.packb(encoded))}
+    return encoded
+
+
+def decode_result(value):
+    """
+    Decodes a value encoded by encode_result(), in any of the wire formats.
+    """
+    if not isinstance(value, dict):
+        return value
+
+    if ZLIB_KEY in value:
+        value = msgpack.unpackb(zlib.decompress(value[ZLIB_KEY]))
+    if COLUMNS_KEY in value:
+        return decode_rows(value)
+    return dict((k, decode_rows(v) if isinstance(v, dict) and COLUMNS_KEY in v else v)
+                for k, v in value.iteritems())
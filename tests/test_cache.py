@@ -0,0 +1,100 @@
+import time
+import unittest2
+from psdash.cache import TTLCache, MemoizedService
+
+
+class CountingService(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_sysinfo(self):
+        self.calls.append('get_sysinfo')
+        return {'hostname': 'test'}
+
+    def get_disks(self, all_partitions=False):
+        self.calls.append('get_disks')
+        return [all_partitions]
+
+    def get_connections(self, filters=None):
+        self.calls.append('get_connections')
+        return [filters]
+
+    def batch(self, calls):
+        self.calls.append('batch')
+        return [getattr(self, name)(*args) for name, args in calls]
+
+
+class TestTTLCache(unittest2.TestCase):
+    def test_get_and_set(self):
+        cache = TTLCache()
+        self.assertEqual(cache.get('a'), (False, None))
+        cache.set('a', 1, 10)
+        self.assertEqual(cache.get('a'), (True, 1))
+
+    def test_expires(self):
+        cache = TTLCache()
+        cache.set('a', 1, 0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), (False, None))
+
+    def test_purges_expired_when_full(self):
+        cache = TTLCache(max_entries=2)
+        cache.set('a', 1, -1)
+        cache.set('b', 2, 10)
+        cache.set('c', 3, 10)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('b'), (True, 2))
+
+
+class TestMemoizedService(unittest2.TestCase):
+    def setUp(self):
+        self.service = CountingService()
+        self.shared_cache = TTLCache()
+
+    def _memoized(self):
+        return MemoizedService(self.service, 'localhost', self.shared_cache)
+
+    def test_identical_calls_are_made_once(self):
+        memoized = self._memoized()
+        self.assertIs(memoized.get_sysinfo(), memoized.get_sysinfo())
+        self.assertEqual(self.service.calls, ['get_sysinfo'])
+
+    def test_different_args_are_separate(self):
+        memoized = self._memoized()
+        self.assertEqual(memoized.get_disks(True), [True])
+        self.assertEqual(memoized.get_disks(False), [False])
+        self.assertEqual(self.service.calls, ['get_disks', 'get_disks'])
+
+    def test_unhashable_args(self):
+        memoized = self._memoized()
+        memoized.get_connections({'state': 'LISTEN', 'pid': ''})
+        memoized.get_connections({'pid': '', 'state': 'LISTEN'})
+        self.assertEqual(self.service.calls, ['get_connections'])
+
+    def test_memoization_is_per_instance(self):
+        self._memoized().get_sysinfo()
+        self._memoized().get_sysinfo()
+        self.assertEqual(self.service.calls, ['get_sysinfo', 'get_sysinfo'])
+
+    def test_ttl_methods_are_shared(self):
+        self._memoized().get_disks()
+        self._memoized().get_disks()
+        self.assertEqual(self.service.calls, ['get_disks'])
+
+    def test_shared_cache_is_per_node(self):
+        self._memoized().get_disks()
+        MemoizedService(self.service, 'othernode', self.shared_cache).get_disks()
+        self.assertEqual(self.service.calls, ['get_disks', 'get_disks'])
+
+    def test_batch_only_passes_uncached_calls(self):
+        memoized = self._memoized()
+        memoized.get_sysinfo()
+        results = memoized.batch([('get_sysinfo', ()), ('get_disks', (True,)), ('get_disks', (True,))])
+        self.assertEqual(results, [{'hostname': 'test'}, [True], [True]])
+        self.assertEqual(self.service.calls, ['get_sysinfo', 'batch', 'get_disks'])
+
+    def test_batch_fully_cached(self):
+        memoized = self._memoized()
+        memoized.get_sysinfo()
+        memoized.batch([('get_sysinfo', ())])
+        self.assertEqual(self.service.calls, ['get_sysinfo'])
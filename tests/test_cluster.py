@@ -0,0 +1,83 @@
+import gevent
+import time
+import unittest2
+from psdash.cluster import ClusterOverview
+from psdash.node import LocalNode
+
+
+class SlowService(object):
+    def __init__(self, service, delay):
+        self.service = service
+        self.delay = delay
+
+    def __getattr__(self, name):
+        gevent.sleep(self.delay)
+        return getattr(self.service, name)
+
+
+class FailingService(object):
+    def batch(self, calls):
+        raise IOError('Connection refused')
+
+
+class FakeNode(object):
+    def __init__(self, name, service):
+        self.name = name
+        self.service = service
+
+    def get_service(self):
+        return self.service
+
+
+class TestClusterOverview(unittest2.TestCase):
+    def setUp(self):
+        self.local = LocalNode()
+        self.cluster = ClusterOverview(timeout=0.2, cache_ttl=0)
+
+    def _node(self, delay=0):
+        return FakeNode('node', SlowService(self.local.get_service(), delay))
+
+    def _by_id(self, entries):
+        return dict((e['id'], e) for e in entries)
+
+    def test_query(self):
+        entries = self.cluster.query({'b': self._node(), 'a': self.local})
+        self.assertEqual([e['id'] for e in entries], ['a', 'b'])
+        for e in entries:
+            self.assertEqual(e['status'], 'ok')
+            self.assertIn('load_avg', e['summary'])
+
+    def test_nodes_are_queried_in_parallel(self):
+        nodes = dict(('node%d' % i, self._node(0.02)) for i in range(10))
+        started = time.time()
+        entries = self.cluster.query(nodes)
+        # each node takes 0.1 seconds to respond, as 5 calls of 0.02 seconds are made
+        self.assertLess(time.time() - started, 0.5)
+        self.assertTrue(all(e['status'] == 'ok' for e in entries))
+
+    def test_slow_node_gives_partial_result(self):
+        entries = self._by_id(self.cluster.query({'fast': self._node(), 'slow': self._node(1)}))
+        self.assertEqual(entries['fast']['status'], 'ok')
+        self.assertEqual(entries['slow']['status'], 'timeout')
+        self.assertIsNone(entries['slow']['summary'])
+
+    def test_last_response_is_kept(self):
+        node = self._node()
+        self.cluster.query({'n': node})
+        node.service.delay = 1
+        entry = self.cluster.query({'n': node})[0]
+        self.assertEqual(entry['status'], 'timeout')
+        self.assertIn('hostname', entry['summary'])
+        self.assertTrue(entry['updated'])
+
+    def test_failing_node(self):
+        entry = self.cluster.query({'n': FakeNode('n', FailingService())})[0]
+        self.assertEqual(entry['status'], 'error')
+        self.assertIn('Connection refused', entry['error'])
+
+    def test_cached_response_is_reused(self):
+        cluster = ClusterOverview(timeout=0.2, cache_ttl=60)
+        node = self._node()
+        cluster.query({'n': node})
+        node.service = FailingService()
+        self.assertEqual(cluster.query({'n': node})[0]['status'], 'ok')
@@ -0,0 +1,261 @@
+# coding=utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest2
+from psdash.discovery import LogDiscovery, LogPattern, pattern_to_regex
+from psdash.inotify import create_inotify
+from psdash.log import Logs
+
+
+class TestLogPattern(unittest2.TestCase):
+    def test_regex(self):
+        regex = pattern_to_regex('/var/log/*.log')
+        self.assertTrue(regex.match('/var/log/syslog.log'))
+        self.assertFalse(regex.match('/var/log/nginx/access.log'))
+        self.assertFalse(regex.match('/var/log/syslog.log.1'))
+
+    def test_regex_recursive(self):
+        regex = pattern_to_regex('/var/log/**/*.log')
+        self.assertTrue(regex.match('/var/log/syslog.log'))
+        self.assertTrue(regex.match('/var/log/nginx/access.log'))
+        self.assertTrue(regex.match('/var/log/a/b/c.log'))
+        self.assertFalse(regex.match('/var/lib/a.log'))
+
+    def test_regex_classes(self):
+        regex = pattern_to_regex('/var/log/app-?.[0-9]')
+        self.assertTrue(regex.match('/var/log/app-a.1'))
+        self.assertFalse(regex.match('/var/log/app-a.x'))
+        regex = pattern_to_regex('/var/log/[!a]*')
+        self.assertTrue(regex.match('/var/log/syslog'))
+        self.assertFalse(regex.match('/var/log/auth.log'))
+
+    def test_dirs(self):
+        p = LogPattern('/var/log/*/*.log')
+        self.assertEqual(p.base_dir, '/var/log')
+        self.assertEqual(p.max_depth, 1)
+        self.assertTrue(p.covers_dir('/var/log/nginx'))
+        self.assertFalse(p.covers_dir('/var/log/nginx/old'))
+        self.assertFalse(p.covers_dir('/var/lib'))
+
+        p = LogPattern('/var/log/**/*.log')
+        self.assertEqual(p.base_dir, '/var/log')
+        self.assertIsNone(p.max_depth)
+        self.assertTrue(p.covers_dir('/var/log/nginx/old'))
+
+        p = LogPattern('/var/log/syslog')
+        self.assertEqual(p.base_dir, '/var/log')
+        self.assertEqual(p.max_depth, 0)
+
+    def test_hidden_files(self):
+        self.assertFalse(LogPattern('/var/log/*').matches('/var/log/.hidden'))
+        self.assertTrue(LogPattern('/var/log/.*').matches('/var/log/.hidden'))
+
+
+class LogDiscoveryTestCase(unittest2.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.logs = Logs()
+        self.discovery = LogDiscovery(self.logs, [os.path.join(self.dir, '**', '*.log')])
+        # deleted files are removed right away unless a test says otherwise
+        self.discovery.REMOVE_DELAY = 0
+
+    def tearDown(self):
+        self.discovery.close()
+        self.logs.clear_available()
+        shutil.rmtree(self.dir)
+
+    def _create(self, *parts):
+        filename = os.path.join(self.dir, *parts)
+        with open(filename, 'w') as f:
+            f.write('line\n')
+        return filename
+
+    def _age(self, *dirnames):
+        # as if last modified long before being listed
+        past = time.time() - 60
+        for dirname in dirnames:
+            os.utime(dirname, (past, past))
+
+
+class TestLogDiscovery(LogDiscoveryTestCase):
+    def test_scan(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        a = self._create('a.log')
+        b = self._create('sub', 'b.log')
+        self._create('c.txt')
+        self.assertEqual(self.discovery.scan(), 2)
+        self.assertEqual(self.logs.available, set([a, b]))
+
+    def test_poll_only_lists_changed_dirs(self):
+        sub = os.path.join(self.dir, 'sub')
+        os.mkdir(sub)
+        self._create('sub', 'b.log')
+        self._age(self.dir, sub)
+        self.discovery.scan()
+        self.assertEqual(self.discovery.poll(), 0)
+
+        c = self._create('sub', 'c.log')
+        self.assertEqual(self.discovery.poll(), 1)
+        self.assertIn(c, self.logs.available)
+
+    def test_poll_removes_deleted(self):
+        a = self._create('a.log')
+        self.discovery.scan()
+        os.remove(a)
+        self.discovery.poll()
+        self.assertEqual(self.logs.available, set())
+
+    def test_poll_removes_deleted_after_delay(self):
+        self.discovery.REMOVE_DELAY = 60
+        a = self._create('a.log')
+        self.discovery.scan()
+        os.remove(a)
+        self.discovery.poll()
+        self.assertIn(a, self.logs.available)
+
+    def test_poll_new_dirs(self):
+        self.discovery.scan()
+        os.makedirs(os.path.join(self.dir, 'x', 'y'))
+        filename = self._create('x', 'y', 'z.log')
+        self.discovery.poll()
+        self.assertIn(filename, self.logs.available)
+
+    def test_poll_removed_dir(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self._create('sub', 'b.log')
+        self.discovery.scan()
+        shutil.rmtree(os.path.join(self.dir, 'sub'))
+        self.discovery.poll()
+        self.assertEqual(self.logs.available, set())
+        self.assertEqual(self.discovery.dirs.keys(), [self.dir])
+
+    def test_depth(self):
+        discovery = LogDiscovery(self.logs, [os.path.join(self.dir, '*', '*.log')])
+        os.makedirs(os.path.join(self.dir, 'a', 'b'))
+        a = self._create('a', 'a.log')
+        self._create('a', 'b', 'b.log')
+        discovery.scan()
+        self.assertEqual(self.logs.available, set([a]))
+        self.assertEqual(sorted(discovery.dirs), [self.dir, os.path.join(self.dir, 'a')])
+
+    def test_missing_base_dir(self):
+        base_dir = os.path.join(self.dir, 'later')
+        discovery = LogDiscovery(self.logs, [os.path.join(base_dir, '*.log')])
+        self.assertEqual(discovery.scan(), 0)
+        os.mkdir(base_dir)
+        filename = self._create('later', 'a.log')
+        discovery.poll()
+        self.assertIn(filename, self.logs.available)
+
+
+class TestLogDiscoveryInotify(LogDiscoveryTestCase):
+    def setUp(self):
+        super(TestLogDiscoveryInotify, self).setUp()
+        self.inotify = create_inotify()
+        if not self.inotify:
+            self.skipTest('inotify is not available')
+        self.discovery.scan()
+        self.discovery.start_watching(self.inotify)
+
+    def _process(self):
+        while self.discovery.watch(0.1):
+            pass
+
+    def test_create_and_delete(self):
+        filename = self._create('a.log')
+        self._process()
+        self.assertIn(filename, self.logs.available)
+
+        os.remove(filename)
+        self._process()
+        self.assertEqual(self.logs.available, set())
+
+    def test_delete_removed_after_delay(self):
+        self.discovery.REMOVE_DELAY = 0.3
+        filename = self._create('a.log')
+        self._process()
+        os.remove(filename)
+        self._process()
+        self.assertIn(filename, self.logs.available)
+
+        time.sleep(0.3)
+        self.discovery.watch(0)
+        self.assertEqual(self.logs.available, set())
+
+    def test_rotated_log_keeps_readers(self):
+        self.discovery.REMOVE_DELAY = 60
+        filename = self._create('a.log')
+        self._process()
+        log = self.logs.get(filename, key='session')
+        self.assertEqual(log.read(), 'line\n')
+
+        with open(filename, 'a') as f:
+            f.write('old 2\n')
+        os.rename(filename, filename + '.1')
+        self._process()
+        with open(filename, 'w') as f:
+            f.write('new 1\n')
+        self._process()
+
+        self.assertIs(self.logs.get(filename, key='session'), log)
+        # the rest of the rotated file, then the new file
+        self.assertEqual(log.read(), 'old 2\n')
+        self.assertEqual(log.read(), 'new 1\n')
+
+    def test_new_dir(self):
+        os.makedirs(os.path.join(self.dir, 'x', 'y'))
+        self._process()
+        filename = self._create('x', 'y', 'z.log')
+        self._process()
+        self.assertIn(filename, self.logs.available)
+
+    def test_move(self):
+        filename = self._create('a.txt')
+        self._process()
+        self.assertEqual(self.logs.available, set())
+
+        renamed = os.path.join(self.dir, 'a.log')
+        os.rename(filename, renamed)
+        self._process()
+        self.assertEqual(self.logs.available, set([renamed]))
+
+        os.rename(renamed, filename)
+        self._process()
+        self.assertEqual(self.logs.available, set())
+
+    def test_unwatched_dir_is_polled(self):
+        add_watch = self.inotify.add_watch
+
+        def failing_add_watch(path, mask):
+            if path.endswith('sub'):
+                raise OSError(28, 'No space left on device')
+            return add_watch(path, mask)
+
+        self.inotify.add_watch = failing_add_watch
+        sub = os.path.join(self.dir, 'sub')
+        os.mkdir(sub)
+        self._process()
+        self.assertIn(sub, self.discovery.dirs)
+        self.assertNotIn(sub, self.discovery._dir_watches)
+
+        filename = self._create('sub', 'a.log')
+        self._process()
+        self.assertEqual(self.logs.available, set())
+        self.assertEqual(self.discovery.poll(), 1)
+        self.assertEqual(self.logs.available, set([filename]))
+
+    def test_removed_dir(self):
+        os.mkdir(os.path.join(self.dir, 'sub'))
+        self._process()
+        self._create('sub', 'b.log')
+        self._process()
+        shutil.rmtree(os.path.join(self.dir, 'sub'))
+        self._process()
+        self.assertEqual(self.logs.available, set())
+        self.assertEqual(self.discovery._watches.values(), [self.dir])
+
+
+if __name__ == '__main__':
+    unittest2.main()
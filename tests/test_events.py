@@ -0,0 +1,91 @@
+import unittest2
+from psdash.events import Publisher, diff, get_overview
+
+
+class TestDiff(unittest2.TestCase):
+    def test_no_previous(self):
+        self.assertEqual(diff(None, {'a': 1}), {'a': 1})
+
+    def test_unchanged(self):
+        self.assertEqual(diff({'a': 1, 'b': {'c': 2}}, {'a': 1, 'b': {'c': 2}}), {})
+
+    def test_changed(self):
+        self.assertEqual(diff({'a': 1, 'b': 2}, {'a': 1, 'b': 3}), {'b': 3})
+
+    def test_nested(self):
+        old = {'eth0': {'rx': 1, 'tx': 2}, 'lo': {'rx': 0, 'tx': 0}}
+        new = {'eth0': {'rx': 5, 'tx': 2}, 'lo': {'rx': 0, 'tx': 0}}
+        self.assertEqual(diff(old, new), {'eth0': {'rx': 5}})
+
+    def test_added_and_removed(self):
+        self.assertEqual(diff({'1': 'a', '2': 'b'}, {'2': 'b', '3': 'c'}), {'1': None, '3': 'c'})
+
+    def test_lists_are_replaced(self):
+        self.assertEqual(diff({'load': [1, 2, 3]}, {'load': [1, 2, 4]}), {'load': [1, 2, 4]})
+
+
+class TestPublisher(unittest2.TestCase):
+    def setUp(self):
+        self.publisher = Publisher(max_pending=2)
+
+    def test_subscriber_gets_full_snapshot_then_delta(self):
+        self.publisher.publish('overview', {'a': 1, 'b': 1})
+        s = self.publisher.subscribe(['overview'])
+        self.publisher.publish('overview', {'a': 1, 'b': 2})
+        self.assertEqual(s.get(timeout=0), ('overview', {'a': 1, 'b': 1}))
+        self.assertEqual(s.get(timeout=0), ('overview', {'b': 2}))
+        self.assertIsNone(s.get(timeout=0))
+
+    def test_unchanged_snapshot_is_not_sent(self):
+        s = self.publisher.subscribe(['overview'])
+        self.publisher.publish('overview', {'a': 1})
+        self.publisher.publish('overview', {'a': 1})
+        self.assertEqual(s.get(timeout=0), ('overview', {'a': 1}))
+        self.assertIsNone(s.get(timeout=0))
+
+    def test_one_sample_fans_out(self):
+        subscriptions = [self.publisher.subscribe(['network']) for _ in range(3)]
+        self.publisher.publish('network', {'eth0': {'rx': 1}})
+        for s in subscriptions:
+            self.assertEqual(s.get(timeout=0), ('network', {'eth0': {'rx': 1}}))
+
+    def test_only_subscribed_channels(self):
+        s = self.publisher.subscribe(['network'])
+        self.publisher.publish('overview', {'a': 1})
+        self.assertIsNone(s.get(timeout=0))
+        self.assertEqual(self.publisher.get_channels(), set(['network']))
+
+    def test_slow_subscriber_is_closed(self):
+        s = self.publisher.subscribe(['overview'])
+        for i in range(3):
+            self.publisher.publish('overview', {'a': i})
+        self.assertTrue(s.closed)
+        self.assertEqual(self.publisher.get_channels(), set())
+
+    def test_unsubscribe(self):
+        s = self.publisher.subscribe(['overview'])
+        self.publisher.unsubscribe(s)
+        self.assertTrue(s.closed)
+        self.assertEqual(self.publisher.get_channels(), set())
+
+
+class TestOverview(unittest2.TestCase):
+    def test_does_not_modify_results(self):
+        memory = {'total': 100, 'available': 40}
+
+        class Service(object):
+            def get_sysinfo(self):
+                return {'uptime': 1, 'load_avg': (0, 0, 0)}
+
+            def get_memory(self):
+                return memory
+
+            def get_cpu(self):
+                return {}
+
+            def get_swap_space(self):
+                return {}
+
+        overview = get_overview(Service())
+        self.assertEqual(overview['memory']['used_excl'], 60)
+        self.assertEqual(memory, {'total': 100, 'available': 40})
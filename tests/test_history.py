@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import unittest2
+from psdash.history import RingBuffer, MmapRingBuffer, Tier, MetricHistory, HostMetrics
+from psdash.node import LocalNode
+
+
+class TestRingBuffer(unittest2.TestCase):
+    def test_empty(self):
+        buf = RingBuffer(3)
+        self.assertEqual(len(buf), 0)
+        self.assertEqual(buf.get_range(), [])
+        self.assertIsNone(buf.get_oldest())
+
+    def test_overwrites_oldest(self):
+        buf = RingBuffer(3)
+        for i in range(5):
+            buf.append(i, i * 10)
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.get_range(), [(2, 20), (3, 30), (4, 40)])
+        self.assertEqual(buf.get_oldest(), 2)
+
+    def test_range(self):
+        buf = RingBuffer(10)
+        for i in range(15):
+            buf.append(i, i)
+        self.assertEqual(buf.get_range(7, 9), [(7, 7), (8, 8), (9, 9)])
+        self.assertEqual(buf.get_range(start=13), [(13, 13), (14, 14)])
+        self.assertEqual(buf.get_range(end=5.5), [(5, 5)])
+        self.assertEqual(buf.get_range(20, 30), [])
+
+    def test_replaces_point_with_same_timestamp(self):
+        buf = RingBuffer(3)
+        buf.append(1, 10)
+        buf.append(2, 20)
+        buf.append(2, 25)
+        buf.append(1, 30)
+        self.assertEqual(buf.get_range(), [(1, 10), (2, 25)])
+
+
+class TestMmapRingBuffer(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'metric.1s.hist')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_persists_across_reopen(self):
+        buf = MmapRingBuffer(self.filename, 3)
+        for i in range(5):
+            buf.append(i, i * 10)
+        buf.close()
+
+        buf = MmapRingBuffer(self.filename, 3)
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(buf.get_range(), [(2, 20), (3, 30), (4, 40)])
+        buf.append(5, 50)
+        self.assertEqual(buf.get_range(start=4), [(4, 40), (5, 50)])
+        buf.close()
+
+    def test_file_size_is_fixed(self):
+        buf = MmapRingBuffer(self.filename, 10)
+        for i in range(25):
+            buf.append(i, i)
+        buf.close()
+        expected = MmapRingBuffer.HEADER.size + 10 * MmapRingBuffer.RECORD.size
+        self.assertEqual(os.path.getsize(self.filename), expected)
+
+    def test_resized_history_is_discarded(self):
+        buf = MmapRingBuffer(self.filename, 3)
+        buf.append(1, 1)
+        buf.close()
+
+        buf = MmapRingBuffer(self.filename, 5)
+        self.assertEqual(len(buf), 0)
+        buf.close()
+
+    def test_unknown_file_is_discarded(self):
+        with open(self.filename, 'wb') as f:
+            f.write('not a history file' * 10)
+        buf = MmapRingBuffer(self.filename, 3)
+        self.assertEqual(buf.get_range(), [])
+        buf.close()
+
+
+class TestTier(unittest2.TestCase):
+    def test_downsamples_to_average(self):
+        tier = Tier(10, RingBuffer(5))
+        for ts, value in [(100, 1), (105, 3), (110, 10), (119, 20), (120, 0)]:
+            tier.add(ts, value)
+        self.assertEqual(tier.get_range(), [(100, 2.0), (110, 15.0)])
+
+
+class TestMetricHistory(unittest2.TestCase):
+    def setUp(self):
+        self.history = MetricHistory(tiers=[(1, 10), (10, 10)])
+
+    def test_add_and_get(self):
+        for ts in range(100, 105):
+            self.history.add('cpu.user', ts, ts - 100)
+        data = self.history.get('cpu.user')
+        self.assertEqual(data['resolution'], 1)
+        self.assertEqual(data['points'], [(100, 0), (101, 1), (102, 2), (103, 3)])
+
+    def test_picks_coarser_tier_for_old_start(self):
+        for ts in range(100, 150):
+            self.history.add('cpu.user', ts, 1)
+        self.assertEqual(self.history.get('cpu.user', start=145)['resolution'], 1)
+        self.assertEqual(self.history.get('cpu.user', start=110)['resolution'], 10)
+
+    def test_explicit_resolution(self):
+        self.history.add('cpu.user', 100, 1)
+        self.assertEqual(self.history.get('cpu.user', resolution=10)['resolution'], 10)
+        self.assertRaises(KeyError, self.history.get, 'cpu.user', resolution=5)
+
+    def test_unknown_metric(self):
+        self.assertRaises(KeyError, self.history.get, 'nosuchmetric')
+
+    def test_memory_limit(self):
+        metric_size = 20 * RingBuffer.ITEM_SIZE
+        history = MetricHistory(tiers=[(1, 10), (10, 10)], memory_limit=metric_size * 2)
+        history.add_sample(100, {'a': 1, 'b': 2, 'c': 3})
+        self.assertEqual(len(history.get_names()), 2)
+        self.assertEqual(history.get_memory_size(), metric_size * 2)
+
+
+class TestPersistentMetricHistory(unittest2.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_survives_restart(self):
+        history = MetricHistory(tiers=[(1, 10), (10, 10)], directory=self.directory)
+        for ts in range(100, 105):
+            history.add('cpu.user', ts, ts - 100)
+        history.close()
+        self.assertItemsEqual(os.listdir(self.directory), ['cpu.user.1s.hist', 'cpu.user.10s.hist'])
+
+        history = MetricHistory(tiers=[(1, 10), (10, 10)], directory=self.directory)
+        history.add('cpu.user', 105, 5)
+        history.add('cpu.user', 106, 6)
+        self.assertEqual(history.get('cpu.user')['points'],
+                         [(100, 0), (101, 1), (102, 2), (103, 3), (105, 5)])
+        history.close()
+
+
+class TestHostMetrics(unittest2.TestCase):
+    def test_sample(self):
+        node = LocalNode()
+        node.net_io_counters.update()
+        host_metrics = HostMetrics(node.get_service())
+        host_metrics.sample()
+        timestamp, values = host_metrics.sample()
+        for name in ['cpu.user', 'memory.percent', 'swap.used', 'load.1']:
+            self.assertIn(name, values)
+        self.assertTrue(any(name.startswith('net.') for name in values))
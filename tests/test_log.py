@@ -1,10 +1,16 @@
 # coding=utf-8
+import gevent
+import gzip
 import os
+import shutil
 import tempfile
 import unittest2
 import time
+import calendar
 from cStringIO import StringIO
-from psdash.log import Logs, LogReader, LogError, ReverseFileSearcher
+from psdash.log import (Logs, LogReader, LogError, LogIndex, LogQuery, MappedFile, MmapLogReader,
+                        ReverseFileSearcher, GzipCheckpoints, GzipFile, MergedLog, get_file_id,
+                        parse_timestamp)
 
 
 class TestLogs(unittest2.TestCase):
@@ -71,6 +77,712 @@ class TestLogs(unittest2.TestCase):
         num_added = self.logs.add_patterns(['/tmp'])
         self.assertEqual(num_added, 0)
 
+    def test_readers_share_index(self):
+        log = self.logs.get(self.filename, key='a')
+        other = self.logs.get(self.filename, key='b')
+        self.assertIs(log.index, other.index)
+
+    def test_searching_sessions_are_independent(self):
+        log = self.logs.get(self.filename, key='a')
+        other = self.logs.get(self.filename, key='b')
+        log.search(self.NEEDLE)
+        self.assertEqual(other.search(self.NEEDLE)[0], self.POSITIONS[0])
+        self.assertEqual(log.search(self.NEEDLE)[0], self.POSITIONS[1])
+
+    def test_searching_starts_over(self):
+        log = self.logs.get(self.filename)
+        for _ in xrange(len(self.POSITIONS)):
+            log.search(self.NEEDLE)
+        self.assertEqual(log.search(self.NEEDLE)[0], -1)
+        self.assertEqual(log.search(self.NEEDLE)[0], self.POSITIONS[0])
+
+
+class TestMmapLogs(unittest2.TestCase):
+    NEEDLE = TestLogs.NEEDLE
+    POSITIONS = TestLogs.POSITIONS
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        with os.fdopen(fd, 'w+') as fp:
+            for pos in self.POSITIONS:
+                fp.seek(pos)
+                fp.write(self.NEEDLE)
+        self.logs = Logs(use_mmap=True)
+        self.logs.add_available(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+        self.logs.clear_available()
+
+    def test_searching(self):
+        log = self.logs.get(self.filename)
+        positions = [log.search(self.NEEDLE)[0] for _ in xrange(len(self.POSITIONS))]
+        self.assertEqual(self.POSITIONS, positions)
+
+    def test_searching_content(self):
+        log = self.logs.get(self.filename)
+        pos, bufferpos, content = log.search(self.NEEDLE)
+        self.assertEqual(content[bufferpos:bufferpos + len(self.NEEDLE)], self.NEEDLE)
+
+    def test_read_tail(self):
+        log = self.logs.get(self.filename)
+        log.set_tail_position()
+        buf = log.read()
+        self.assertEqual(len(buf), MmapLogReader.BUFFER_SIZE)
+
+    def test_creates_mmap_readers(self):
+        log = self.logs.get(self.filename)
+        self.assertIsInstance(log, MmapLogReader)
+        self.assertIs(log.mapped, log.index.mapped)
+
+    def test_repr_works(self):
+        log = self.logs.get(self.filename)
+        self.assertIn('<MmapLogReader', repr(log))
+
+    def test_read_growing(self):
+        log = self.logs.get(self.filename)
+        log.set_tail_position()
+        log.read()
+        self.assertEqual(log.read(), '')
+        with open(self.filename, 'a') as f:
+            f.write('appended\n')
+        self.assertEqual(log.read(), 'appended\n')
+        self.assertEqual(log.search('appended')[0], self.POSITIONS[0] + len(self.NEEDLE))
+
+
+class TestLogRotation(unittest2.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dirname, 'test.log')
+        self._write('first line\n')
+        self.logs = self._create_logs()
+        self.logs.add_available(self.filename)
+        self.log = self.logs.get(self.filename)
+        self.log.set_tail_position()
+        self.assertEqual(self.log.read(), 'first line\n')
+
+    def tearDown(self):
+        self.logs.clear_available()
+        shutil.rmtree(self.dirname)
+
+    def _create_logs(self):
+        return Logs()
+
+    def _write(self, buf, mode='a', filename=None):
+        with open(filename or self.filename, mode) as f:
+            f.write(buf)
+
+    def _rotate(self):
+        os.rename(self.filename, self.filename + '.1')
+        self._write('new file\n', 'w')
+
+    def test_follows_rotated_file(self):
+        self._write('last line\n')
+        self._rotate()
+        # written before the writer moved on to the new file
+        self._write('very last line\n', filename=self.filename + '.1')
+        self.assertEqual(self.log.read(), 'last line\nvery last line\n')
+        self.assertEqual(self.log.read(), 'new file\n')
+        self.assertEqual(self.log.read(), '')
+
+    def test_not_following_rotated_file(self):
+        self.log.follow_rotated = False
+        self._write('last line\n')
+        self._rotate()
+        self.assertEqual(self.log.read(), 'new file\n')
+
+    def test_rotated_before_new_file_is_created(self):
+        os.rename(self.filename, self.filename + '.1')
+        self._write('last line\n', filename=self.filename + '.1')
+        self.assertEqual(self.log.read(), 'last line\n')
+        self.assertEqual(self.log.read(), '')
+        self._write('new file\n', 'w')
+        self.assertEqual(self.log.read(), 'new file\n')
+
+    def test_tail_after_rotation(self):
+        self._rotate()
+        self.log.set_tail_position()
+        self.assertEqual(self.log.read(), 'new file\n')
+
+    def test_truncated(self):
+        self._write('', 'w')
+        self.assertEqual(self.log.read(), '')
+        self._write('new\n')
+        self.assertEqual(self.log.read(), 'new\n')
+
+    def test_search_after_rotation(self):
+        self.assertEqual(self.log.search('first')[0], 0)
+        # larger than the old file, so that only the file id tells it apart
+        os.rename(self.filename, self.filename + '.1')
+        self._write('new file with the first line after\n', 'w')
+        self.assertEqual(self.log.search('first')[0], len('new file with the '))
+        self.assertEqual(self.log.search('first')[0], -1)
+
+    def test_index_rebuilt_after_rotation(self):
+        self.log.search('first')
+        index = self.log.index
+        self._rotate()
+        index.update()
+        self.assertEqual(index.indexed_size, len('new file\n'))
+        self.assertEqual(index.file_id, get_file_id(os.stat(self.filename)))
+
+
+class TestMmapLogRotation(TestLogRotation):
+    def _create_logs(self):
+        return Logs(use_mmap=True)
+
+    def test_follows_rotated_file(self):
+        # the mapping moves on to the new file right away
+        self._write('last line\n')
+        self._rotate()
+        self.assertEqual(self.log.read(), 'new file\n')
+
+    def test_rotated_before_new_file_is_created(self):
+        os.rename(self.filename, self.filename + '.1')
+        self._write('last line\n', filename=self.filename + '.1')
+        self.assertEqual(self.log.read(), 'last line\n')
+        self._write('new file\n', 'w')
+        self.assertEqual(self.log.read(), 'new file\n')
+
+
+class TestGzipLogs(unittest2.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp(suffix='.log.gz')
+        self.content = ''.join('line %d %s\n' % (i, os.urandom(8).encode('hex')) for i in xrange(10000))
+        half = len(self.content) / 2
+        # two gzip members, as with appending to a gzip file
+        for part, mode in ((self.content[:half], 'wb'), (self.content[half:], 'ab')):
+            f = gzip.open(self.filename, mode)
+            f.write(part)
+            f.close()
+        self.checkpoints = GzipCheckpoints(self.filename, interval=10000)
+        self.checkpoints.CHUNK_SIZE = 1024
+        self.fp = GzipFile(self.filename, self.checkpoints)
+
+    def tearDown(self):
+        self.fp.close()
+        os.remove(self.filename)
+
+    def test_read(self):
+        self.assertEqual(self.fp.read(100), self.content[:100])
+        self.assertEqual(self.fp.read(100), self.content[100:200])
+
+    def test_size(self):
+        self.assertEqual(self.fp.get_size(), len(self.content))
+        self.assertGreater(len(self.checkpoints.checkpoints), 10)
+
+    def test_read_lines(self):
+        index = LogIndex(self.filename, 4096, gzip_interval=10000)
+        result = index.read_lines(5000, 2)
+        self.assertEqual(result['lines'], self.content.split('\n')[5000:5002])
+        self.assertEqual(result['num_lines'], 10000)
+
+    def test_seek(self):
+        for offset in (len(self.content) - 10, 0, len(self.content) / 2 - 5, 123456, len(self.content) + 10):
+            self.fp.seek(offset)
+            self.assertEqual(self.fp.read(10), self.content[offset:offset + 10])
+        self.fp.seek(-10, os.SEEK_END)
+        self.assertEqual(self.fp.read(), self.content[-10:])
+
+    def test_read_from_checkpoint(self):
+        self.fp.get_size()
+        offset, compressed_offset, _ = self.checkpoints.checkpoints[5]
+        self.fp.seek(offset + 10)
+        self.fp._fp.seek(0)
+        self.fp.read(10)
+        # decompressing from the checkpoint, not from the start
+        self.assertLessEqual(self.fp._fp.tell(), compressed_offset + 2 * self.checkpoints.CHUNK_SIZE)
+
+    def test_reset_on_change(self):
+        self.fp.get_size()
+        f = gzip.open(self.filename, 'wb')
+        f.write('new content\n')
+        f.close()
+        self.assertEqual(self.fp.get_size(), len('new content\n'))
+        self.assertEqual(len(self.checkpoints.checkpoints), 1)
+        self.assertEqual(self.fp.read(), 'new content\n')
+
+    def test_log_reader(self):
+        logs = Logs()
+        logs.add_available(self.filename)
+        log = logs.get(self.filename)
+        log.set_tail_position()
+        self.assertEqual(log.read(), self.content[-LogReader.BUFFER_SIZE:])
+        self.assertEqual(log.search('line 5000 ')[0], self.content.find('line 5000 '))
+        result = log.find_lines(LogQuery(['line 9999 ']))
+        self.assertEqual(result['matches'][0]['line_number'], 9999)
+        logs.clear_available()
+
+    def test_concurrent_readers(self):
+        logs = Logs()
+        logs.add_available(self.filename)
+        # yield often while decompressing
+        logs.get_index(self.filename).gzip.CHUNK_SIZE = 1024
+        readers = [logs.get(self.filename, key=key) for key in ('a', 'b')]
+        offsets = [len(self.content) / 4, len(self.content) / 2]
+
+        def read(log, offset):
+            log.seek(offset)
+            return log.read()
+
+        greenlets = [gevent.spawn(read, log, offset) for log, offset in zip(readers, offsets)]
+        gevent.joinall(greenlets, raise_error=True)
+        for greenlet, offset in zip(greenlets, offsets):
+            self.assertEqual(greenlet.value, self.content[offset:offset + LogReader.BUFFER_SIZE])
+        logs.clear_available()
+
+    def test_mmap_falls_back(self):
+        logs = Logs(use_mmap=True)
+        logs.add_available(self.filename)
+        log = logs.get(self.filename)
+        self.assertNotIsInstance(log, MmapLogReader)
+        self.assertEqual(log.read()[:100], self.content[:100])
+        logs.clear_available()
+
+
+class TestMappedFile(unittest2.TestCase):
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+        self.mapped = MappedFile(self.filename)
+
+    def tearDown(self):
+        self.mapped.close()
+        os.remove(self.filename)
+
+    def _write(self, buf, mode='w'):
+        with open(self.filename, mode) as f:
+            f.write(buf)
+
+    def test_empty(self):
+        self.assertEqual(self.mapped.read(0, 100), '')
+
+    def test_growth(self):
+        self._write('first\n')
+        self.assertEqual(self.mapped.read(0, 100), 'first\n')
+        self._write('second\n', 'a')
+        self.assertEqual(self.mapped.read(6, 100), 'second\n')
+
+    def test_truncation(self):
+        self._write('first\nsecond\n')
+        self.mapped.remap()
+        self._write('new\n')
+        self.assertEqual(self.mapped.read(0, 100), 'new\n')
+        self.assertEqual(self.mapped.read(6, 100), '')
+        self.assertEqual(self.mapped.size, 4)
+
+    def test_view_does_not_copy(self):
+        self._write('first\nsecond\n')
+        view = self.mapped.view(6, 6)
+        self.assertIsInstance(view, buffer)
+        self.assertEqual(str(view), 'second')
+
+
+class TestLogReaderPool(unittest2.TestCase):
+    def setUp(self):
+        self.filenames = []
+        for i in xrange(2):
+            _, filename = tempfile.mkstemp()
+            with open(filename, 'w') as f:
+                f.write('line %d\n' % i * 5000)
+            self.filenames.append(filename)
+        self.logs = Logs(max_readers=3, idle_timeout=60)
+        for filename in self.filenames:
+            self.logs.add_available(filename)
+
+    def tearDown(self):
+        self.logs.clear_available()
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def test_sessions_share_file(self):
+        log = self.logs.get(self.filenames[0], key='a')
+        other = self.logs.get(self.filenames[0], key='b')
+        self.assertIs(log.shared, other.shared)
+        self.assertEqual(self.logs.get_stats()['open_files'], 1)
+
+    def test_sessions_have_own_positions(self):
+        log = self.logs.get(self.filenames[0], key='a')
+        other = self.logs.get(self.filenames[0], key='b')
+        log.set_tail_position()
+        self.assertEqual(other.read()[:7], 'line 0\n')
+        self.assertEqual(log.read()[-7:], 'line 0\n')
+        self.assertEqual(log.read(), '')
+        self.assertNotEqual(other.read(), '')
+
+    def test_evicts_least_recently_used(self):
+        self.logs.get(self.filenames[0], key='a')
+        self.logs.get(self.filenames[0], key='b')
+        self.logs.get(self.filenames[1], key='a')
+        self.logs.get(self.filenames[0], key='a')
+        self.logs.get(self.filenames[1], key='c')
+        self.assertEqual(len(self.logs.readers), 3)
+        self.assertNotIn((self.filenames[0], 'b'), self.logs.readers)
+        self.assertIn((self.filenames[0], 'a'), self.logs.readers)
+        self.assertEqual(self.logs.get_stats()['evicted'], 1)
+
+    def test_evicted_reader_starts_over(self):
+        log = self.logs.get(self.filenames[0], key='a')
+        log.read()
+        for key in 'bcd':
+            self.logs.get(self.filenames[0], key=key)
+        self.assertIsNot(self.logs.get(self.filenames[0], key='a'), log)
+        # the shared file stays open
+        self.assertIs(self.logs.get(self.filenames[0], key='a').shared, log.shared)
+
+    def test_evict_idle(self):
+        self.logs.get(self.filenames[0], key='a')
+        self.logs.get(self.filenames[1], key='b')
+        reader_key = (self.filenames[0], 'a')
+        last_used, use = self.logs._last_used[reader_key]
+        self.logs._last_used[reader_key] = (last_used - 120, use)
+        self.assertEqual(self.logs.evict_idle(), 1)
+        self.assertEqual(self.logs.readers.keys(), [(self.filenames[1], 'b')])
+        self.assertEqual(self.logs.get_stats()['evicted_idle'], 1)
+
+    def test_stats(self):
+        self.logs.get(self.filenames[0], key='a')
+        self.logs.get(self.filenames[1], key='a')
+        self.logs.get(self.filenames[1], key='b')
+        stats = self.logs.get_stats()
+        self.assertEqual(stats['readers'], 3)
+        self.assertEqual(stats['sessions'], 2)
+        self.assertEqual(stats['open_files'], 2)
+        self.assertEqual(stats['max_readers'], 3)
+
+
+class TestParseTimestamp(unittest2.TestCase):
+    def test_iso(self):
+        ts = calendar.timegm((2016, 1, 2, 3, 4, 5))
+        self.assertEqual(parse_timestamp('2016-01-02T03:04:05Z message'), ts)
+        self.assertEqual(parse_timestamp('2016-01-02 03:04:05.250+01:00 message'), ts - 3600 + 0.25)
+        self.assertEqual(parse_timestamp('2016-01-02 03:04:05,250 INFO message'),
+                         time.mktime((2016, 1, 2, 3, 4, 5, 0, 0, -1)) + 0.25)
+
+    def test_access_log(self):
+        line = '127.0.0.1 - - [02/Jan/2016:03:04:05 -0100] "GET / HTTP/1.1" 200 612'
+        self.assertEqual(parse_timestamp(line), calendar.timegm((2016, 1, 2, 3, 4, 5)) + 3600)
+
+    def test_syslog(self):
+        ts = parse_timestamp('Jan  2 03:04:05 host kernel: message')
+        self.assertEqual(time.localtime(ts)[1:6], (1, 2, 3, 4, 5))
+        self.assertLessEqual(ts, time.time() + 86400)
+
+    def test_none(self):
+        self.assertIsNone(parse_timestamp('    at com.example.Main(Main.java:10)'))
+        self.assertIsNone(parse_timestamp('x' * 100 + ' 2016-01-02T03:04:05Z'))
+
+
+class TestMergedLog(unittest2.TestCase):
+    def setUp(self):
+        self.filenames = []
+        self.logs = Logs()
+        self._create_log([
+            '2016-01-02T03:04:01Z app started',
+            '2016-01-02T03:04:04Z app error',
+            'Traceback (most recent call last):',
+            '2016-01-02T03:04:06Z app stopped'
+        ])
+        self._create_log([
+            '127.0.0.1 - - [02/Jan/2016:03:04:02 +0000] "GET / HTTP/1.1" 200 612',
+            '127.0.0.1 - - [02/Jan/2016:03:04:05 +0000] "GET /error HTTP/1.1" 500 612'
+        ])
+        self.log = MergedLog([self.logs.get(f) for f in self.filenames])
+
+    def tearDown(self):
+        self.logs.clear_available()
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def _create_log(self, lines):
+        _, filename = tempfile.mkstemp()
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        self.filenames.append(filename)
+        self.logs.add_available(filename)
+
+    def test_read_merged(self):
+        lines = [(os.path.basename(f), l[:30]) for _, f, l in self.log.read()]
+        self.assertEqual([l for _, l in lines], [
+            '2016-01-02T03:04:01Z app start',
+            '127.0.0.1 - - [02/Jan/2016:03:',
+            '2016-01-02T03:04:04Z app error',
+            'Traceback (most recent call la',
+            '127.0.0.1 - - [02/Jan/2016:03:',
+            '2016-01-02T03:04:06Z app stopp'
+        ])
+        self.assertEqual(lines[1][0], os.path.basename(self.filenames[1]))
+        self.assertEqual(self.log.read(), [])
+
+    def test_read_complete_lines(self):
+        self.log.read()
+        with open(self.filenames[0], 'a') as f:
+            f.write('2016-01-02T03:04:07Z app sta')
+        self.assertEqual(self.log.read(), [])
+        with open(self.filenames[0], 'a') as f:
+            f.write('rted\n')
+        self.assertEqual([l for _, _, l in self.log.read()], ['2016-01-02T03:04:07Z app started'])
+
+    def test_read_lagging_log(self):
+        self._create_log(['2016-01-02T03:05:%02dZ lagging' % i for i in xrange(30)])
+        self._create_log(['2016-01-02T03:05:10Z other'])
+        readers = [LogReader(f, buffer_size=100) for f in self.filenames[2:]]
+        log = MergedLog(readers)
+
+        lines = []
+        while True:
+            read = log.read()
+            if not read:
+                break
+            lines.extend(read)
+        timestamps = [ts for ts, _, _ in lines]
+        self.assertEqual(len(lines), 31)
+        self.assertEqual(timestamps, sorted(timestamps))
+        for r in readers:
+            r.close()
+
+    def test_read_inherits_timestamp(self):
+        self.log.read()
+        with open(self.filenames[0], 'a') as f:
+            f.write('  continued\n')
+        self.assertEqual(self.log.read(), [(calendar.timegm((2016, 1, 2, 3, 4, 6)), self.filenames[0], '  continued')])
+
+    def test_tail(self):
+        with open(self.filenames[0], 'w') as f:
+            f.write(('2016-01-02T03:04:01Z %s\n' % ('x' * 100)) * 1000)
+        lines = self.log.read(seek_tail=True)
+        self.assertEqual(lines[0][2], '2016-01-02T03:04:01Z %s' % ('x' * 100))
+        self.assertEqual(lines[-1][2][:30], '127.0.0.1 - - [02/Jan/2016:03:')
+
+    def test_find_lines(self):
+        result = self.log.find_lines(LogQuery(['error']))
+        self.assertEqual([m['timestamp'] for m in result['matches']], [
+            calendar.timegm((2016, 1, 2, 3, 4, 5)),
+            calendar.timegm((2016, 1, 2, 3, 4, 4))
+        ])
+        self.assertEqual(result['matches'][0]['filename'], self.filenames[1])
+        self.assertEqual(result['next'], [-1, -1])
+
+    def test_find_lines_paged(self):
+        query = LogQuery(['app', 'GET'])
+        result = self.log.find_lines(query, limit=2)
+        self.assertEqual([m['line'][-7:] for m in result['matches']], ['stopped', 'TP/1.1" 500 612'[-7:]])
+        found = result['matches']
+        while result['next'] != [-1, -1]:
+            result = self.log.find_lines(query, result['next'], limit=2)
+            found.extend(result['matches'])
+        self.assertEqual(len(found), 5)
+        timestamps = [m['timestamp'] for m in found]
+        self.assertEqual(timestamps, sorted(timestamps, reverse=True))
+
+    def test_find_lines_inherited_timestamp(self):
+        result = self.log.find_lines(LogQuery(['Traceback', '/error'], mode=LogQuery.ANY))
+        self.assertEqual([m['line'][:9] for m in result['matches']], ['127.0.0.1', 'Traceback'])
+        self.assertEqual(result['matches'][1]['timestamp'], calendar.timegm((2016, 1, 2, 3, 4, 4)))
+
+    def test_find_lines_max_scan(self):
+        result = self.log.find_lines(LogQuery(['error']), max_scan=10)
+        # the first log used it all up
+        self.assertEqual(result['scanned'], sum(os.path.getsize(f) for f in self.filenames[:1]))
+        self.assertEqual(len(result['matches']), 1)
+        self.assertNotEqual(result['next'][1], -1)
+
+
+class TestLogIndex(unittest2.TestCase):
+    BLOCK_SIZE = 1024
+
+    def setUp(self):
+        _, self.filename = tempfile.mkstemp()
+        self.lines = ['line %d some message\n' % i for i in xrange(1000)]
+        self._write(''.join(self.lines))
+        self.index = LogIndex(self.filename, self.BLOCK_SIZE)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _write(self, buf, mode='w'):
+        with open(self.filename, mode) as f:
+            f.write(buf)
+
+    def _position(self, line):
+        return sum(len(l) for l in self.lines[:line])
+
+    def test_blocks_end_at_lines(self):
+        self.index.update()
+        self.assertEqual(self.index.indexed_size, os.path.getsize(self.filename))
+        self.assertGreater(len(self.index.offsets), 1)
+        for offset, line_number in zip(self.index.offsets, self.index.line_numbers):
+            self.assertEqual(offset, self._position(line_number))
+
+    def test_rfind(self):
+        self.assertEqual(self.index.rfind('line 500 '), self._position(500))
+        self.assertEqual(self.index.rfind('line 5'), self._position(599))
+        self.assertEqual(self.index.rfind('line 5', self._position(599)), self._position(598))
+        self.assertEqual(self.index.rfind('line 1 '), self._position(1))
+
+    def test_rfind_not_found(self):
+        self.assertEqual(self.index.rfind('wontexist'), -1)
+        self.assertEqual(self.index.rfind('line 999', self._position(999)), -1)
+
+    def test_rfind_spanning_lines(self):
+        self.assertEqual(self.index.rfind('message\nline 400 '), self._position(400) - len('message\n'))
+
+    def test_candidate_blocks(self):
+        self.index.update()
+        ranges = self.index._get_ranges('line 500 ', os.path.getsize(self.filename))
+        self.assertLess(len(ranges), len(self.index.offsets))
+        self.assertTrue(any(start <= self._position(500) < end for start, end in ranges))
+
+    def test_update_indexes_new_lines_only(self):
+        self.index.update()
+        indexed_size = self.index.indexed_size
+        num_blocks = len(self.index.offsets)
+        bitmaps = list(self.index.bitmaps)
+
+        self._write('appended line\nincomplete', 'a')
+        self.index.update()
+        self.assertEqual(self.index.indexed_size, indexed_size + len('appended line\n'))
+        self.assertEqual(self.index.bitmaps[:num_blocks], bitmaps)
+        self.assertEqual(self.index.rfind('appended'), indexed_size)
+        self.assertEqual(self.index.rfind('incomplete'), indexed_size + len('appended line\n'))
+
+    def test_update_truncated(self):
+        self.index.update()
+        self._write('new content\n')
+        self.assertEqual(self.index.rfind('content'), 4)
+        self.assertEqual(self.index.indexed_size, len('new content\n'))
+
+    def test_get_line_number(self):
+        self.index.update()
+        for line in (0, 1, 500, 999):
+            self.assertEqual(self.index.get_line_number(self._position(line)), line)
+        self.assertEqual(self.index.get_line_number(self._position(500) + 3), 500)
+
+    def _find_line_numbers(self, query, **kwargs):
+        return [m['line_number'] for m in self.index.find_lines(query, **kwargs)['matches']]
+
+    def test_find_lines(self):
+        query = LogQuery(['line 50 ', 'line 5 '])
+        self.assertEqual(self._find_line_numbers(query), [50, 5])
+
+    def test_find_lines_all_terms(self):
+        query = LogQuery(['line 5', '0 some'], mode=LogQuery.ALL)
+        self.assertEqual(self._find_line_numbers(query), [590, 580, 570, 560, 550, 540, 530, 520, 510, 500, 50])
+
+    def test_find_lines_regex(self):
+        query = LogQuery([r'^line 9\d '], regex=True)
+        self.assertEqual(self._find_line_numbers(query), range(99, 89, -1))
+
+    def test_find_lines_ignore_case(self):
+        self.assertEqual(self._find_line_numbers(LogQuery(['LINE 7 '])), [])
+        self.assertEqual(self._find_line_numbers(LogQuery(['LINE 7 '], ignore_case=True)), [7])
+
+    def test_find_lines_context(self):
+        match = self.index.find_lines(LogQuery(['line 1 ']), context=2)['matches'][0]
+        self.assertEqual(match['position'], self._position(1))
+        self.assertEqual(match['line'], self.lines[1].rstrip('\n'))
+        self.assertEqual(match['before'], ['line 0 some message'])
+        self.assertEqual(match['after'], ['line 2 some message', 'line 3 some message'])
+
+    def test_find_lines_paged(self):
+        query = LogQuery(['line 99'])
+        result = self.index.find_lines(query, limit=5)
+        self.assertEqual([m['line_number'] for m in result['matches']], [999, 998, 997, 996, 995])
+        self.assertEqual(result['next'], self._position(995))
+        result = self.index.find_lines(query, before=result['next'], limit=10)
+        self.assertEqual([m['line_number'] for m in result['matches']], [994, 993, 992, 991, 990, 99])
+        self.assertIsNone(result['next'])
+
+    def test_find_lines_max_scan(self):
+        result = self.index.find_lines(LogQuery(['message']), max_scan=1)
+        self.assertLess(result['scanned'], os.path.getsize(self.filename))
+        self.assertEqual(result['next'], self.index.offsets[-1])
+        self.assertEqual(result['matches'][-1]['position'], self.index.offsets[-1])
+
+    def test_find_lines_while_indexing(self):
+        # as if another greenlet was indexing the file, none of it is indexed yet
+        self.index._updating = True
+        query = LogQuery(['line 99'])
+        self.assertEqual(self._find_line_numbers(query), [999, 998, 997, 996, 995, 994, 993, 992, 991, 990, 99])
+
+        result = self.index.find_lines(query, max_scan=1)
+        self.assertLessEqual(result['scanned'], self.BLOCK_SIZE)
+        self.assertEqual([m['line_number'] for m in result['matches']], range(999, 989, -1))
+        result = self.index.find_lines(query, before=result['next'], max_scan=1)
+        self.assertEqual(result['matches'], [])
+        self.assertGreater(result['next'], self._position(99))
+
+    def test_find_lines_skips_blocks(self):
+        result = self.index.find_lines(LogQuery(['line 500 ']))
+        self.assertLess(result['scanned'], os.path.getsize(self.filename))
+
+    def test_read_lines(self):
+        for start in (0, 1, 37, 500, 998):
+            result = self.index.read_lines(start, 3)
+            self.assertEqual(result['start'], start)
+            self.assertEqual(result['lines'], [l.rstrip('\n') for l in self.lines[start:start + 3]])
+            self.assertEqual(result['offset'], self._position(start))
+            self.assertEqual(result['end'], self._position(start + 3))
+            self.assertEqual(result['num_lines'], 1000)
+
+    def test_read_lines_from_end(self):
+        result = self.index.read_lines(-5, 10)
+        self.assertEqual(result['start'], 995)
+        self.assertEqual(len(result['lines']), 5)
+        self.assertEqual(result['end'], os.path.getsize(self.filename))
+
+        result = self.index.read_lines(2000, 10)
+        self.assertEqual(result['start'], 1000)
+        self.assertEqual(result['lines'], [])
+
+    def test_read_lines_unindexed(self):
+        self.index.update()
+        self._write('line 1000 more\nline 1001 incomplete', 'a')
+        result = self.index.read_lines(999, 5)
+        self.assertEqual(result['lines'], ['line 999 some message', 'line 1000 more', 'line 1001 incomplete'])
+        self.assertEqual(result['num_lines'], 1002)
+        self.assertEqual(result['end'], os.path.getsize(self.filename))
+
+    def test_read_lines_while_indexing(self):
+        self.index._updating = True
+        self.index.SCAN_CHUNK_SIZE = 100
+        result = self.index.read_lines(-3, 2)
+        self.assertEqual(result['lines'], ['line 997 some message', 'line 998 some message'])
+        self.assertEqual(result['num_lines'], 1000)
+
+    def test_read_lines_long_lines(self):
+        # lines longer than a block, splitting them between blocks
+        lines = ['%d %s' % (i, 'x' * (self.BLOCK_SIZE * (i % 3))) for i in xrange(20)]
+        self._write('\n'.join(lines) + '\n')
+        for start in xrange(20):
+            self.assertEqual(self.index.read_lines(start, 2)['lines'], lines[start:start + 2])
+
+    def test_read_range(self):
+        result = self.index.read_range(self._position(10), 30)
+        self.assertEqual(result['content'], ''.join(self.lines)[self._position(10):self._position(10) + 30])
+        self.assertEqual(result['line_number'], 10)
+        self.assertEqual(result['size'], os.path.getsize(self.filename))
+
+        size = os.path.getsize(self.filename)
+        result = self.index.read_range(size - 5, 100)
+        self.assertEqual(result['content'], 'sage\n')
+        self.assertEqual(self.index.read_range(size + 10, 100)['content'], '')
+        self.assertRaises(ValueError, self.index.read_range, -1, 10)
+
+    def test_invalid_query(self):
+        self.assertRaises(ValueError, LogQuery, [])
+        self.assertRaises(ValueError, LogQuery, ['a'], mode='some')
+        self.assertRaises(ValueError, LogQuery, ['('], regex=True)
+
+
+class TestMappedLogIndex(TestLogIndex):
+    def setUp(self):
+        super(TestMappedLogIndex, self).setUp()
+        self.index = LogIndex(self.filename, self.BLOCK_SIZE, mapped=MappedFile(self.filename))
+
+    def tearDown(self):
+        self.index.close()
+        super(TestMappedLogIndex, self).tearDown()
+
 
 class TestFileSearcher(unittest2.TestCase):
         def _create_temp_file(self, buf):
@@ -0,0 +1,122 @@
+# coding=utf-8
+import os
+import tempfile
+import unittest2
+from psdash.log import Logs, LogQuery
+from psdash.logmetrics import LogCounter, LogMetrics
+
+
+class TestLogCounter(unittest2.TestCase):
+    def setUp(self):
+        queries = {
+            'errors': LogQuery(['ERROR'], regex=True),
+            '5xx': LogQuery([r'status=5\d\d'], regex=True)
+        }
+        self.counter = LogCounter('test.log', queries, 10)
+
+    def test_counts(self):
+        self.counter.add(60, 'ERROR a\nINFO status=200\n')
+        self.counter.add(90, 'ERROR b status=503\n')
+        self.counter.add(120, 'ERROR c\n')
+        self.assertEqual(self.counter.get_counts('errors', 3, 120), [0, 2, 1])
+        self.assertEqual(self.counter.get_counts('5xx', 3, 120), [0, 1, 0])
+        self.assertEqual(self.counter.totals, {'errors': 3, '5xx': 1})
+
+    def test_minutes_without_lines(self):
+        self.counter.add(60, 'ERROR a\n')
+        self.counter.add(300, 'ERROR b\n')
+        self.assertEqual(self.counter.get_counts('errors', 6, 300), [0, 1, 0, 0, 0, 1])
+        self.assertEqual(self.counter.get_counts('errors', 2, 600), [0, 0])
+
+    def test_incomplete_lines(self):
+        self.counter.add(60, 'ERR')
+        self.assertEqual(self.counter.totals['errors'], 0)
+        self.counter.add(60, 'OR a\nERROR')
+        self.assertEqual(self.counter.totals['errors'], 1)
+        self.counter.add(60, ' b\n')
+        self.assertEqual(self.counter.totals['errors'], 2)
+
+    def test_long_line_is_skipped(self):
+        self.counter.MAX_LINE_SIZE = 10
+        self.counter.add(60, 'ERROR a\nINFO 0123456789')
+        self.assertEqual(self.counter.totals['errors'], 1)
+        # the rest of the long line is not taken for a line of its own
+        self.counter.add(60, 'ERROR')
+        self.counter.add(60, ' b\nERROR c\n')
+        self.assertEqual(self.counter.totals['errors'], 2)
+
+    def test_history_size(self):
+        for minute in xrange(20):
+            self.counter.add(minute * 60, 'ERROR\n')
+        # the 10 minutes kept and the current one
+        self.assertEqual(self.counter.get_counts('errors', 15, 19 * 60), [0] * 4 + [1] * 11)
+
+
+class TestLogMetrics(unittest2.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'app.log')
+        self.other = os.path.join(self.dir, 'other.txt')
+        for filename in (self.filename, self.other):
+            with open(filename, 'w') as f:
+                f.write('ERROR before counting\n')
+        self.logs = Logs()
+        self.logs.add_available(self.filename)
+        self.logs.add_available(self.other)
+        self.metrics = LogMetrics(self.logs, {
+            os.path.join(self.dir, '*.log'): {'errors': 'ERROR'},
+            os.path.join(self.dir, 'app.*'): {'warnings': 'WARN'}
+        })
+
+    def tearDown(self):
+        self.logs.clear_available()
+        for filename in (self.filename, self.other):
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.rmdir(self.dir)
+
+    def _append(self, content):
+        with open(self.filename, 'a') as f:
+            f.write(content)
+
+    def test_update(self):
+        self.metrics.update(now=600)
+        self._append('ERROR a\nWARN b\nERROR c\n')
+        self.metrics.update(now=610)
+
+        metrics = self.metrics.get(minutes=2, now=610)
+        self.assertEqual(len(metrics), 1)
+        self.assertEqual(metrics[0]['filename'], self.filename)
+        self.assertEqual(metrics[0]['end'], 600)
+        self.assertEqual(metrics[0]['counts'], {'errors': [0, 2], 'warnings': [0, 1]})
+        self.assertIsNone(self.metrics.counters[self.other])
+
+    def test_max_read(self):
+        self.metrics.max_read = 10
+        self.metrics.update(now=600)
+        self._append('ERROR a\n' * 4)
+        self.metrics.update(now=600)
+        self.assertEqual(self.metrics.counters[self.filename].totals['errors'], 1)
+        self.metrics.update(now=660)
+        self.assertEqual(self.metrics.counters[self.filename].totals['errors'], 2)
+
+    def test_removed_log(self):
+        self.metrics.update(now=600)
+        self.logs.remove_available(self.filename)
+        self.metrics.update(now=610)
+        self.assertNotIn(self.filename, self.metrics.counters)
+        self.assertEqual(self.metrics.get(now=610), [])
+
+    def test_truncated(self):
+        self.metrics.update(now=600)
+        with open(self.filename, 'w') as f:
+            f.write('ERROR new\n')
+        self.metrics.update(now=610)
+        self.assertEqual(self.metrics.counters[self.filename].totals['errors'], 1)
+
+    def test_invalid_pattern(self):
+        self.assertRaises(ValueError, LogMetrics, self.logs, {'/var/log/*.log': {'errors': '('}})
+
+
+if __name__ == '__main__':
+    unittest2.main()
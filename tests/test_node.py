@@ -2,12 +2,15 @@ import os
 import sys
 import platform
 from psdash.log import LogReader
+from psdash.logmetrics import LogMetrics
 import socket
 import tempfile
 import unittest2
+import gevent
 import time
 import psutil
-from psdash.node import LocalNode
+import zerorpc
+from psdash.node import LocalNode, RemoteNode, RemoteService, CircuitBreaker, NodeUnavailable, PUSH_CALLS
 
 
 class TestNode(unittest2.TestCase):
@@ -148,6 +151,12 @@ class TestNode(unittest2.TestCase):
         for a in asserts:
             self.assertIn(a, proc)
 
+    def test_query_process_list(self):
+        result = self.service.query_process_list(sort='pid', order='asc', limit=1)
+        self.assertEqual(len(result['processes']), 1)
+        self.assertGreaterEqual(result['num_matches'], result['num_user_procs'])
+        self.assertEqual(result['num_procs'], result['num_matches'])
+
     @unittest2.skipIf(os.environ.get('USER') != 'root', 'os.setuid requires privileged user')
     def test_get_process_list_anonymous_process(self):
         os.setuid(12345)
@@ -260,6 +269,45 @@ class TestNode(unittest2.TestCase):
         self.assertEqual(len(content), LogReader.BUFFER_SIZE)
         os.close(fd)
 
+    def test_follow_log(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, 'FOOBAR\n' * 10000)
+        self.node.logs.add_available(filename)
+
+        result = self.service.follow_log(filename, 'tail')
+        self.assertEqual(result, {'position': 70000, 'content': ''})
+
+        os.write(fd, 'NEW\n' * 10)
+        result = self.service.follow_log(filename, 'tail', result['position'], 12)
+        self.assertEqual(result, {'position': 70012, 'content': 'NEW\n' * 3})
+        result = self.service.follow_log(filename, 'tail', result['position'])
+        self.assertEqual(result, {'position': 70040, 'content': 'NEW\n' * 7})
+        os.close(fd)
+
+    def test_read_log_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.write(fd, 'FOOBAR\n' * 10)
+        self.assertRaises(KeyError, self.service.read_log_file, filename, 0, 10)
+        self.node.logs.add_available(filename)
+
+        result = self.service.read_log_file(filename, 7, 6)
+        self.assertEqual(result, {'content': 'FOOBAR', 'size': 70})
+        os.close(fd)
+
+    def test_get_log_metrics(self):
+        fd, filename = tempfile.mkstemp()
+        self.node.logs.add_available(filename)
+        self.node.log_metrics = LogMetrics(self.node.logs, {filename: {'errors': 'ERROR'}})
+        self.node.log_metrics.update()
+        os.write(fd, 'ERROR\n' * 3)
+        self.node.log_metrics.update()
+
+        metrics = self.service.get_log_metrics(None, 10)
+        self.assertEqual(metrics[0]['filename'], filename)
+        self.assertEqual(metrics[0]['counts']['errors'][-1], 3)
+        self.assertEqual(metrics[0]['totals'], {'errors': 3})
+        os.close(fd)
+
     def test_search_log(self):
         fd, filename = tempfile.mkstemp()
         os.write(fd, 'FOOBAR\n' * 100)
@@ -281,3 +329,211 @@ class TestNode(unittest2.TestCase):
 
 
 
+
+
+class TestBatch(unittest2.TestCase):
+    def setUp(self):
+        self.service = LocalNode().get_service()
+
+    def test_batch(self):
+        sysinfo, disks = self.service.batch([('get_sysinfo', ()), ('get_disks', (True,))])
+        self.assertEqual(sysinfo['hostname'], socket.gethostname())
+        self.assertEqual(disks, self.service.get_disks(True))
+
+    def test_batch_invalid_method(self):
+        for name in ['nosuchmethod', 'batch', '_create_service', 'node']:
+            self.assertRaises(ValueError, self.service.batch, [(name, ())])
+
+    def test_batch_wire_format(self):
+        plain, columns = self.service.get_process_list(), self.service.batch([('get_process_list', ())], 'columns')[0]
+        self.assertIsInstance(plain, list)
+        self.assertIn('__columns__', columns)
+        self.assertRaises(ValueError, self.service.batch, [('get_sysinfo', ())], 'nosuchformat')
+
+    def test_batch_passes_exceptions(self):
+        self.assertRaises(psutil.NoSuchProcess, self.service.batch, [('get_sysinfo', ()), ('get_process', (0,))])
+
+class FakeClient(object):
+    def __init__(self):
+        self.error = None
+        self.calls = []
+        self.wire_formats = ['plain']
+        self.missing = set()
+
+    def __call__(self, method, *args):
+        self.calls.append(method)
+        if self.error:
+            raise self.error
+        if method in self.missing:
+            raise zerorpc.RemoteError('NameError', method, None)
+        if method == 'get_wire_formats':
+            return self.wire_formats
+        if method == 'batch':
+            return [name for name, _ in args[0]]
+        return method
+
+
+class TestCircuitBreaker(unittest2.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+
+    def test_opens_after_threshold(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.is_open())
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.is_open())
+
+    def test_single_trial_after_reset_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.opened_at -= 10
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_trial_closes(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.opened_at -= 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+
+
+class TestRemoteService(unittest2.TestCase):
+    def setUp(self):
+        self.node = RemoteNode('remote', 'example.org', 5000, failure_threshold=2)
+        self.client = FakeClient()
+        self.service = RemoteService(self.node, self.client, 'columns')
+
+    def test_call(self):
+        self.assertEqual(self.service.get_sysinfo(), 'get_sysinfo')
+
+    def test_timeout_raises_unavailable(self):
+        self.client.error = zerorpc.TimeoutExpired(1)
+        self.assertRaises(NodeUnavailable, self.service.get_sysinfo)
+        self.assertTrue(self.node.is_healthy())
+
+    def test_failing_node_is_not_called(self):
+        self.client.error = zerorpc.LostRemote()
+        self.assertRaises(NodeUnavailable, self.service.get_sysinfo)
+        self.assertRaises(NodeUnavailable, self.service.get_sysinfo)
+        self.assertFalse(self.node.is_healthy())
+
+        self.client.calls = []
+        self.assertRaises(NodeUnavailable, self.service.get_sysinfo)
+        self.assertEqual(self.client.calls, [])
+
+    def test_wire_format_negotiated(self):
+        self.client.wire_formats = ['plain', 'columns']
+        self.assertEqual(self.service.get_wire_format(), 'columns')
+        # bulk calls are batched to have them encoded
+        self.service.get_process_list()
+        self.assertEqual(self.client.calls, ['get_wire_formats', 'batch'])
+
+    def test_wire_format_not_supported(self):
+        self.client.error = zerorpc.RemoteError('NameError', 'Unknown command', None)
+        self.assertEqual(self.service.get_wire_format(), 'plain')
+
+    def test_batch_not_supported(self):
+        self.client.missing = set(['batch', 'get_wire_formats'])
+        calls = [('get_sysinfo', ()), ('get_cpu', ())]
+        self.assertEqual(self.service.batch(calls), ['get_sysinfo', 'get_cpu'])
+        self.assertFalse(self.service.batch_supported)
+
+        # not tried again
+        self.client.calls = []
+        self.assertEqual(self.service.batch(calls), ['get_sysinfo', 'get_cpu'])
+        self.assertEqual(self.service.get_process_list(), 'get_process_list')
+        self.assertEqual(self.client.calls, ['get_sysinfo', 'get_cpu', 'get_process_list'])
+
+    def test_remote_errors_do_not_count(self):
+        self.client.error = zerorpc.RemoteError('NoSuchProcess', 'no such process', None)
+        for _ in range(3):
+            self.assertRaises(zerorpc.RemoteError, self.service.get_process, 1)
+        self.assertTrue(self.node.is_healthy())
+
+    def _open_for_trial(self):
+        self.client.error = zerorpc.LostRemote()
+        for _ in range(2):
+            self.assertRaises(NodeUnavailable, self.service.get_sysinfo)
+        self.node.circuit_breaker.opened_at -= self.node.circuit_breaker.reset_timeout
+
+    def test_trial_remote_error_closes(self):
+        self._open_for_trial()
+        self.client.error = zerorpc.RemoteError('NoSuchProcess', 'no such process', None)
+        self.assertRaises(zerorpc.RemoteError, self.service.get_process, 1)
+        self.assertTrue(self.node.is_healthy())
+
+    def test_trial_failure_reopens(self):
+        self._open_for_trial()
+        self.client.error = ValueError('unexpected')
+        self.assertRaises(ValueError, self.service.get_sysinfo)
+        self.assertFalse(self.node.is_healthy())
+        self.assertFalse(self.node.circuit_breaker._trial_pending)
+
+    def test_caller_timeout_does_not_count(self):
+        self.client.error = gevent.Timeout()
+        for _ in range(3):
+            self.assertRaises(gevent.Timeout, self.service.get_sysinfo)
+        self.assertTrue(self.node.is_healthy())
+
+        # nor does it hold up the next trial
+        self._open_for_trial()
+        self.client.error = gevent.Timeout()
+        self.assertRaises(gevent.Timeout, self.service.get_sysinfo)
+        self.assertFalse(self.node.circuit_breaker._trial_pending)
+        self.assertTrue(self.node.circuit_breaker.allow())
+
+
+class TestPushedService(unittest2.TestCase):
+    def setUp(self):
+        local = LocalNode()
+        local.net_io_counters.update()
+        self.local_service = local.get_service()
+        results = self.local_service.batch(PUSH_CALLS)
+        calls = [(name, args, result) for (name, args), result in zip(PUSH_CALLS, results)]
+
+        self.node = RemoteNode('remote', 'example.org', 5000)
+        self.client = FakeClient()
+        self.node._service = RemoteService(self.node, self.client)
+        self.node.update_pushed(calls, 10)
+
+    def test_serves_pushed_calls(self):
+        service = self.node.get_service()
+        self.assertEqual(service.get_sysinfo()['hostname'], socket.gethostname())
+        self.assertEqual(service.get_disks(True), self.local_service.get_disks(True))
+        self.assertEqual(self.client.calls, [])
+
+    def test_query_process_list(self):
+        result = self.node.get_service().query_process_list('pid', 'asc', 0, 5, 'all', '')
+        self.assertEqual(len(result['processes']), 5)
+        self.assertEqual(result['processes'][0]['pid'], 1)
+        self.assertEqual(self.client.calls, [])
+
+    def test_get_connections_filtered(self):
+        conns = self.node.get_service().get_connections({'state': 'NOSUCHSTATE'})
+        self.assertEqual(conns, [])
+
+    def test_other_calls_go_to_node(self):
+        self.assertEqual(self.node.get_service().get_process(1), 'get_process')
+        self.assertEqual(self.client.calls, ['get_process'])
+
+    def test_batch(self):
+        sysinfo, process = self.node.get_service().batch([('get_sysinfo', ()), ('get_process', (1,))])
+        self.assertIn('hostname', sysinfo)
+        self.assertEqual(process, 'get_process')
+        self.assertEqual(self.client.calls, ['batch'])
+
+    def test_old_push_is_not_used(self):
+        self.node.pushed.timestamp -= 31
+        self.assertIsInstance(self.node.get_service(), RemoteService)
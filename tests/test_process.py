@@ -0,0 +1,233 @@
+import gevent
+import os
+import time
+import psutil
+import unittest2
+from collections import namedtuple
+from psdash.process import (ProcessTable, ProcessSnapshot, TrackedProcess, PROCESS_DETAIL_FIELDS,
+                            get_start_time, read_stat, read_fields, create_process_filter)
+
+CpuTimes = namedtuple('CpuTimes', ['user', 'system'])
+
+
+class TestProcessTable(unittest2.TestCase):
+    def setUp(self):
+        self.table = ProcessTable()
+
+    def test_first_get_samples(self):
+        self.assertIsNone(self.table.last_snapshot)
+        snapshot = self.table.get()
+        self.assertIsInstance(snapshot, ProcessSnapshot)
+        self.assertIs(self.table.last_snapshot, snapshot)
+
+    def test_get_reuses_snapshot(self):
+        self.assertIs(self.table.get(), self.table.get())
+
+    def test_update_replaces_snapshot(self):
+        first = self.table.update()
+        second = self.table.update()
+        self.assertIsNot(first, second)
+        self.assertIs(self.table.get(), second)
+
+    def test_snapshot_contains_current_process(self):
+        pids = [p['pid'] for p in self.table.update()]
+        self.assertIn(os.getpid(), pids)
+
+    def test_update_yields(self):
+        self.table.YIELD_INTERVAL = 1
+        greenlet = gevent.spawn(lambda: None)
+        self.table.update()
+        self.assertTrue(greenlet.ready())
+
+    def test_snapshot_is_immutable(self):
+        snapshot = self.table.update()
+        self.assertIsInstance(snapshot.processes, tuple)
+        self.assertEqual(len(snapshot), len(snapshot.processes))
+
+    def test_snapshot_get_process(self):
+        snapshot = self.table.update()
+        proc = snapshot.get_process(os.getpid())
+        self.assertEqual(proc['pid'], os.getpid())
+        self.assertIsNone(snapshot.get_process(-1))
+
+    def test_process_objects_are_reused(self):
+        self.table.update()
+        key = (os.getpid(), get_start_time(os.getpid()))
+        tracked = self.table._processes[key]
+        self.table.update()
+        self.assertIs(self.table._processes[key], tracked)
+
+    def test_dead_processes_are_evicted(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        key = (pid, get_start_time(pid))
+        self.table.update()
+        self.assertIn(key, self.table._processes)
+        os.waitpid(pid, 0)
+        self.table.update()
+        self.assertNotIn(key, self.table._processes)
+
+    def test_read_stat(self):
+        p = psutil.Process(os.getpid())
+        before = p.cpu_times()
+        start_time, cpu_times = read_stat(os.getpid())
+        after = p.cpu_times()
+        self.assertEqual(start_time, get_start_time(os.getpid()))
+        self.assertTrue(before.user <= cpu_times.user <= after.user)
+        self.assertTrue(before.system <= cpu_times.system <= after.system)
+
+    def test_cpu_percent_measured_between_samples(self):
+        self.table.update()
+        deadline = time.time() + 0.3
+        while time.time() < deadline:
+            pass
+        proc = self.table.update().get_process(os.getpid())
+        self.assertGreater(proc['cpu_percent'], 0)
+
+
+class TestTrackedProcess(unittest2.TestCase):
+    def test_first_sample_is_zero(self):
+        tracked = TrackedProcess(None, 0)
+        self.assertEqual(tracked.cpu_percent(CpuTimes(1.0, 1.0), 10.0), 0.0)
+
+    def test_percent_of_one_core(self):
+        tracked = TrackedProcess(None, 0)
+        tracked.cpu_percent(CpuTimes(1.0, 1.0), 10.0)
+        self.assertEqual(tracked.cpu_percent(CpuTimes(2.0, 1.5), 13.0), 50.0)
+
+
+class TestProcessReadCost(unittest2.TestCase):
+    """
+    Counts the calls made to psutil's platform implementation, which is
+    where the files in /proc are actually read and parsed.
+    """
+
+    def setUp(self):
+        self.calls = {}
+        self.originals = {}
+        for name, attr in vars(psutil._psplatform.Process).items():
+            if not name.startswith('_') and callable(attr):
+                self.originals[name] = attr
+                setattr(psutil._psplatform.Process, name, self._counting(name, attr))
+
+    def tearDown(self):
+        for name, attr in self.originals.items():
+            setattr(psutil._psplatform.Process, name, attr)
+
+    def _counting(self, name, func):
+        calls = self.calls
+
+        def wrapper(proc, *args, **kwargs):
+            # keyed on the object itself to keep it alive, so its id can't be reused
+            key = (proc, name)
+            calls[key] = calls.get(key, 0) + 1
+            return func(proc, *args, **kwargs)
+        return wrapper
+
+    def _calls_for(self, p):
+        return dict((name, n) for (proc, name), n in self.calls.items() if proc is p._proc)
+
+    def assertReadOnce(self, p):
+        calls = self._calls_for(p)
+        self.assertTrue(calls)
+        for name, n in calls.items():
+            self.assertEqual(n, 1, '%s was called %d times' % (name, n))
+
+    def test_detail_fields_are_read_once(self):
+        p = psutil.Process(os.getpid())
+        read_fields(p, PROCESS_DETAIL_FIELDS)
+        self.assertReadOnce(p)
+
+    def test_list_fields_are_read_once(self):
+        table = ProcessTable()
+        table.update()
+        tracked = table._processes[(os.getpid(), get_start_time(os.getpid()))]
+        self.assertReadOnce(tracked.process)
+
+    def test_stat_not_read_by_psutil_on_later_samples(self):
+        table = ProcessTable()
+        table.update()
+        tracked = table._processes[(os.getpid(), get_start_time(os.getpid()))]
+        self.calls.clear()
+        table.update()
+        calls = self._calls_for(tracked.process)
+        self.assertNotIn('cpu_times', calls)
+        self.assertNotIn('create_time', calls)
+
+    def test_fewer_reads_than_reading_each_field(self):
+        p = psutil.Process(os.getpid())
+        for _, accessor, _ in PROCESS_DETAIL_FIELDS:
+            getattr(p, accessor)()
+        per_field = sum(self._calls_for(p).values())
+
+        q = psutil.Process(os.getpid())
+        read_fields(q, PROCESS_DETAIL_FIELDS)
+        batched = sum(self._calls_for(q).values())
+
+        self.assertLess(batched, per_field)
+
+
+class TestProcessSnapshotQuery(unittest2.TestCase):
+    def setUp(self):
+        procs = [
+            {'pid': 1, 'name': 'init', 'cmdline': '/sbin/init', 'user': 'root', 'cpu_percent': 0.5, 'status': 'sleeping'},
+            {'pid': 2, 'name': 'nginx', 'cmdline': 'nginx: worker', 'user': 'www', 'cpu_percent': 12.0, 'status': 'running'},
+            {'pid': 3, 'name': 'python', 'cmdline': 'python app.py', 'user': 'www', 'cpu_percent': 3.0, 'status': 'sleeping'},
+            {'pid': 4, 'name': 'sshd', 'cmdline': '/usr/sbin/sshd', 'user': 'root', 'cpu_percent': 7.0, 'status': 'sleeping'},
+            {'pid': 5, 'name': 'bash', 'cmdline': '-bash', 'user': None, 'cpu_percent': 1.0, 'status': 'running'},
+        ]
+        self.snapshot = ProcessSnapshot(procs, time.time())
+
+    def _pids(self, procs):
+        return [p['pid'] for p in procs]
+
+    def test_sort_desc(self):
+        procs, num = self.snapshot.query(sort='cpu_percent', reverse=True)
+        self.assertEqual(self._pids(procs), [2, 4, 3, 5, 1])
+        self.assertEqual(num, 5)
+
+    def test_sort_asc(self):
+        procs, _ = self.snapshot.query(sort='pid', reverse=False)
+        self.assertEqual(self._pids(procs), [1, 2, 3, 4, 5])
+
+    def test_page_desc(self):
+        procs, num = self.snapshot.query(sort='cpu_percent', reverse=True, offset=1, limit=2)
+        self.assertEqual(self._pids(procs), [4, 3])
+        self.assertEqual(num, 5)
+
+    def test_page_asc(self):
+        procs, _ = self.snapshot.query(sort='pid', reverse=False, offset=3, limit=5)
+        self.assertEqual(self._pids(procs), [4, 5])
+
+    def test_offset_past_end(self):
+        procs, num = self.snapshot.query(sort='cpu_percent', offset=10, limit=5)
+        self.assertEqual(procs, [])
+        self.assertEqual(num, 5)
+
+    def test_index_is_reused(self):
+        self.assertIs(self.snapshot.get_index('pid'), self.snapshot.get_index('pid'))
+
+    def test_unindexed_sort(self):
+        procs, _ = self.snapshot.query(sort='status', reverse=True, limit=2)
+        self.assertEqual([p['status'] for p in procs], ['sleeping', 'sleeping'])
+
+    def test_user_filter(self):
+        procs, num = self.snapshot.query(sort='pid', reverse=False,
+                                         predicate=create_process_filter(user_only=True))
+        self.assertEqual(self._pids(procs), [2, 3, 5])
+        self.assertEqual(num, 3)
+        self.assertEqual(self.snapshot.get_num_user_processes(), 3)
+
+    def test_text_filter(self):
+        procs, num = self.snapshot.query(sort='pid', reverse=False, limit=1,
+                                         predicate=create_process_filter(text=u'WWW'))
+        self.assertEqual(self._pids(procs), [2])
+        self.assertEqual(num, 2)
+
+    def test_text_filter_pid(self):
+        procs, _ = self.snapshot.query(predicate=create_process_filter(text='4'))
+        self.assertEqual(self._pids(procs), [4])
+
+    def test_no_filter(self):
+        self.assertIsNone(create_process_filter())
@@ -55,6 +55,15 @@ class TestRunner(unittest2.TestCase):
         else:
             self.fail("Didn't find any changed network interface")
 
+    def test_publish_to_subscribers(self):
+        r = PsDashRunner()
+        publisher = r.get_publisher('localhost')
+        self.assertIs(publisher, r.get_publisher('localhost'))
+        s = publisher.subscribe(['overview', 'processes'])
+        r._publish('localhost', publisher, publisher.get_channels())
+        channels = set([s.get(timeout=0)[0], s.get(timeout=0)[0]])
+        self.assertEqual(channels, set(['overview', 'processes']))
+
     def test_local_node_is_added(self):
         r = PsDashRunner()
         self.assertIsInstance(r.get_local_node(), LocalNode)
@@ -76,6 +85,30 @@ class TestRunner(unittest2.TestCase):
         self.assertEqual(node.port, 5000)
         self.assertEqual(node.last_registered, now)
 
+    def test_evict_nodes(self):
+        r = PsDashRunner({'PSDASH_NODE_EVICT_AFTER': 60})
+        fresh = r.register_node('fresh', 'example.org', 5000)
+        stale = r.register_node('stale', 'example.org', 5001)
+        stale.last_registered -= 61
+        self.assertEqual(r.evict_nodes(), [stale.get_id()])
+        self.assertIsNone(r.get_node(stale.get_id()))
+        self.assertIs(r.get_node(fresh.get_id()), fresh)
+        self.assertIsNotNone(r.get_local_node())
+
+    def test_configured_nodes_are_not_evicted(self):
+        r = PsDashRunner({
+            'PSDASH_NODE_EVICT_AFTER': 60,
+            'PSDASH_NODES': [{'name': 'test-node', 'host': 'remotehost.org', 'port': 5000}]
+        })
+        r.get_node('remotehost.org:5000').last_registered -= 61
+        self.assertEqual(r.evict_nodes(), [])
+
+    def test_node_timeouts_from_config(self):
+        r = PsDashRunner({'PSDASH_NODE_TIMEOUT': 3, 'PSDASH_NODE_FAILURE_THRESHOLD': 5})
+        node = r.register_node('examplehost', 'example.org', 5000)
+        self.assertEqual(node.timeout, 3)
+        self.assertEqual(node.circuit_breaker.failure_threshold, 5)
+
     def test_get_all_nodes(self):
         r = PsDashRunner()
         r.register_node('examplehost', 'example.org', 5000)
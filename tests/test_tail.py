@@ -0,0 +1,135 @@
+# coding=utf-8
+import os
+import tempfile
+import unittest2
+from psdash.node import LocalNode
+from psdash.tail import LogTails, TailSubscription
+
+
+class DummyTail(object):
+    def wakeup(self):
+        pass
+
+
+class TestTailSubscription(unittest2.TestCase):
+    def test_get(self):
+        s = TailSubscription(DummyTail(), 10)
+        s.put('abc')
+        s.put('def')
+        self.assertEqual(s.get(), (0, 'abcdef'))
+        self.assertIsNone(s.get(timeout=0.01))
+
+    def test_skips_oldest(self):
+        s = TailSubscription(DummyTail(), 10)
+        s.put('aaaa')
+        s.put('bbbb')
+        s.put('cccc')
+        self.assertEqual(s.buffered, 8)
+        self.assertEqual(s.get(), (4, 'bbbbcccc'))
+
+        s.put('x' * 15)
+        self.assertEqual(s.get(), (5, 'x' * 10))
+
+    def test_close(self):
+        s = TailSubscription(DummyTail(), 10)
+        s.close()
+        s.put('abc')
+        self.assertIsNone(s.get(timeout=1))
+
+
+class TestLogTails(unittest2.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        self.fp = os.fdopen(fd, 'w')
+        self.fp.write('before\n')
+        self.fp.flush()
+        self.node = LocalNode()
+        self.node.logs.add_available(self.filename)
+        self.tails = LogTails(self.node, 'tail', poll_interval=0.01)
+
+    def tearDown(self):
+        self.tails.close()
+        self.fp.close()
+        self.node.logs.clear_available()
+        os.remove(self.filename)
+
+    def _append(self, content):
+        self.fp.write(content)
+        self.fp.flush()
+
+    def test_follow(self):
+        s = self.tails.subscribe(self.filename)
+        self._append('after\n')
+        self.assertEqual(s.get(timeout=1), (0, 'after\n'))
+
+    def test_shared_by_subscribers(self):
+        s1 = self.tails.subscribe(self.filename)
+        s2 = self.tails.subscribe(self.filename)
+        self.assertEqual(len(self.tails.tails), 1)
+        self._append('after\n')
+        self.assertEqual(s1.get(timeout=1), (0, 'after\n'))
+        self.assertEqual(s2.get(timeout=1), (0, 'after\n'))
+
+        self.tails.unsubscribe(s1)
+        self.assertEqual(len(self.tails.tails), 1)
+        self.tails.unsubscribe(s2)
+        self.assertEqual(self.tails.tails, {})
+
+    def test_slow_subscriber(self):
+        tails = LogTails(self.node, 'tail', max_buffered=100, poll_interval=0.01, read_size=10)
+        slow = tails.subscribe(self.filename)
+        fast = tails.subscribe(self.filename)
+        content = ''.join('line %02d\n' % i for i in xrange(30))
+        self._append(content)
+
+        received = ''
+        while len(received) < len(content):
+            received += fast.get(timeout=1)[1]
+        self.assertEqual(received, content)
+
+        skipped, buffered = slow.get()
+        self.assertEqual(slow.max_buffered, len(buffered))
+        self.assertEqual(skipped + len(buffered), len(content))
+        self.assertTrue(content.endswith(buffered))
+        tails.close()
+
+    def test_held_up_by_subscribers(self):
+        tails = LogTails(self.node, 'tail', max_buffered=10, poll_interval=0.01, read_size=10)
+        s = tails.subscribe(self.filename)
+        content = 'x' * 20 + 'y' * 20
+        self._append(content)
+
+        received = ''
+        while len(received) < len(content):
+            skipped, buffered = s.get(timeout=1)
+            self.assertEqual(skipped, 0)
+            received += buffered
+        self.assertEqual(received, content)
+        tails.close()
+
+    def test_not_available(self):
+        self.assertRaises(KeyError, self.tails.subscribe, '/var/log/nosuchlog')
+
+    def test_truncated(self):
+        s = self.tails.subscribe(self.filename)
+        self.fp.seek(0)
+        self.fp.truncate()
+        self._append('new\n')
+        self.assertEqual(s.get(timeout=1), (0, 'new\n'))
+
+    def test_inotify(self):
+        tails = LogTails(self.node, 'tail', poll_interval=60, use_inotify=True)
+        s = tails.subscribe(self.filename)
+        # let the tail catch up and wait for changes
+        self.assertIsNone(s.get(timeout=0.1))
+        if not tails._watches:
+            tails.close()
+            self.skipTest('inotify is not available')
+
+        self._append('after\n')
+        self.assertEqual(s.get(timeout=5), (0, 'after\n'))
+        tails.close()
+
+
+if __name__ == '__main__':
+    unittest2.main()
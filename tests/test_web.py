@@ -1,11 +1,16 @@
 import gevent
+import gzip
 import json
 import unittest2
 import base64
 import os
 import tempfile
+import time
 import urllib2
+import msgpack
+import zerorpc
 from psdash.run import PsDashRunner
+from psdash.node import PUSH_CALLS, RemoteService, is_unknown_method
 
 try:
     import httplib
@@ -178,6 +183,10 @@ class TestEndpoints(unittest2.TestCase):
         resp = self.client.get('/processes')
         self.assertEqual(resp.status_code, httplib.OK)
 
+    def test_processes_paged(self):
+        resp = self.client.get('/processes/pid/asc/all?offset=10&limit=5&q=python')
+        self.assertEqual(resp.status_code, httplib.OK)
+
     def test_process_overview(self):
         resp = self.client.get('/process/%d' % self.pid)
         self.assertEqual(resp.status_code, httplib.OK)
@@ -236,6 +245,33 @@ class TestEndpoints(unittest2.TestCase):
         resp = self.client.get('/register?name=examplehost&port=500')
         self.assertEqual(resp.status_code, httplib.OK)
 
+    def test_cluster(self):
+        resp = self.client.get('/cluster')
+        self.assertEqual(resp.status_code, httplib.OK)
+
+    def test_push(self):
+        service = self.r.get_local_node().get_service()
+        results = service.batch(PUSH_CALLS)
+        data = msgpack.packb({
+            'interval': 10,
+            'calls': [(name, args, result) for (name, args), result in zip(PUSH_CALLS, results)]
+        })
+        resp = self.client.post('/push?name=pushhost&port=5000', data=data,
+                                environ_base={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(resp.status_code, httplib.OK)
+
+        node = self.r.get_node('127.0.0.1:5000')
+        self.assertEqual(node.name, 'pushhost')
+        self.assertTrue(node.is_push_current())
+        # served from the push, the node has no agent to call
+        for url in ['/', '/processes', '/network', '/disks']:
+            resp = self.client.get('%s?node=%s' % (url, node.get_id()))
+            self.assertEqual(resp.status_code, httplib.OK)
+
+    def test_push_invalid_data(self):
+        resp = self.client.post('/push?name=pushhost&port=5000', data='not msgpack')
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
     def test_register_node_all_params_required(self):
         resp = self.client.get('/register?name=examplehost')
         self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
@@ -244,6 +280,143 @@ class TestEndpoints(unittest2.TestCase):
         self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
 
 
+class TestApi(unittest2.TestCase):
+    def setUp(self):
+        self.r = PsDashRunner()
+        self.client = self.r.app.test_client()
+        self.pid = os.getpid()
+        self.r.get_local_node().net_io_counters.update()
+
+    def _get_json(self, url):
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.mimetype, 'application/json')
+        return json.loads(resp.data)
+
+    def test_sysinfo(self):
+        data = self._get_json('/api/v1/sysinfo')
+        self.assertIn('hostname', data)
+
+    def test_memory(self):
+        data = self._get_json('/api/v1/memory')
+        self.assertIn('total', data)
+
+    def test_cpu(self):
+        data = self._get_json('/api/v1/cpu')
+        self.assertIn('user', data)
+
+    def test_network(self):
+        data = self._get_json('/api/v1/network')
+        self.assertIsInstance(data, dict)
+
+    def test_connections(self):
+        data = self._get_json('/api/v1/connections?state=')
+        self.assertIsInstance(data, list)
+
+    def test_processes(self):
+        data = self._get_json('/api/v1/processes?sort=pid&order=asc&limit=2')
+        self.assertEqual(len(data['processes']), 2)
+        self.assertIn('num_matches', data)
+
+    def test_process(self):
+        data = self._get_json('/api/v1/processes/%d' % self.pid)
+        self.assertEqual(data['pid'], self.pid)
+
+    def test_process_section(self):
+        data = self._get_json('/api/v1/processes/%d/threads' % self.pid)
+        self.assertIsInstance(data, list)
+
+    def test_process_invalid_section(self):
+        resp = self.client.get('/api/v1/processes/%d/whatnot' % self.pid)
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+    def test_process_non_existing_pid(self):
+        resp = self.client.get('/api/v1/processes/0')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        self.assertIn('error', json.loads(resp.data))
+
+    def test_etag_not_modified(self):
+        resp = self.client.get('/api/v1/swap')
+        etag = resp.headers['ETag']
+        self.assertTrue(etag)
+
+        resp = self.client.get('/api/v1/swap', headers=[('If-None-Match', etag)])
+        self.assertEqual(resp.status_code, httplib.NOT_MODIFIED)
+        self.assertEqual(resp.data, '')
+
+    def test_unknown_node(self):
+        resp = self.client.get('/api/v1/sysinfo?node=nosuchnode')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+    def test_basic_auth_required(self):
+        self.r.app.config['PSDASH_AUTH_USERNAME'] = 'tester'
+        self.r.app.config['PSDASH_AUTH_PASSWORD'] = 'secret'
+        resp = self.client.get('/api/v1/sysinfo')
+        self.assertEqual(resp.status_code, httplib.UNAUTHORIZED)
+
+    def test_history(self):
+        node = self.r.get_local_node()
+        node.history.add_sample(*node.host_metrics.sample())
+        self.assertIn('cpu.user', self._get_json('/api/v1/history'))
+        data = self._get_json('/api/v1/history/cpu.user?resolution=1')
+        self.assertEqual(data['resolution'], 1)
+
+    def test_history_unknown_metric(self):
+        resp = self.client.get('/api/v1/history/nosuchmetric')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        self.assertEqual(json.loads(resp.data)['error'], 'No history of metric "nosuchmetric"')
+
+    def test_cluster(self):
+        data = self._get_json('/api/v1/cluster')
+        self.assertEqual(len(data), 1)
+        self.assertEqual(data[0]['id'], 'localhost')
+        self.assertEqual(data[0]['status'], 'ok')
+        self.assertIn('memory_percent', data[0]['summary'])
+
+    def test_service_calls_memoized_per_request(self):
+        calls = []
+        service = self.r.get_local_node().get_service()
+        get_sysinfo = service.get_sysinfo
+
+        def counting_get_sysinfo():
+            calls.append(1)
+            return get_sysinfo()
+        service.get_sysinfo = counting_get_sysinfo
+
+        self.assertEqual(self.client.get('/', headers=[('X-Requested-With', 'XMLHttpRequest')]).status_code, httplib.OK)
+        self.assertEqual(self.client.get('/network').status_code, httplib.OK)
+        self.assertEqual(len(calls), 2)
+
+    def test_unavailable_node(self):
+        node = self.r.register_node('examplehost', '127.0.0.1', 5000)
+        node.circuit_breaker.record_failure()
+        node.circuit_breaker.opened_at = time.time()
+        resp = self.client.get('/api/v1/sysinfo?node=%s' % node.get_id())
+        self.assertEqual(resp.status_code, httplib.SERVICE_UNAVAILABLE)
+        self.assertIn('error', json.loads(resp.data))
+
+        resp = self.client.get('/?node=%s' % node.get_id())
+        self.assertEqual(resp.status_code, httplib.SERVICE_UNAVAILABLE)
+
+    def test_stream(self):
+        self.r.get_publisher('localhost').publish('overview', {'uptime': 10})
+        resp = self.client.get('/api/v1/stream?channels=overview')
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        event = next(iter(resp.response))
+        self.assertEqual(event, 'event: overview\ndata: {"uptime":10}\n\n')
+        resp.close()
+
+    def test_stream_unknown_channel(self):
+        resp = self.client.get('/api/v1/stream?channels=overview,nosuchchannel')
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
+    def test_url_prefix(self):
+        r = PsDashRunner({'PSDASH_URL_PREFIX': '/subfolder/'})
+        resp = r.app.test_client().get('/subfolder/api/v1/sysinfo')
+        self.assertEqual(resp.status_code, httplib.OK)
+
+
 class TestLogs(unittest2.TestCase):
     def _create_log_file(self):
         fd, filename = tempfile.mkstemp()
@@ -264,6 +437,141 @@ class TestLogs(unittest2.TestCase):
     def test_logs(self):
         resp = self.client.get('/logs')
         self.assertEqual(resp.status_code, httplib.OK)
+        # the merged view is of the logs of the same node
+        self.assertIn('<input type="hidden" name="node" value="localhost" />', resp.data)
+
+    def test_merged(self):
+        other = self._create_log_file()
+        self.r.get_local_node().logs.add_available(other)
+        resp = self.client.get('/log/merged?filename=%s&filename=%s' % (self.filename, other))
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertIn('[%s] something' % os.path.basename(other), resp.data)
+
+        resp = self.client.get('/log/merged?filename=%s&filename=%s&seek_tail=0' % (self.filename, other),
+                               environ_overrides={'HTTP_X_REQUESTED_WITH': 'xmlhttprequest'})
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.data, '')
+
+    def test_log_tail(self):
+        resp = self.client.get('/api/v1/logs/tail?filename=%s' % self.filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        with open(self.filename, 'a') as f:
+            f.write('appended\n')
+        event = next(iter(resp.response))
+        self.assertEqual(event, 'event: append\ndata: {"content":"appended\\n","skipped":0}\n\n')
+        resp.close()
+        self.assertEqual(self.r.get_log_tails('localhost').tails, {})
+
+    def test_log_tail_not_found(self):
+        resp = self.client.get('/api/v1/logs/tail?filename=/var/log/nosuchlog')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+    def test_log_lines(self):
+        resp = self.client.get('/api/v1/logs/lines?filename=%s&start=99&count=3' % self.filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['lines'], ['woha', 'something', 'woha'])
+        self.assertEqual(data['num_lines'], 201)
+
+        resp = self.client.get('/api/v1/logs/lines?filename=%s&count=-1' % self.filename)
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
+    def test_log_range(self):
+        resp = self.client.get('/api/v1/logs/range?filename=%s&offset=500&length=9' % self.filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['content'], 'something')
+        self.assertEqual(data['line_number'], 100)
+
+    def test_log_download(self):
+        resp = self.client.get('/log/download?filename=%s' % self.filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(resp.headers['Accept-Ranges'], 'bytes')
+        with open(self.filename) as f:
+            self.assertEqual(resp.data, f.read())
+
+    def test_log_download_range(self):
+        resp = self.client.get('/log/download?filename=%s' % self.filename, headers={'Range': 'bytes=500-508'})
+        self.assertEqual(resp.status_code, httplib.PARTIAL_CONTENT)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes 500-508/1010')
+        self.assertEqual(resp.data, 'something')
+
+        resp = self.client.get('/log/download?filename=%s' % self.filename, headers={'Range': 'bytes=-5'})
+        self.assertEqual(resp.data, 'woha\n')
+
+        resp = self.client.get('/log/download?filename=%s' % self.filename, headers={'Range': 'bytes=2000-'})
+        self.assertEqual(resp.status_code, httplib.REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(resp.headers['Content-Range'], 'bytes */1010')
+
+    def test_log_download_gzip(self):
+        _, filename = tempfile.mkstemp(suffix='.log.gz')
+        f = gzip.open(filename, 'wb')
+        f.write('line\n' * 1000)
+        f.close()
+        self.r.get_local_node().logs.add_available(filename)
+
+        resp = self.client.get('/log/download?filename=%s' % filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        with open(filename, 'rb') as f:
+            self.assertEqual(resp.data, f.read())
+        self.assertEqual(resp.headers['Content-Length'], str(os.path.getsize(filename)))
+        self.r.get_local_node().logs.remove_available(filename)
+        os.remove(filename)
+
+    def test_log_download_not_found(self):
+        resp = self.client.get('/log/download?filename=/var/log/nosuchlog')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+    def test_log_metrics(self):
+        r = PsDashRunner({'PSDASH_LOG_METRICS': {self.filename: {'something': 'some'}}})
+        r.get_local_node().logs.add_available(self.filename)
+        log_metrics = r.get_local_node().log_metrics
+        log_metrics.update()
+        with open(self.filename, 'a') as f:
+            f.write('something\n' * 3)
+        log_metrics.update()
+
+        client = r.app.test_client()
+        resp = client.get('/api/v1/logs/metrics?minutes=5')
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['filename'], self.filename)
+        self.assertEqual(data[0]['counts']['something'][-1], 3)
+        self.assertEqual(len(data[0]['counts']['something']), 5)
+
+        resp = client.get('/logs')
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertIn('<polyline', resp.data)
+        self.assertIn('something: 3', resp.data)
+
+        resp = client.get('/api/v1/logs/metrics?minutes=0')
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
+    def test_merged_search(self):
+        other = self._create_log_file()
+        self.r.get_local_node().logs.add_available(other)
+        url = '/api/v1/logs/merged/search?filename=%s&filename=%s&q=something&limit=1' % (self.filename, other)
+        data = json.loads(self.client.get(url).data)
+        self.assertEqual(len(data['matches']), 1)
+        found = set([data['matches'][0]['filename']])
+
+        data = json.loads(self.client.get(url + '&before=%s' % data['next']).data)
+        found.add(data['matches'][0]['filename'])
+        self.assertEqual(found, set([self.filename, other]))
+        self.assertIsNone(data['next'])
+
+    def test_merged_search_invalid_cursor(self):
+        resp = self.client.get('/api/v1/logs/merged/search?filename=%s&q=something&before=1,2' % self.filename)
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
+    def test_logs_stats(self):
+        self.client.get('/log?filename=%s' % self.filename)
+        resp = self.client.get('/api/v1/logs/stats')
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data['readers'], 1)
+        self.assertEqual(data['open_files'], 1)
 
     def test_logs_removed_file(self):
         filename = self._create_log_file()
@@ -302,6 +610,37 @@ class TestLogs(unittest2.TestCase):
         except ValueError:
             self.fail('Log search did not return valid json data')
 
+    def test_matches(self):
+        resp = self.client.get('/log/matches?filename=%s&q=SOME&q=thing&mode=all&ignore_case=1&context=2'
+                               % self.filename)
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['matches']), 1)
+        self.assertEqual(data['matches'][0]['line_number'], 100)
+        self.assertEqual(data['matches'][0]['before'], ['woha', 'woha'])
+        self.assertIsNone(data['next'])
+
+    def test_matches_paged(self):
+        resp = self.client.get('/api/v1/logs/search?filename=%s&q=woha&limit=150' % self.filename)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['matches']), 150)
+        self.assertEqual(data['matches'][0]['line_number'], 200)
+
+        resp = self.client.get('/api/v1/logs/search?filename=%s&q=woha&limit=150&before=%d'
+                               % (self.filename, data['next']))
+        data = json.loads(resp.data)
+        self.assertEqual(len(data['matches']), 50)
+        self.assertEqual(data['matches'][-1]['line_number'], 0)
+        self.assertIsNone(data['next'])
+
+    def test_matches_invalid_regex(self):
+        resp = self.client.get('/api/v1/logs/search?filename=%s&q=(woha&regex=1' % self.filename)
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
+    def test_matches_no_terms(self):
+        resp = self.client.get('/log/matches?filename=%s' % self.filename)
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+
     def test_read(self):
         resp = self.client.get('/log?filename=%s' % self.filename,
                                environ_overrides={'HTTP_X_REQUESTED_WITH': 'xmlhttprequest'})
@@ -320,6 +659,12 @@ class TestLogs(unittest2.TestCase):
         resp = self.client.get('/log/search?filename=%s&text=%s' % (filename, 'something'))
         self.assertEqual(resp.status_code, httplib.NOT_FOUND)
 
+        resp = self.client.get('/log/matches?filename=%s&q=%s' % (filename, 'something'))
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+        resp = self.client.get('/log/merged?filename=%s&filename=%s' % (self.filename, filename))
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
         resp = self.client.get('/log/read?filename=%s' % filename)
         self.assertEqual(resp.status_code, httplib.NOT_FOUND)
 
@@ -327,5 +672,106 @@ class TestLogs(unittest2.TestCase):
         self.assertEqual(resp.status_code, httplib.NOT_FOUND)
 
 
+class AgentClient(object):
+    """
+    Calls a local service as the client of a remote agent, raising the
+    exceptions of the service as zerorpc does.
+    """
+    missing = set()
+
+    def __init__(self, service):
+        self.service = service
+
+    def __call__(self, method, *args):
+        if method in self.missing:
+            raise zerorpc.RemoteError('NameError', method, None)
+        if method == 'batch':
+            for name, _ in args[0]:
+                if name in self.missing:
+                    raise zerorpc.RemoteError('ValueError', 'Invalid method in batch: %s' % name, None)
+        try:
+            return getattr(self.service, method)(*args)
+        except Exception as e:
+            raise zerorpc.RemoteError(type(e).__name__, str(e), None)
+
+
+class OldAgentClient(AgentClient):
+    """
+    An agent from before the missing methods.
+    """
+    missing = set(['query_process_list', 'get_log_metrics'])
+
+
+class TestRemoteErrors(unittest2.TestCase):
+    def setUp(self):
+        self.r = PsDashRunner()
+        self.client = self.r.app.test_client()
+        node = self.r.register_node('remotehost', '127.0.0.1', 5000)
+        node._service = RemoteService(node, AgentClient(self.r.get_local_node().get_service()))
+        self.node_id = node.get_id()
+
+    def _get(self, url):
+        return self.client.get('%s&node=%s' % (url, self.node_id))
+
+    def test_not_found(self):
+        filename = '/var/log/surelynotaroundright.log'
+        for url in ['/api/v1/logs/lines?filename=%s', '/api/v1/logs/range?filename=%s',
+                    '/api/v1/logs/search?filename=%s&q=x']:
+            resp = self._get(url % filename)
+            self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+
+        resp = self._get('/api/v1/history/nosuchmetric?resolution=1')
+        self.assertEqual(resp.status_code, httplib.NOT_FOUND)
+        self.assertNotIn("'", json.loads(resp.data)['error'])
+
+    def test_bad_request(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        self.r.get_local_node().logs.add_available(filename)
+        resp = self._get('/api/v1/logs/range?filename=%s&offset=-1' % filename)
+        self.assertEqual(resp.status_code, httplib.BAD_REQUEST)
+        os.remove(filename)
+
+    def test_other_errors_fail(self):
+        pid = os.fork()
+        if not pid:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        resp = self._get('/api/v1/processes/%d?' % pid)
+        self.assertEqual(resp.status_code, httplib.INTERNAL_SERVER_ERROR)
+
+
+class TestOldAgent(unittest2.TestCase):
+    def setUp(self):
+        self.r = PsDashRunner()
+        self.client = self.r.app.test_client()
+        node = self.r.register_node('oldhost', '127.0.0.1', 5000)
+        node._service = RemoteService(node, OldAgentClient(self.r.get_local_node().get_service()))
+        self.node_id = node.get_id()
+
+    def test_is_unknown_method(self):
+        self.assertTrue(is_unknown_method(zerorpc.RemoteError('NameError', 'get_log_metrics', None)))
+        self.assertTrue(is_unknown_method(zerorpc.RemoteError('ValueError', 'Invalid method in batch: x', None)))
+        self.assertFalse(is_unknown_method(zerorpc.RemoteError('ValueError', 'invalid literal', None)))
+        self.assertFalse(is_unknown_method(NameError('x')))
+
+    def test_processes(self):
+        resp = self.client.get('/processes?node=%s' % self.node_id)
+        self.assertEqual(resp.status_code, httplib.OK)
+
+        resp = self.client.get('/api/v1/processes?node=%s&limit=5' % self.node_id)
+        self.assertEqual(resp.status_code, httplib.OK)
+        data = json.loads(resp.data)
+        self.assertLessEqual(len(data['processes']), 5)
+
+    def test_logs(self):
+        resp = self.client.get('/logs?node=%s' % self.node_id)
+        self.assertEqual(resp.status_code, httplib.OK)
+
+        resp = self.client.get('/api/v1/logs/metrics?node=%s' % self.node_id)
+        self.assertEqual(resp.status_code, httplib.OK)
+        self.assertEqual(json.loads(resp.data), [])
+
+
 if __name__ == '__main__':
     unittest2.main()
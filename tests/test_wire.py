@@ -0,0 +1,55 @@
+import msgpack
+import unittest2
+from psdash.node import LocalNode
+from psdash.wire import (encode_result, decode_result, encode_rows, decode_rows,
+                         PLAIN, COLUMNS, COLUMNS_ZLIB)
+
+
+class TestColumns(unittest2.TestCase):
+    def setUp(self):
+        self.rows = [
+            {'pid': 1, 'name': 'init', 'user': 'root', 'cpu_percent': 0.5, 'big': 2 ** 63, 'flag': True},
+            {'pid': 2, 'name': 'bash', 'user': None, 'cpu_percent': 1.0, 'big': 1, 'flag': False},
+            {'pid': 3, 'name': 'init', 'user': 'root', 'cpu_percent': 0.0, 'big': 2, 'flag': True},
+        ]
+
+    def _roundtrip(self, value, wire_format):
+        return decode_result(msgpack.unpackb(msgpack.packb(encode_result(value, wire_format))))
+
+    def test_roundtrip(self):
+        self.assertEqual(decode_rows(encode_rows(self.rows)), self.rows)
+
+    def test_types_are_kept(self):
+        row = self._roundtrip(self.rows, COLUMNS)[0]
+        self.assertIs(type(row['pid']), int)
+        self.assertIs(type(row['cpu_percent']), float)
+        self.assertIs(row['flag'], True)
+
+    def test_strings_are_interned(self):
+        columns = dict((name, (t, data)) for name, t, data in encode_rows(self.rows)['columns'])
+        column_type, (table, _) = columns['name']
+        self.assertEqual(column_type, 's')
+        self.assertEqual(table, ['init', 'bash'])
+
+    def test_all_formats(self):
+        for wire_format in (PLAIN, COLUMNS, COLUMNS_ZLIB):
+            self.assertEqual(self._roundtrip(self.rows, wire_format), self.rows)
+
+    def test_rows_within_dict(self):
+        value = {'processes': self.rows, 'num_matches': 3}
+        self.assertEqual(self._roundtrip(value, COLUMNS_ZLIB), value)
+
+    def test_other_values_are_untouched(self):
+        for value in [{'hostname': 'test'}, [1, 2], [], 'text', None]:
+            self.assertEqual(encode_result(value, COLUMNS), value)
+            self.assertEqual(decode_result(value), value)
+
+    def test_process_list_is_smaller(self):
+        node = LocalNode()
+        processes = node.get_service().get_process_list()
+        plain = len(msgpack.packb(processes))
+        columns = len(msgpack.packb(encode_result(processes, COLUMNS)))
+        compressed = len(msgpack.packb(encode_result(processes, COLUMNS_ZLIB)))
+        self.assertLess(columns, plain)
+        self.assertLess(compressed, columns)
+        self.assertEqual(self._roundtrip(processes, COLUMNS), processes)